@@ -0,0 +1,285 @@
+# -*- test-case-name: vxyowsup.tests.test_axolotl_store -*-
+'''Keeps each account's axolotl keys and sessions in Redis instead of
+yowsup's SQLite database.
+
+The stack uses a ``MemoryAxolotlStore``, loaded with everything in Redis
+for its account when the transport starts, so encrypting and decrypting
+never wait for storage. Every change it makes is passed back to the reactor
+and written to Redis behind it by ``AxolotlStateStore``.
+'''
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from axolotl.ecc.djbec import DjbECPublicKey, DjbECPrivateKey
+from axolotl.identitykey import IdentityKey
+from axolotl.identitykeypair import IdentityKeyPair
+from axolotl.invalidkeyidexception import InvalidKeyIdException
+from axolotl.state.axolotlstore import AxolotlStore
+from axolotl.state.prekeyrecord import PreKeyRecord
+from axolotl.state.sessionrecord import SessionRecord
+from axolotl.state.signedprekeyrecord import SignedPreKeyRecord
+
+from yowsup.layers.axolotl import YowAxolotlLayer
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter
+
+
+class MemoryAxolotlStore(AxolotlStore):
+    '''An axolotl store held in memory.
+
+    ``state`` maps field names to serialized values, as kept in Redis:
+
+    * ``local:registration_id``, ``local:public_key`` and
+      ``local:private_key`` for the account's own identity,
+    * ``identity:<recipient>`` for the identity keys of contacts,
+    * ``prekey:<id>`` and ``signed_prekey:<id>`` for prekey records and
+    * ``session:<recipient>:<device>`` for session records.
+
+    Records are kept serialized and a fresh one is returned by every load,
+    since the caller changes it and only stores it back if decrypting
+    succeeds. Each change is passed to ``on_change`` as the field and its new
+    value, or None if it was removed.
+    '''
+
+    def __init__(self, state=None, on_change=None):
+        self.state = dict(state or {})
+        self.on_change = on_change
+
+    def _set(self, field, value):
+        self.state[field] = value
+        if self.on_change is not None:
+            self.on_change(field, value)
+
+    def _delete(self, field):
+        if self.state.pop(field, None) is not None:
+            if self.on_change is not None:
+                self.on_change(field, None)
+
+    def _fields(self, prefix):
+        return [
+            (field[len(prefix):], value)
+            for field, value in self.state.iteritems()
+            if field.startswith(prefix)]
+
+    # Our own identity
+
+    def getIdentityKeyPair(self):
+        public_key = self.state['local:public_key']
+        return IdentityKeyPair(
+            IdentityKey(DjbECPublicKey(public_key[1:])),
+            DjbECPrivateKey(self.state['local:private_key']))
+
+    def getLocalRegistrationId(self):
+        registration_id = self.state.get('local:registration_id')
+        if registration_id is None:
+            return None
+        return int(registration_id)
+
+    def storeLocalData(self, registrationId, identityKeyPair):
+        self._set(
+            'local:public_key',
+            identityKeyPair.getPublicKey().getPublicKey().serialize())
+        self._set(
+            'local:private_key', identityKeyPair.getPrivateKey().serialize())
+        # Set last, since it is what says the keys are there.
+        self._set('local:registration_id', str(registrationId))
+
+    # Contacts' identities
+
+    def saveIdentity(self, recepientId, identityKey):
+        self._set(
+            'identity:%s' % (recepientId,),
+            identityKey.getPublicKey().serialize())
+
+    def isTrustedIdentity(self, recepientId, identityKey):
+        known = self.state.get('identity:%s' % (recepientId,))
+        return known is None or known == identityKey.getPublicKey().serialize()
+
+    # Prekeys
+
+    def loadPreKey(self, preKeyId):
+        record = self.state.get('prekey:%s' % (preKeyId,))
+        if record is None:
+            raise InvalidKeyIdException('No such prekey: %s' % (preKeyId,))
+        return PreKeyRecord(serialized=record)
+
+    def loadPreKeys(self):
+        return [
+            PreKeyRecord(serialized=record)
+            for _id, record in sorted(
+                self._fields('prekey:'), key=lambda item: int(item[0]))]
+
+    def storePreKey(self, preKeyId, preKeyRecord):
+        self._set('prekey:%s' % (preKeyId,), preKeyRecord.serialize())
+
+    def containsPreKey(self, preKeyId):
+        return 'prekey:%s' % (preKeyId,) in self.state
+
+    def removePreKey(self, preKeyId):
+        self._delete('prekey:%s' % (preKeyId,))
+
+    # Signed prekeys
+
+    def loadSignedPreKey(self, signedPreKeyId):
+        record = self.state.get('signed_prekey:%s' % (signedPreKeyId,))
+        if record is None:
+            raise InvalidKeyIdException(
+                'No such signed prekey: %s' % (signedPreKeyId,))
+        return SignedPreKeyRecord(serialized=record)
+
+    def loadSignedPreKeys(self):
+        return [
+            SignedPreKeyRecord(serialized=record)
+            for _id, record in sorted(
+                self._fields('signed_prekey:'),
+                key=lambda item: int(item[0]))]
+
+    def storeSignedPreKey(self, signedPreKeyId, signedPreKeyRecord):
+        self._set(
+            'signed_prekey:%s' % (signedPreKeyId,),
+            signedPreKeyRecord.serialize())
+
+    def containsSignedPreKey(self, signedPreKeyId):
+        return 'signed_prekey:%s' % (signedPreKeyId,) in self.state
+
+    def removeSignedPreKey(self, signedPreKeyId):
+        self._delete('signed_prekey:%s' % (signedPreKeyId,))
+
+    # Sessions
+
+    def _session_field(self, recepientId, deviceId):
+        return 'session:%s:%s' % (recepientId, deviceId)
+
+    def loadSession(self, recepientId, deviceId):
+        record = self.state.get(self._session_field(recepientId, deviceId))
+        if record is None:
+            return SessionRecord()
+        return SessionRecord(serialized=record)
+
+    def getSubDeviceSessions(self, recepientId):
+        return sorted(
+            int(device)
+            for device, _record in self._fields('session:%s:' % (
+                recepientId,)))
+
+    def storeSession(self, recepientId, deviceId, sessionRecord):
+        self._set(
+            self._session_field(recepientId, deviceId),
+            sessionRecord.serialize())
+
+    def containsSession(self, recepientId, deviceId):
+        return self._session_field(recepientId, deviceId) in self.state
+
+    def deleteSession(self, recepientId, deviceId):
+        self._delete(self._session_field(recepientId, deviceId))
+
+    def deleteAllSessions(self, recepientId):
+        for deviceId in self.getSubDeviceSessions(recepientId):
+            self.deleteSession(recepientId, deviceId)
+
+
+class StoredAxolotlLayer(YowAxolotlLayer):
+    '''The axolotl layer, using ``store`` instead of a SQLite database.
+
+    Yowsup drops its store when the connection is lost and opens the
+    database again when it is next needed. This layer puts the same store
+    back instead.
+    '''
+
+    def __init__(self, store):
+        self.axolotl_store = store
+        super(StoredAxolotlLayer, self).__init__()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = self.axolotl_store
+            if self._store.getLocalRegistrationId() is not None:
+                self.state = self._STATE_HASKEYS
+            else:
+                self.state = self._STATE_INIT
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        self._store = store
+
+
+class AxolotlStateStore(BatchWriter):
+    '''Keeps the axolotl state of each account in a Redis hash, keyed by its
+    MSISDN.
+
+    Changes are collected for up to ``batch_interval`` seconds (or until
+    ``batch_size`` of them are pending) and written with one ``HMSET`` and
+    one ``HDEL`` per account. A field changed several times in that time
+    (such as the session with a busy contact) is only written once. Changes
+    not yet written are lost if the transport stops without flushing.
+    '''
+
+    def __init__(self, redis, batch_size=100, batch_interval=0.05,
+                 metrics=None, clock=reactor):
+        super(AxolotlStateStore, self).__init__(
+            batch_size, batch_interval, clock)
+        self.redis = redis
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # msisdn -> {field: value or None}, waiting for the next flush
+        self._changes = {}
+        self._pending = 0
+
+    def key(self, msisdn):
+        return 'axolotl:%s' % (msisdn,)
+
+    @defer.inlineCallbacks
+    def load(self, msisdn):
+        '''Returns the state kept for ``msisdn``, including changes not yet
+        written.'''
+        state = yield self.redis.hgetall(self.key(msisdn))
+        for field, value in self._changes.get(msisdn, {}).iteritems():
+            if value is None:
+                state.pop(field, None)
+            else:
+                state[field] = value
+        defer.returnValue(state)
+
+    def update(self, msisdn, field, value):
+        '''Sets ``field`` of the state of ``msisdn`` to ``value``, or removes
+        it if ``value`` is None.'''
+        changes = self._changes.setdefault(msisdn, {})
+        if field not in changes:
+            self._pending += 1
+        changes[field] = value
+        self._changed(self._pending)
+
+    def _write_pending(self):
+        changes, self._changes = self._changes, {}
+        pending, self._pending = self._pending, 0
+        if changes:
+            self._write_batch(changes, pending)
+
+    def _write_batch(self, changes, size):
+        start = self.clock.seconds()
+        ds = []
+        for msisdn, fields in changes.iteritems():
+            sets = dict(
+                (field, value) for field, value in fields.iteritems()
+                if value is not None)
+            deletes = [
+                field for field, value in fields.iteritems() if value is None]
+            if sets:
+                ds.append(self.redis.hmset(self.key(msisdn), sets))
+            if deletes:
+                ds.append(self.redis.hdel(self.key(msisdn), *deletes))
+        d = self._track(defer.gatherResults(ds, consumeErrors=True))
+
+        def written(r):
+            self.metrics.incr('axolotl.flushes')
+            self.metrics.record('axolotl.batch_size', size)
+            self.metrics.record(
+                'axolotl.flush_latency', self.clock.seconds() - start)
+            return r
+
+        d.addBoth(written)
+        d.addErrback(log.err, 'Failed to write axolotl state')
@@ -0,0 +1 @@
+"""Benchmarks for the WhatsApp transport's hot paths."""
@@ -0,0 +1,4 @@
+from vxyowsup.bench.cli import main
+
+
+main()
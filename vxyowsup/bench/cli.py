@@ -0,0 +1,39 @@
+"""Runs one of the benchmarks.
+
+Usage: python -m vxyowsup.bench <benchmark> [arguments]
+
+Each benchmark takes the arguments listed in its module's docstring.
+"""
+import sys
+
+from twisted.internet import task
+from twisted.python.reflect import namedAny
+
+
+BENCHMARKS = {
+    'transport': 'vxyowsup.bench.transport',
+    'reactor_queue': 'vxyowsup.bench.reactor_queue',
+    'process_stack': 'vxyowsup.bench.process_stack',
+    'stack_loop': 'vxyowsup.bench.stack_loop',
+    'message_ids': 'vxyowsup.bench.message_ids',
+    'dedupe': 'vxyowsup.bench.dedupe',
+    'replay': 'vxyowsup.bench.replay',
+}
+
+
+def usage():
+    return '%s\nBenchmarks: %s' % (
+        __doc__.strip(), ', '.join(sorted(BENCHMARKS)))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in BENCHMARKS:
+        sys.exit(usage())
+    module = namedAny(BENCHMARKS[argv[0]])
+    task.react(module.main, argv[1:])
+
+
+if __name__ == '__main__':
+    main()
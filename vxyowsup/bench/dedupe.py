@@ -0,0 +1,74 @@
+"""Measures what checking outbound messages for redeliveries
+(``SentMessages``) adds to each send.
+
+``messages`` new message ids are claimed (and acked), with the filters
+sized for ``capacity`` of them, then ``redelivered`` of them are claimed
+again, as a redelivery after a restart would. For each phase this reports
+the claims per second and the time each took, and how many had to be
+checked against Redis. The new ids should nearly all be answered by the
+local filters (the rest are their false positives) and every redelivered one
+should be caught.
+Without ``redis`` (a JSON dict of ``redis_manager`` options), Vumi's fake
+Redis is used.
+
+Usage: python -m vxyowsup.bench.dedupe [messages] [capacity] [redelivered]
+    [redis]
+"""
+import json
+import sys
+import time
+import uuid
+
+from twisted.internet import defer, task
+
+from vumi.persist.txredis_manager import TxRedisManager
+
+from vxyowsup.dedupe import SentMessages
+
+
+@defer.inlineCallbacks
+def run_claims(sent, ids):
+    '''Claims each of ``ids`` in turn, and acks those that are new. Returns
+    how many were new, the claims per second, and the microseconds per
+    claim.'''
+    start = time.time()
+    ds = [sent.claim(message_id) for message_id in ids]
+    results = yield defer.gatherResults(ds)
+    new = [message_id for message_id, (is_new, _) in zip(ids, results)
+           if is_new]
+    for message_id in new:
+        sent.sent(message_id, 'wa-' + message_id)
+    yield sent.flush()
+    elapsed = time.time() - start
+    defer.returnValue((len(new), len(ids) / elapsed, elapsed / len(ids) * 1e6))
+
+
+@defer.inlineCallbacks
+def main(reactor, messages='100000', capacity='1000000', redelivered='1000',
+         redis=None):
+    config = json.loads(redis) if redis else {'FAKE_REDIS': 'yes'}
+    manager = yield TxRedisManager.from_config(dict(
+        config, key_prefix='vxyowsup-bench-%s' % (uuid.uuid4().hex,)))
+    sent = SentMessages(
+        manager, 60 * 60 * 24, capacity=int(capacity), batch_size=1000)
+    ids = [uuid.uuid4().hex for _ in xrange(int(messages))]
+    try:
+        for label, claims in [('new', ids),
+                              ('redelivered', ids[:int(redelivered)])]:
+            before = sent.metrics.get('dedupe.confirmations')
+            new, rate, per_claim = yield run_claims(sent, claims)
+            print ('%-12s claims=%-7d new=%-7d checked_in_redis=%-6d '
+                   'rate=%.0f/sec  %.1fus/claim' % (
+                       label, len(claims), new,
+                       sent.metrics.get('dedupe.confirmations') - before,
+                       rate, per_claim))
+        bloom = sent.filters[sent.generation()]
+        print 'filter: %d bytes, %d hashes, %d ids' % (
+            len(bloom.bits), bloom.hashes, bloom.count)
+    finally:
+        yield manager._purge_all()
+        yield manager._close()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,205 @@
+"""Pieces shared by the benchmarks: stand-ins for the transport, a stand-in
+network layer with timing hooks, and a runner for the real transport on top
+of it.
+"""
+import base64
+import resource
+import time
+
+from twisted.internet import defer, reactor, task
+
+from vumi.transports.tests.helpers import TransportHelper
+
+from yowsup.layers.logger import YowLoggerLayer
+from yowsup.stacks import YowStackBuilder
+
+from vxyowsup.event_log import EventLog
+from vxyowsup.metrics import Metrics
+from vxyowsup.reactor_queue import ReactorQueue
+from vxyowsup.whatsapp import WhatsAppTransport
+from vxyowsup.tests.test_whatsapp import TestingLayer, use_auto_ack_stack
+
+
+CREDENTIALS = ('27000000000', base64.b64encode('xxx'))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def rss():
+    '''The process's resident set size in bytes, or the most it has been if
+    the current size can't be found.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def wait_until(condition, interval=0.01):
+    '''Returns a deferred that fires once ``condition()`` is true.'''
+    d = defer.Deferred()
+
+    def check():
+        if condition():
+            poll.stop()
+            d.callback(None)
+
+    poll = task.LoopingCall(check)
+    poll.start(interval)
+    return d
+
+
+class BenchConfig(object):
+    echo_to = None
+    inbound_receipts = 'on_receive'
+    inbound_receipt_type = 'read'
+    max_inbound_in_flight = 0
+    inbound_receipt_batch_interval = 0
+    inbound_receipt_batch_size = 50
+    media = False
+    log_level = 'error'
+    log_sample_rates = {}
+
+
+class BenchLog(object):
+    def info(self, *args, **kw):
+        pass
+
+    debug = msg = err = error = warning = info
+
+
+class BenchTransport(object):
+    '''Stands in for the transport when a benchmark drives a stack client
+    directly. Subclasses add the transport methods they want to count.'''
+
+    config = BenchConfig()
+    log = BenchLog()
+    event_log = EventLog(log, 'error')
+    transport_type = 'whatsapp'
+
+    def __init__(self, queue_cls=ReactorQueue):
+        self.metrics = Metrics()
+        self.reactor_queue = queue_cls(self, metrics=self.metrics)
+
+
+class BenchLayer(TestingLayer):
+    '''The stand-in network layer. ``on_message`` (if set) is called from the
+    stack thread with the body and node of each outgoing message, which is
+    then acked if ``auto_ack`` is set.'''
+
+    on_message = None
+    auto_ack = True
+
+    def send(self, data):
+        if data.tag != 'message':
+            return
+        if self.on_message is not None:
+            self.on_message(data.getChild('body').getData(), data)
+        if self.auto_ack:
+            self.send_ack(data)
+
+
+@staticmethod
+def getBenchCoreLayers():
+    return (BenchLayer, YowLoggerLayer)
+
+
+def use_bench_stack():
+    '''Makes every stack built afterwards use ``BenchLayer`` and skip
+    encryption.'''
+    use_auto_ack_stack()
+    YowStackBuilder.getCoreLayers = getBenchCoreLayers
+
+
+class Stages(object):
+    '''Collects how long messages take to get through each stage. A message
+    is identified within a stage by any key both ends of it know.'''
+
+    def __init__(self):
+        self.order = []
+        self.started = {}
+        self.latencies = {}
+
+    def start(self, stage, key):
+        if stage not in self.latencies:
+            self.order.append(stage)
+            self.latencies[stage] = []
+        self.started[(stage, key)] = time.time()
+
+    def end(self, stage, key):
+        started = self.started.pop((stage, key), None)
+        if started is not None:
+            self.latencies[stage].append(time.time() - started)
+
+    def count(self, stage):
+        return len(self.latencies.get(stage, ()))
+
+    def wait(self, stage, count):
+        return wait_until(lambda: self.count(stage) >= count)
+
+    def report(self):
+        lines = []
+        for stage in self.order:
+            latencies = self.latencies[stage]
+            if not latencies:
+                continue
+            lines.append('  %-22s p50=%7.2fms p95=%7.2fms p99=%7.2fms' % (
+                stage, percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000))
+        return '\n'.join(lines)
+
+
+class TransportBench(object):
+    '''Runs a real ``WhatsAppTransport`` over ``BenchLayer`` and fake Redis,
+    with the transport's publish methods wired up to ``stages``.'''
+
+    CONFIG = {
+        'phone': CREDENTIALS[0],
+        'password': CREDENTIALS[1],
+    }
+
+    def __init__(self, reactor=reactor, config=None):
+        self.reactor = reactor
+        self.config = dict(self.CONFIG, **(config or {}))
+        self.stages = Stages()
+        self.helper = TransportHelper(WhatsAppTransport)
+        self.transport = None
+        self.layer = None
+
+    @defer.inlineCallbacks
+    def start(self):
+        use_bench_stack()
+        yield self.helper.setup()
+        # How long the transport takes to be ready for messages.
+        self.stages.start('start -> ready', None)
+        self.transport = yield self.helper.get_transport(self.config)
+        self.stages.end('start -> ready', None)
+        self.layer = self.transport.stack_client.network_layer
+
+    def stop(self):
+        return self.helper.cleanup()
+
+    def hook(self, name, callback):
+        '''Calls ``callback`` with the keyword arguments of every call to the
+        transport's ``name`` method, before the method itself.'''
+        original = getattr(self.transport, name)
+
+        def hooked(*args, **kw):
+            callback(**kw)
+            return original(*args, **kw)
+
+        setattr(self.transport, name, hooked)
+
+    def feed(self, nodes, stage, key):
+        '''Feeds protocol tree nodes up the stack from a thread, starting
+        ``stage`` for each one as it goes in.'''
+        def run():
+            for node in nodes:
+                self.stages.start(stage, key(node))
+                self.layer.receive(node)
+        self.reactor.callInThread(run)
@@ -0,0 +1,121 @@
+"""Compares the Redis memory taken by message id mappings kept as a key each
+(``MessageIdStore``) with mappings packed into time bucketed hashes
+(``BucketedMessageIdStore``), and how quickly each writes and looks them
+up.
+
+``mappings`` mappings are written, with WhatsApp ids made over the last
+``spread`` seconds, then all looked up again with the local cache turned
+off. For each layout this reports the number of Redis keys, the bytes of
+keys, fields and values stored per mapping and, with a real Redis, the
+growth in its ``used_memory`` per mapping (which includes Redis's own
+overhead for each key and expiry). Without ``redis`` (a JSON dict of
+``redis_manager`` options), Vumi's fake Redis is used and only the first
+two are reported.
+
+Usage: python -m vxyowsup.bench.message_ids [mappings] [spread]
+    [bucket_size] [redis]
+"""
+import json
+import sys
+import time
+import uuid
+
+from twisted.internet import defer, task
+
+from vumi.persist.txredis_manager import TxRedisManager
+
+from vxyowsup.message_store import BucketedMessageIdStore, MessageIdStore
+
+
+TTL = 60 * 60 * 24
+
+
+@defer.inlineCallbacks
+def used_memory(redis):
+    '''Redis's ``used_memory``, or None for the fake Redis.'''
+    info = getattr(redis._client, 'info', None)
+    if info is None:
+        defer.returnValue(None)
+    stats = yield info()
+    defer.returnValue(int(stats['used_memory']))
+
+
+@defer.inlineCallbacks
+def stored_bytes(redis, bucketed):
+    '''The number of keys under ``redis``'s prefix and the bytes of their
+    names, fields and values.'''
+    keys = yield redis.keys('*')
+    size = 0
+    for key in keys:
+        size += len(key)
+        if bucketed:
+            fields = yield redis.hgetall(key)
+            size += sum(len(f) + len(v) for f, v in fields.iteritems())
+        else:
+            size += len((yield redis.get(key)))
+    defer.returnValue((len(keys), size))
+
+
+@defer.inlineCallbacks
+def run_layout(redis, store, mappings):
+    before = yield used_memory(redis)
+    start = time.time()
+    for whatsapp_id, vumi_id in mappings:
+        store.add(whatsapp_id, vumi_id)
+    yield store.flush()
+    write_rate = len(mappings) / (time.time() - start)
+    after = yield used_memory(redis)
+
+    ids = [whatsapp_id for whatsapp_id, _vumi_id in mappings]
+    start = time.time()
+    found = {}
+    for i in xrange(0, len(ids), 100):
+        found.update((yield store.get_many(ids[i:i + 100])))
+    read_rate = len(ids) / (time.time() - start)
+    assert len(found) == len(ids)
+
+    keys, size = yield stored_bytes(
+        redis, isinstance(store, BucketedMessageIdStore))
+    memory = None
+    if before is not None:
+        memory = float(after - before) / len(mappings)
+    defer.returnValue((keys, float(size) / len(mappings), memory,
+                       write_rate, read_rate))
+
+
+@defer.inlineCallbacks
+def main(reactor, mappings='10000', spread='3600', bucket_size='3600',
+         redis=None):
+    config = json.loads(redis) if redis else {'FAKE_REDIS': 'yes'}
+    now = int(time.time())
+    count = int(mappings)
+    spread = int(spread)
+    mappings = [
+        ('%d-%d' % (now - spread + i * spread // count, i), uuid.uuid4().hex)
+        for i in xrange(count)]
+
+    for label in ('keys', 'buckets'):
+        manager = yield TxRedisManager.from_config(dict(
+            config, key_prefix='vxyowsup-bench-%s' % (uuid.uuid4().hex,)))
+        if label == 'buckets':
+            store = BucketedMessageIdStore(
+                manager, TTL, bucket_size=int(bucket_size), cache_size=0,
+                read_old_keys=False, batch_size=1000)
+        else:
+            store = MessageIdStore(
+                manager, TTL, cache_size=0, batch_size=1000)
+        try:
+            keys, size, memory, write_rate, read_rate = yield run_layout(
+                manager, store, mappings)
+        finally:
+            yield manager._purge_all()
+            yield manager._close()
+        line = '%-8s keys=%-7d stored=%5.1fB/mapping' % (label, keys, size)
+        if memory is not None:
+            line += '  used_memory=%6.1fB/mapping' % (memory,)
+        print '%s  writes=%.0f/sec  lookups=%.0f/sec' % (
+            line, write_rate, read_rate)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
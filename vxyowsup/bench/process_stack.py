@@ -0,0 +1,94 @@
+"""Compares running a stack in a thread of the transport process with running
+it in a child process.
+
+Outbound messages are sent through a stack whose network layer is the test
+suite's ``AutoAckTestingLayer``, and the benchmark waits for all of their acks
+while a timer in the reactor measures how late it fires (reactor latency).
+
+Usage: python -m vxyowsup.bench.process_stack [messages]
+"""
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python.threadpool import ThreadPool
+
+from yowsup.layers.protocol_messages.protocolentities import (
+    TextMessageProtocolEntity)
+
+from vxyowsup.bench.harness import BenchTransport, CREDENTIALS, percentile
+from vxyowsup.process_stack import ProcessStackClient
+from vxyowsup.whatsapp import StackClient
+from vxyowsup.tests.test_whatsapp import use_auto_ack_stack
+
+
+SETUP = 'vxyowsup.tests.test_whatsapp.use_auto_ack_stack'
+TICK = 0.005
+
+
+class CountingTransport(BenchTransport):
+    '''Counts acks.'''
+
+    def __init__(self, expected):
+        super(CountingTransport, self).__init__()
+        self.expected = expected
+        self.received = 0
+        self.done = defer.Deferred()
+
+    def _send_ack(self, whatsapp_id):
+        self.received += 1
+        if self.received == self.expected:
+            self.done.callback(None)
+
+
+@defer.inlineCallbacks
+def run_mode(reactor, mode, count):
+    transport = CountingTransport(count)
+    pool = ThreadPool(minthreads=1, maxthreads=1)
+    pool.start()
+    if mode == 'process':
+        client = ProcessStackClient(CREDENTIALS, transport, setup=SETUP)
+    else:
+        client = StackClient(CREDENTIALS, transport)
+    client_d = client.start(pool)
+    yield client.connect_d
+
+    messages = [
+        TextMessageProtocolEntity('hello %s' % i, to='27123@s.whatsapp.net')
+        for i in xrange(count)]
+    lags = []
+    expected = [time.time() + TICK]
+
+    def tick():
+        now = time.time()
+        lags.append(now - expected[0])
+        expected[0] = now + TICK
+
+    timer = task.LoopingCall(tick)
+    timer.start(TICK, now=False)
+
+    start = time.time()
+    for msg in messages:
+        client.send_to_stack(msg)
+    yield transport.done
+    elapsed = time.time() - start
+
+    timer.stop()
+    client.client_stop()
+    yield client_d.addErrback(lambda f: None)
+    pool.stop()
+    defer.returnValue((count / elapsed, lags))
+
+
+@defer.inlineCallbacks
+def main(reactor, messages='5000'):
+    use_auto_ack_stack()
+    for mode in ['thread', 'process']:
+        rate, lags = yield run_mode(reactor, mode, int(messages))
+        print '%-8s %8.0f msgs/sec  reactor lag p50=%.1fms p99=%.1fms' % (
+            mode, rate, percentile(lags, 50) * 1000,
+            percentile(lags, 99) * 1000)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,117 @@
+"""Compares how quickly inbound events reach the reactor thread when each one
+wakes the reactor separately versus when they're batched by ReactorQueue.
+
+Receipts are fed into a real yowsup stack (on top of the test suite's
+``TestingLayer``) from a separate thread, just as the yowsup loop would.
+
+The stand-in transport spends ``work_us`` microseconds on each delivery
+report, approximating the lookup and publish the real transport does.
+
+Usage: python -m vxyowsup.bench.reactor_queue [events] [work_us]
+"""
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from yowsup.stacks import YowStackBuilder
+from yowsup.layers.logger import YowLoggerLayer
+from yowsup.layers.protocol_receipts.protocolentities import (
+    IncomingReceiptProtocolEntity)
+
+from vxyowsup.bench.harness import BenchTransport
+from vxyowsup.reactor_queue import ReactorQueue
+from vxyowsup.whatsapp import WhatsAppInterface
+from vxyowsup.tests.test_whatsapp import TestingLayer
+
+
+class SilentTestingLayer(TestingLayer):
+    '''Drops outgoing data, so the acks sent for each receipt don't add
+    reactor wakeups of their own.'''
+
+    def send(self, data):
+        pass
+
+
+@staticmethod
+def getBenchCoreLayers():
+    return (SilentTestingLayer, YowLoggerLayer)
+
+
+class DirectReactorQueue(ReactorQueue):
+    '''The unbatched path: every call wakes the reactor separately.'''
+
+    def call(self, name, *args, **kw):
+        self.reactor.callFromThread(getattr(self.target, name), *args, **kw)
+
+
+class CountingTransport(BenchTransport):
+    '''Counts delivery reports.'''
+
+    def __init__(self, queue_cls, expected, work):
+        super(CountingTransport, self).__init__(queue_cls)
+        self.expected = expected
+        self.work = work
+        self.received = 0
+        self.done = defer.Deferred()
+
+    def _send_delivery_report(self, whatsapp_id):
+        until = time.time() + self.work
+        while time.time() < until:
+            pass
+        self.received += 1
+        if self.received == self.expected:
+            self.done.callback(None)
+
+
+def build_stack(transport):
+    original = YowStackBuilder.getCoreLayers
+    YowStackBuilder.getCoreLayers = getBenchCoreLayers
+    try:
+        stack = YowStackBuilder.getDefaultStack(
+            layer=WhatsAppInterface(transport, '+27000000000'), media=False,
+            axolotl=True)
+    finally:
+        YowStackBuilder.getCoreLayers = original
+    stack.setCredentials(('27000000000', 'eHh4'))
+    return stack
+
+
+def make_receipts(count):
+    return [
+        IncomingReceiptProtocolEntity(
+            _id='%s-%s' % (int(time.time()), i), _from='27123@s.whatsapp.net',
+            timestamp=str(int(time.time()))).toProtocolTreeNode()
+        for i in xrange(count)]
+
+
+@defer.inlineCallbacks
+def run_path(reactor, queue_cls, receipts, work):
+    transport = CountingTransport(queue_cls, len(receipts), work)
+    layer = build_stack(transport).getLayer(0)
+
+    def feed():
+        for node in receipts:
+            layer.receive(node)
+
+    start = time.time()
+    reactor.callInThread(feed)
+    yield transport.done
+    elapsed = time.time() - start
+    defer.returnValue((len(receipts) / elapsed, transport.reactor_queue))
+
+
+@defer.inlineCallbacks
+def main(reactor, events='20000', work_us='50'):
+    receipts = make_receipts(int(events))
+    work = int(work_us) / 1000000.0
+    for label, queue_cls in [
+            ('direct', DirectReactorQueue), ('batched', ReactorQueue)]:
+        rate, queue = yield run_path(reactor, queue_cls, receipts, work)
+        batches = queue.metrics.histogram('reactor_queue.batch_size')
+        print '%-8s %10.0f events/sec  wakeups=%s' % (
+            label, rate, batches.count or len(receipts))
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
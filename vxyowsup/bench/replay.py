@@ -0,0 +1,312 @@
+"""Replays a capture of an account's traffic (recorded by setting the
+transport's ``capture_dir``) through the real transport, over the stand-in
+network layer and fake Redis, and reports how long the transport spent on
+each kind of callback.
+
+The nodes the account received (messages, acks, receipts and the rest) are
+fed up the stack and lost connections are repeated, at their captured times
+divided by ``speed`` (0 feeds them as fast as they are taken). Each text
+message the account sent is dispatched to the transport as an outbound
+message at the time it was sent, and the acks and receipts for it are fed
+with the id the replay sent it with. The nodes the transport sends are
+counted by tag against those in the capture.
+
+Each call from the stack to the transport, and each node the stack handles,
+is timed. ``profile`` is one of:
+
+``none``: only those timings.
+``cprofile``: those, and the reactor thread under cProfile (by cumulative
+time).
+``sample``: those, and the functions most often found running in samples
+of every thread's stack (including those of waiting threads) taken every
+millisecond.
+
+The report is written to the file ``report``, or printed.
+
+Usage: python -m vxyowsup.bench.replay <capture> [speed] [profile] [report]
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import deque
+from StringIO import StringIO
+
+from twisted.internet import defer, task
+
+from yowsup.layers.network import YowNetworkLayer
+
+from vxyowsup.bench.harness import BenchLayer, TransportBench, wait_until
+from vxyowsup.capture import EVENT, INBOUND, OUTBOUND, read_capture
+
+
+PROFILES = ('none', 'cprofile', 'sample')
+
+
+class CallbackTimings(object):
+    '''Collects how long each kind of callback took, from any thread.'''
+
+    def __init__(self):
+        # name -> [calls, total seconds, most seconds]
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, elapsed, elapsed]
+                return
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+    def report(self):
+        lines = ['  %-28s %7s %10s %9s %9s' % (
+            'callback', 'calls', 'total ms', 'mean us', 'max ms')]
+        for name, (calls, total, most) in sorted(
+                self.timings.iteritems(), key=lambda item: -item[1][1]):
+            lines.append('  %-28s %7d %10.2f %9.1f %9.2f' % (
+                name, calls, total * 1000, total / calls * 1e6, most * 1000))
+        return '\n'.join(lines)
+
+
+def function_name(code):
+    path = '/'.join(code.co_filename.split(os.sep)[-2:])
+    return '%s:%d(%s)' % (path, code.co_firstlineno, code.co_name)
+
+
+class Sampler(object):
+    '''Samples the stacks of every other thread every ``interval`` seconds,
+    from a thread of its own, counting how often each function is the one
+    running (self) and anywhere in a stack (cumulative).'''
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.samples = 0
+        self.own = {}
+        self.cumulative = {}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name='sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def run(self):
+        me = threading.current_thread().ident
+        while self._running:
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(frame)
+            time.sleep(self.interval)
+
+    def sample(self, frame):
+        self.samples += 1
+        name = function_name(frame.f_code)
+        self.own[name] = self.own.get(name, 0) + 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                name = function_name(code)
+                self.cumulative[name] = self.cumulative.get(name, 0) + 1
+            frame = frame.f_back
+
+    def report(self, limit=20):
+        lines = ['  %d samples' % (self.samples,)]
+        for label, counts in [('self', self.own),
+                              ('cumulative', self.cumulative)]:
+            lines.append('  %s:' % (label,))
+            for name, count in sorted(
+                    counts.iteritems(), key=lambda item: -item[1])[:limit]:
+                lines.append('    %5.1f%%  %s' % (
+                    100.0 * count / max(self.samples, 1), name))
+        return '\n'.join(lines)
+
+
+def message_key(node):
+    '''What a captured text message and the replay's sending of it have in
+    common.'''
+    body = node.getChild('body')
+    if node.tag != 'message' or body is None:
+        return None
+    return (node['to'], body.getData())
+
+
+class Replay(object):
+    '''Feeds the records of a capture to ``bench`` from a thread, keeping
+    the ids of captured messages and of the replay's sending of them.'''
+
+    # Longest time (in seconds) an ack or receipt waits for the replay to
+    # send the message it is for.
+    SEND_TIMEOUT = 5
+
+    def __init__(self, bench, records, speed=1):
+        self.bench = bench
+        self.records = records
+        self.speed = speed
+        self.captured_sent = {}
+        self.sent = {}
+        self.dispatched = 0
+        self.fed = 0
+        # (to, body) -> captured ids of the messages not sent yet
+        self.pending = {}
+        # captured message id -> id of the replay's sending of it
+        self.ids = {}
+        self.done = False
+        for _, direction, node in records:
+            if direction != OUTBOUND:
+                continue
+            self.captured_sent[node.tag] = (
+                self.captured_sent.get(node.tag, 0) + 1)
+            key = message_key(node)
+            if key is not None:
+                self.pending.setdefault(key, deque()).append(node['id'])
+        self.outbound_ids = set(
+            captured_id for ids in self.pending.itervalues()
+            for captured_id in ids)
+
+        layer = bench.layer
+        layer.auto_ack = False
+        layer.on_message = self.on_message
+        layer.send = self.on_send
+
+    def on_send(self, node):
+        self.sent[node.tag] = self.sent.get(node.tag, 0) + 1
+        BenchLayer.send(self.bench.layer, node)
+
+    def on_message(self, content, node):
+        ids = self.pending.get((node['to'], content))
+        if ids:
+            self.ids[ids.popleft()] = node['id']
+
+    def run(self):
+        start = time.time()
+        first = self.records[0][0] if self.records else 0
+        for timestamp, direction, node in self.records:
+            if self.speed:
+                delay = (timestamp - first) / self.speed - (
+                    time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if direction == INBOUND:
+                self.receive(node)
+            elif direction == OUTBOUND:
+                if message_key(node) is not None:
+                    self.dispatched += 1
+                    self.bench.reactor.callFromThread(self.dispatch, node)
+            elif direction == EVENT and node['name'] == (
+                    YowNetworkLayer.EVENT_STATE_DISCONNECTED):
+                self.bench.layer.disconnect()
+        self.done = True
+
+    def receive(self, node):
+        if node.tag in ('ack', 'receipt'):
+            self.replace_id(node)
+            items = node.getChild('list')
+            for item in (items.getAllChildren() if items else ()):
+                self.replace_id(item)
+        self.fed += 1
+        self.bench.layer.receive(node)
+
+    def replace_id(self, node):
+        captured_id = node['id']
+        if captured_id not in self.outbound_ids:
+            return
+        deadline = time.time() + self.SEND_TIMEOUT
+        while captured_id not in self.ids and time.time() < deadline:
+            time.sleep(0.001)
+        node['id'] = self.ids.get(captured_id, captured_id)
+
+    def dispatch(self, node):
+        helper = self.bench.helper
+        return helper.dispatch_outbound(helper.make_outbound(
+            node.getChild('body').getData().decode('utf-8'),
+            to_addr='+' + node['to'].split('@')[0], from_addr='vumi'))
+
+    def settled(self):
+        transport = self.bench.transport
+        window = transport.stack_client.whatsapp_interface.inbound_window
+        return (self.done and not len(window) and
+                not len(transport.reactor_queue) and
+                self.sent.get('message', 0) >= self.dispatched)
+
+    def report(self):
+        return '  sent (replayed/captured): %s' % (' '.join(
+            '%s %d/%d' % (tag, self.sent.get(tag, 0),
+                          self.captured_sent.get(tag, 0))
+            for tag in sorted(set(self.sent) | set(self.captured_sent))),)
+
+
+@defer.inlineCallbacks
+def replay(reactor, path, speed=1, profile='none'):
+    '''Replays the capture at ``path``. Returns the report.'''
+    if profile not in PROFILES:
+        raise ValueError('Unknown profile: %r' % (profile,))
+    records = list(read_capture(path))
+    bench = TransportBench(reactor)
+    yield bench.start()
+    try:
+        timings = CallbackTimings()
+        bench.transport.reactor_queue.timer = timings.record
+        bench.transport.stack_client.whatsapp_interface.timer = (
+            timings.record)
+        run = Replay(bench, records, speed)
+
+        profiler = sampler = None
+        if profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif profile == 'sample':
+            sampler = Sampler()
+            sampler.start()
+        start = time.time()
+        reactor.callInThread(run.run)
+        yield wait_until(run.settled)
+        elapsed = time.time() - start
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+    finally:
+        yield bench.stop()
+
+    captured = records[-1][0] - records[0][0] if records else 0
+    lines = [
+        '%s: %d records (%d fed) in %.2fs, captured over %.2fs' % (
+            path, len(records), run.fed, elapsed, captured),
+        run.report(),
+        'callbacks:',
+        timings.report()]
+    if profiler is not None:
+        stream = StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(
+            'cumulative').print_stats(30)
+        lines.extend(['reactor thread (cProfile):', stream.getvalue()])
+    if sampler is not None:
+        lines.extend(['samples:', sampler.report()])
+    defer.returnValue('\n'.join(lines))
+
+
+@defer.inlineCallbacks
+def main(reactor, capture, speed='1', profile='none', report=None):
+    text = yield replay(reactor, capture, float(speed), profile)
+    if report is None:
+        print text
+    else:
+        with open(report, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,119 @@
+"""Measures how long an outbound message waits between being handed to a
+stack client and reaching the network layer, for the old polling loop and
+the current wakeable one.
+
+The stack's network layer is the test suite's ``TestingLayer`` with an idle
+socket alongside it in the loop's socket map, as a connected client would
+have. Messages are sent one at a time, ``interval`` seconds apart.
+
+Usage: python -m vxyowsup.bench.stack_loop [messages] [interval]
+"""
+import asyncore
+import socket
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python.threadpool import ThreadPool
+
+from yowsup.layers.logger import YowLoggerLayer
+from yowsup.layers.protocol_messages.protocolentities import (
+    TextMessageProtocolEntity)
+from yowsup.stacks import YowStackBuilder
+
+from vxyowsup.bench.harness import BenchTransport, CREDENTIALS, percentile
+from vxyowsup.whatsapp import StackClient
+from vxyowsup.tests.test_whatsapp import TestingLayer, use_auto_ack_stack
+
+
+class TimingLayer(TestingLayer):
+    ''' Records when each message reaches the network layer. '''
+
+    arrivals = {}
+
+    def send(self, data):
+        if data.tag == 'message':
+            self.arrivals[data['id']] = time.time()
+
+
+@staticmethod
+def getTimingCoreLayers():
+    return (TimingLayer, YowLoggerLayer)
+
+
+class IdleConnection(asyncore.dispatcher):
+    ''' A connected socket that never has anything to read. '''
+
+    def writable(self):
+        return False
+
+
+class PollingStackClient(StackClient):
+    '''The old loop: poll for up to a second, then run one detached call.'''
+
+    def exec_detached(self, call):
+        self.detached_calls.append(call)
+
+    def loop(self):
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout=1, count=1, map=self.socket_map)
+            try:
+                call = self.detached_calls.popleft()
+            except IndexError:
+                continue
+            call()
+        self.waker.close()
+
+
+class IgnoringTransport(BenchTransport):
+    def __getattr__(self, name):
+        # Ignore whatever the interface reports back.
+        return lambda *args, **kw: None
+
+
+@defer.inlineCallbacks
+def run_client(reactor, client_cls, count, interval):
+    pool = ThreadPool(minthreads=1, maxthreads=1)
+    pool.start()
+    client = client_cls(CREDENTIALS, IgnoringTransport())
+    ours, theirs = socket.socketpair()
+    IdleConnection(ours, map=client.socket_map)
+    client_d = client.start(pool)
+    yield client.connect_d
+
+    sent = {}
+    for i in xrange(count):
+        msg = TextMessageProtocolEntity(
+            'hello %s' % i, to='27123@s.whatsapp.net')
+        sent[msg.getId()] = time.time()
+        client.send_to_stack(msg)
+        yield task.deferLater(reactor, interval, lambda: None)
+    while len(TimingLayer.arrivals) < count:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+
+    client.client_stop()
+    yield client_d
+    pool.stop()
+    theirs.close()
+    latencies = [
+        TimingLayer.arrivals.pop(msg_id) - sent_at
+        for msg_id, sent_at in sent.iteritems()]
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def main(reactor, messages='20', interval='0.25'):
+    use_auto_ack_stack()
+    YowStackBuilder.getCoreLayers = getTimingCoreLayers
+    for label, client_cls in [
+            ('polling', PollingStackClient), ('wakeable', StackClient)]:
+        latencies = yield run_client(
+            reactor, client_cls, int(messages), float(interval))
+        print '%-9s enqueue -> network p50=%.2fms p99=%.2fms' % (
+            label, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,168 @@
+"""Floods the real transport with messages through the stand-in network
+layer and fake Redis, and reports throughput, per-stage latency and memory
+growth.
+
+Scenarios:
+
+``outbound``: outbound messages dispatched to the transport, each acked by
+the network layer as it is sent.
+``bulk``: the same, but with each outbound message sent to up to 1000
+recipients at once (messages are counted per recipient).
+``inbound``: messages received from the network and published.
+``receipts``: acks and delivery receipts for messages already sent.
+
+Usage: python -m vxyowsup.bench.transport [scenarios] [messages]
+
+where scenarios is a comma separated list (by default, all of them).
+"""
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from yowsup.layers.protocol_messages.protocolentities import (
+    TextMessageProtocolEntity)
+
+from vxyowsup.bench.harness import TransportBench, rss, wait_until
+
+
+def recipient(i):
+    return '+2780%07d' % (i % 1000,)
+
+
+def send_outbound(bench, count, ids, stage=None):
+    '''Dispatches ``count`` outbound messages, filling in ``ids`` (their
+    contents to their message ids) first and starting ``stage`` for each
+    one, if given.'''
+    messages = [
+        bench.helper.make_outbound(
+            'bench %s' % i, to_addr=recipient(i), from_addr='vumi')
+        for i in xrange(count)]
+    ids.update((msg['content'], msg['message_id']) for msg in messages)
+    ds = []
+    for msg in messages:
+        if stage is not None:
+            bench.stages.start(stage, msg['content'])
+        ds.append(bench.helper.dispatch_outbound(msg))
+    return defer.gatherResults(ds)
+
+
+@defer.inlineCallbacks
+def outbound(bench, count):
+    stages = bench.stages
+    ids = {}
+
+    def on_message(content, node):
+        stages.end('outbound -> network', content)
+        stages.start('network -> ack', ids[content])
+
+    bench.layer.on_message = on_message
+    bench.hook('publish_ack', lambda user_message_id, **kw: stages.end(
+        'network -> ack', user_message_id))
+    yield send_outbound(bench, count, ids, 'outbound -> network')
+    yield stages.wait('network -> ack', count)
+
+
+@defer.inlineCallbacks
+def bulk(bench, count, per_message=1000):
+    stages = bench.stages
+    recipients = [recipient(i) for i in xrange(count)]
+    messages = [
+        bench.helper.make_outbound(
+            'bulk %s' % i, to_addr=recipients[i], from_addr='vumi',
+            helper_metadata={'whatsapp': {
+                'recipients': recipients[i:i + per_message]}})
+        for i in xrange(0, count, per_message)]
+    bench.layer.on_message = lambda content, node: stages.start(
+        'network -> ack', node['id'])
+    bench.hook('publish_ack', lambda sent_message_id, **kw: stages.end(
+        'network -> ack', sent_message_id))
+    yield defer.gatherResults(
+        [bench.helper.dispatch_outbound(msg) for msg in messages])
+    yield stages.wait('network -> ack', count)
+
+
+@defer.inlineCallbacks
+def inbound(bench, count):
+    stages = bench.stages
+    nodes = [
+        TextMessageProtocolEntity(
+            'bench %s' % i, _from=recipient(i)[1:] + '@s.whatsapp.net'
+        ).toProtocolTreeNode()
+        for i in xrange(count)]
+    bench.hook('publish_message', lambda content, **kw: stages.end(
+        'network -> publish', content))
+    bench.feed(
+        nodes, 'network -> publish',
+        lambda node: node.getChild('body').getData())
+    yield stages.wait('network -> publish', count)
+
+
+@defer.inlineCallbacks
+def receipts(bench, count):
+    stages = bench.stages
+    nodes = []
+    bench.layer.auto_ack = False
+    bench.layer.on_message = lambda content, node: nodes.append(node)
+    ids = {}
+    yield send_outbound(bench, count, ids)
+    yield wait_until(lambda: len(nodes) >= count)
+    whatsapp_ids = dict(
+        (ids[node.getChild('body').getData()], node['id']) for node in nodes)
+
+    bench.hook('publish_ack', lambda sent_message_id, **kw: stages.end(
+        'ack -> publish', sent_message_id))
+    bench.hook('publish_delivery_report', lambda user_message_id, **kw: (
+        stages.end('receipt -> publish', whatsapp_ids[user_message_id])))
+
+    def storm():
+        for node in nodes:
+            stages.start('ack -> publish', node['id'])
+            bench.layer.send_ack(node)
+            stages.start('receipt -> publish', node['id'])
+            bench.layer.send_receipt(node)
+
+    start = time.time()
+    bench.reactor.callInThread(storm)
+    yield stages.wait('receipt -> publish', count)
+    defer.returnValue(start)
+
+
+SCENARIOS = {
+    'outbound': outbound,
+    'bulk': bulk,
+    'inbound': inbound,
+    'receipts': receipts,
+}
+
+
+@defer.inlineCallbacks
+def run_scenario(reactor, name, count, config=None):
+    '''Runs one scenario against a fresh transport. Returns the number of
+    messages per second, the growth in memory in bytes and the stages.'''
+    bench = TransportBench(reactor, config)
+    yield bench.start()
+    try:
+        rss_before = rss()
+        start = time.time()
+        # A scenario may return a later start time, to leave out setup.
+        start = (yield SCENARIOS[name](bench, count)) or start
+        elapsed = time.time() - start
+        growth = rss() - rss_before
+    finally:
+        yield bench.stop()
+    defer.returnValue((count / elapsed, growth, bench.stages))
+
+
+@defer.inlineCallbacks
+def main(reactor, scenarios=','.join(sorted(SCENARIOS)), messages='5000'):
+    for name in scenarios.split(','):
+        rate, growth, stages = yield run_scenario(
+            reactor, name, int(messages))
+        print '%-9s %8.0f msgs/sec  rss %+.1fMB' % (
+            name, rate, growth / 1024.0 / 1024.0)
+        print stages.report()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,102 @@
+# -*- test-case-name: vxyowsup.tests.test_capture -*-
+import os
+import struct
+import threading
+import time
+
+from yowsup.layers.coder.decoder import ReadDecoder
+from yowsup.layers.coder.encoder import WriteEncoder
+from yowsup.layers.coder.tokendictionary import TokenDictionary
+from yowsup.structs import ProtocolTreeNode
+
+
+MAGIC = 'VXCAP1\n'
+# time received or sent, direction, length of the encoded node
+RECORD = struct.Struct('>dcI')
+
+INBOUND = 'i'
+OUTBOUND = 'o'
+EVENT = 'e'
+
+
+def event_node(name, reason=None):
+    '''A stand-in node for a connection event, so that events can be kept in
+    a capture with the nodes around them.'''
+    attributes = {'name': name}
+    if reason is not None:
+        attributes['reason'] = reason
+    return ProtocolTreeNode('event', attributes)
+
+
+def without_none(node):
+    '''``node`` without attributes set to None, which the encoder can't
+    write. Nodes rebuilt from entities the server sent can have them.'''
+    attributes = node.attributes or {}
+    children = node.getAllChildren()
+    cleaned = [without_none(child) for child in children]
+    if (None not in attributes.itervalues() and
+            all(a is b for a, b in zip(cleaned, children))):
+        return node
+    return ProtocolTreeNode(
+        node.tag,
+        dict((k, v) for k, v in attributes.iteritems() if v is not None),
+        cleaned, node.data)
+
+
+class CaptureWriter(object):
+    '''Writes the protocol tree nodes an account receives and sends (and its
+    connection events) to the file at ``path``, each with the time it was
+    written.
+
+    Nodes are kept in the binary form yowsup sends them to the server in,
+    which is a fraction of the size of their text form. Records may be
+    written from any thread. Only the user the transport runs as may read
+    the file, since it holds the account's messages.
+    '''
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.encoder = WriteEncoder(TokenDictionary())
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = os.fdopen(os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, direction, node):
+        data = str(bytearray(self.encoder.protocolTreeNodeToBytes(
+            without_none(node))))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD.pack(self.clock(), direction, len(data)))
+            self._file.write(data)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    '''Yields ``(time, direction, node)`` for each record in the capture at
+    ``path``. A record cut short (by the transport stopping mid-write) ends
+    the capture.'''
+    decoder = ReadDecoder(TokenDictionary())
+    decoder.streamStarted = True
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a capture: %s' % (path,))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, size = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield timestamp, direction, decoder.getProtocolTreeNode(
+                bytearray(data))
@@ -0,0 +1,158 @@
+# -*- test-case-name: vxyowsup.tests.test_contacts -*-
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter, LRUCache
+
+
+# What a check gives a waiting MSISDN when its sync fails.
+UNKNOWN = object()
+
+
+class ContactStore(object):
+    '''Remembers which MSISDNs are WhatsApp users (and their JIDs) and which
+    are not, for ``ttl`` seconds after each was last checked.
+
+    Each MSISDN is a Redis key of its own, holding the time it was checked
+    and its JID (empty for a number that isn't a WhatsApp user). Recent
+    lookups are also kept in a local ``LRUCache`` of up to ``cache_size``
+    entries.
+    '''
+
+    def __init__(self, redis, ttl, cache_size=10000, metrics=None,
+                 clock=reactor):
+        self.redis = redis
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+        self.cache = LRUCache(
+            cache_size, ttl, metrics=self.metrics, clock=clock,
+            name='contacts.cache')
+
+    def key(self, msisdn):
+        return 'contact:%s' % (msisdn,)
+
+    @defer.inlineCallbacks
+    def get_many(self, msisdns):
+        '''Returns ``{msisdn: (jid, checked_at)}`` for each of ``msisdns``
+        that is known, with a JID of None for those that aren't WhatsApp
+        users.'''
+        found = {}
+        missing = []
+        for msisdn in set(msisdns):
+            contact = self.cache.get(msisdn)
+            if contact is not None:
+                found[msisdn] = contact
+            else:
+                missing.append(msisdn)
+        values = yield defer.gatherResults([
+            self.redis.get(self.key(msisdn)) for msisdn in missing])
+        for msisdn, value in zip(missing, values):
+            if value is None:
+                continue
+            checked_at, _sep, jid = value.partition(' ')
+            contact = found[msisdn] = (jid or None, float(checked_at))
+            self.cache.set(msisdn, contact)
+        defer.returnValue(found)
+
+    def set_many(self, contacts):
+        '''Remembers ``{msisdn: jid}``, with a JID of None for numbers that
+        aren't WhatsApp users.'''
+        now = self.clock.seconds()
+        ds = []
+        for msisdn, jid in contacts.iteritems():
+            self.cache.set(msisdn, (jid, now))
+            ds.append(self.redis.setex(
+                self.key(msisdn), self.ttl, '%d %s' % (now, jid or '')))
+        return defer.gatherResults(ds).addCallback(lambda _: None)
+
+
+class ContactSync(BatchWriter):
+    '''Checks whether MSISDNs are WhatsApp users.
+
+    MSISDNs not in the ``ContactStore`` are collected for up to
+    ``batch_interval`` seconds (or until ``batch_size`` of them are pending)
+    and passed to ``sync`` together. ``sync`` asks the server about them and
+    returns a deferred that fires with ``{msisdn: jid}``, with a JID of None
+    for numbers that aren't users. An MSISDN already waiting for a sync is
+    not asked about again.
+    '''
+
+    def __init__(self, store, sync, batch_size=50, batch_interval=0.05,
+                 metrics=None, clock=reactor):
+        super(ContactSync, self).__init__(batch_size, batch_interval, clock)
+        self.store = store
+        self.sync = sync
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # msisdn -> deferreds waiting for it to be synced
+        self._waiting = {}
+        # MSISDNs waiting for the next flush
+        self._pending = []
+
+    def check(self, msisdns):
+        '''Returns a deferred that fires with ``{msisdn: jid}`` for each of
+        ``msisdns`` that could be checked, with a JID of None for those that
+        aren't WhatsApp users.'''
+        d = self.store.get_many(msisdns)
+        return d.addCallback(self._check_unknown, msisdns)
+
+    def _check_unknown(self, known, msisdns):
+        found = dict((msisdn, jid) for msisdn, (jid, _) in known.iteritems())
+        unknown = list(set(msisdns) - set(found))
+        if not unknown:
+            return found
+        ds = [self._wait_for(msisdn) for msisdn in unknown]
+
+        def synced(results):
+            found.update(
+                (msisdn, jid) for msisdn, jid in zip(unknown, results)
+                if jid is not UNKNOWN)
+            return found
+
+        return defer.gatherResults(ds).addCallback(synced)
+
+    def _wait_for(self, msisdn):
+        d = defer.Deferred()
+        waiting = self._waiting.get(msisdn)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+        self._waiting[msisdn] = [d]
+        self._pending.append(msisdn)
+        self._changed(len(self._pending))
+        return d
+
+    def _write_pending(self):
+        pending, self._pending = self._pending, []
+        for i in xrange(0, len(pending), self.batch_size):
+            self._sync_batch(pending[i:i + self.batch_size])
+
+    def _sync_batch(self, msisdns):
+        start = self.clock.seconds()
+        self.metrics.incr('contacts.syncs')
+        self.metrics.record('contacts.sync_size', len(msisdns))
+        d = self._track(self.sync(msisdns))
+
+        def synced(contacts):
+            self.metrics.record(
+                'contacts.sync_latency', self.clock.seconds() - start)
+            self.metrics.incr('contacts.non_users', sum(
+                1 for jid in contacts.itervalues() if jid is None))
+            self._done(msisdns, contacts)
+            return self.store.set_many(contacts)
+
+        def failed(f):
+            self.metrics.incr('contacts.sync_failures')
+            log.err(f, 'Failed to sync contacts')
+            self._done(msisdns, {})
+
+        d.addCallbacks(synced, failed)
+        d.addErrback(log.err, 'Failed to store contacts')
+
+    def _done(self, msisdns, contacts):
+        for msisdn in msisdns:
+            for d in self._waiting.pop(msisdn, ()):
+                d.callback(contacts.get(msisdn, UNKNOWN))
@@ -0,0 +1,193 @@
+# -*- test-case-name: vxyowsup.tests.test_dedupe -*-
+import hashlib
+import math
+import struct
+
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter
+
+
+class BloomFilter(object):
+    '''A set of strings that can say for sure that a string was never added,
+    but wrongly says one was for about ``error_rate`` of them once
+    ``capacity`` have been.'''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        # Two hashes from one digest, combined to give as many as needed.
+        a, b = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(a + i * b) % self.size for i in xrange(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for i in self._indexes(key):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for i in self._indexes(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+
+class SentMessages(BatchWriter):
+    '''Remembers which outbound messages have been sent, by Vumi message id,
+    with the WhatsApp id of their first ack, for at least ``horizon``
+    seconds, so that a message delivered to the transport again isn't sent
+    again.
+
+    A message is claimed before it is sent, and only remembered once
+    ``sent`` is called for its ack. If sending it fails it is forgotten
+    instead, so that it is sent if it is delivered again.
+
+    Ids are kept in a Redis hash for each ``horizon`` seconds (which expires
+    after two of them), written in batches every ``batch_interval`` seconds
+    or once ``batch_size`` ids are pending. Each hash is mirrored by a local
+    ``BloomFilter``, loaded from Redis at startup, so most ids are known to
+    be new without asking Redis. Only the few the filters might have seen
+    are looked up in Redis.
+    '''
+
+    def __init__(self, redis, horizon, capacity=1000000, error_rate=0.001,
+                 batch_size=100, batch_interval=0.05, metrics=None,
+                 clock=reactor):
+        super(SentMessages, self).__init__(batch_size, batch_interval, clock)
+        self.redis = redis
+        self.horizon = horizon
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # generation -> BloomFilter, for this generation and the last
+        self.filters = {}
+        # message id -> generation, of those claimed and not yet acked
+        self._sending = {}
+        # message id -> (generation, WhatsApp id), waiting for the next flush
+        self._pending = {}
+
+    def generation(self):
+        return int(self.clock.seconds() // self.horizon)
+
+    def key(self, generation):
+        return 'sent:%d' % (generation,)
+
+    def _filters(self):
+        '''The filters for this generation and the last, making a new one
+        and forgetting older ones (and claims never acked or failed) when
+        the generation changes.'''
+        current = self.generation()
+        if current not in self.filters:
+            self.filters = dict(
+                (generation, bloom)
+                for generation, bloom in self.filters.iteritems()
+                if generation == current - 1)
+            self.filters[current] = BloomFilter(
+                self.capacity, self.error_rate)
+            self._sending = dict(
+                (message_id, generation)
+                for message_id, generation in self._sending.iteritems()
+                if generation >= current - 1)
+        return current, self.filters
+
+    @defer.inlineCallbacks
+    def load(self):
+        '''Fills the filters with the ids sent in this generation and the
+        last.'''
+        current, filters = self._filters()
+        for generation in (current - 1, current):
+            ids = yield self.redis.hgetall(self.key(generation))
+            if not ids:
+                continue
+            bloom = filters.setdefault(
+                generation, BloomFilter(self.capacity, self.error_rate))
+            for message_id in ids:
+                bloom.add(message_id)
+            self.metrics.incr('dedupe.loaded', len(ids))
+
+    def claim(self, message_id):
+        '''Returns a deferred that fires with ``(True, None)`` if
+        ``message_id`` hasn't been sent before (and notes that it is being
+        sent now), or ``(False, whatsapp_id)`` if it has, with the WhatsApp
+        id of its ack, or None if it is still being sent.'''
+        current, filters = self._filters()
+        if message_id in self._sending:
+            return self._duplicate(None)
+        if message_id in self._pending:
+            # Not in Redis yet, but certainly sent.
+            return self._duplicate(self._pending[message_id][1])
+        if not any(message_id in bloom for bloom in filters.itervalues()):
+            self.metrics.incr('dedupe.new')
+            self._sending[message_id] = current
+            return defer.succeed((True, None))
+
+        self.metrics.incr('dedupe.confirmations')
+        d = defer.gatherResults([
+            self.redis.hget(self.key(current - 1), message_id),
+            self.redis.hget(self.key(current), message_id)])
+
+        def confirmed(whatsapp_ids):
+            whatsapp_id = whatsapp_ids[1] or whatsapp_ids[0]
+            if whatsapp_id is not None:
+                return self._duplicate(whatsapp_id)
+            if message_id in self._sending:
+                # Claimed again while we were asking.
+                return self._duplicate(None)
+            self.metrics.incr('dedupe.false_positives')
+            self._sending[message_id] = current
+            return (True, None)
+
+        return d.addCallback(confirmed)
+
+    def _duplicate(self, whatsapp_id):
+        self.metrics.incr('dedupe.duplicates')
+        return defer.succeed((False, whatsapp_id))
+
+    def sent(self, message_id, whatsapp_id):
+        '''Remembers that ``message_id`` was sent, and acked as
+        ``whatsapp_id``. Later acks for other recipients of the same message
+        are ignored.'''
+        current, filters = self._filters()
+        claimed = self._sending.pop(message_id, None) is not None
+        if not claimed and (message_id in self._pending or any(
+                message_id in bloom for bloom in filters.itervalues())):
+            return
+        filters[current].add(message_id)
+        self._add(message_id, current, whatsapp_id)
+
+    def forget(self, message_id):
+        '''Forgets the claim on ``message_id``, since sending it failed.'''
+        self._sending.pop(message_id, None)
+
+    def _add(self, message_id, generation, whatsapp_id):
+        self._pending[message_id] = (generation, whatsapp_id)
+        self._changed(len(self._pending))
+
+    def _write_pending(self):
+        batch, self._pending = self._pending, {}
+        by_generation = {}
+        for message_id, (generation, whatsapp_id) in batch.iteritems():
+            by_generation.setdefault(generation, {})[message_id] = (
+                whatsapp_id)
+        for generation, ids in by_generation.iteritems():
+            self._write_batch(self.key(generation), ids)
+
+    def _write_batch(self, key, ids):
+        self.metrics.incr('dedupe.flushes')
+        self.metrics.record('dedupe.batch_size', len(ids))
+        d = self._track(defer.gatherResults([
+            self.redis.hmset(key, ids),
+            self.redis.expire(key, 2 * self.horizon)], consumeErrors=True))
+        d.addErrback(log.err, 'Failed to write sent message ids')
@@ -0,0 +1,83 @@
+# -*- test-case-name: vxyowsup.tests.test_event_log -*-
+import itertools
+import logging
+
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+
+class EventLogError(Exception):
+    """ Raised for an unknown log level. """
+
+
+def render_entity(entity):
+    ''' A protocol entity's tree on a single line. '''
+    return ' '.join(str(entity).split('\n'))
+
+
+class EventLog(object):
+    '''Logs events as a name followed by ``key=value`` fields, for example
+    ``ack.received class=message id=1453219584-12``.
+
+    Events below ``level`` are dropped before anything is formatted, and a
+    field whose value is callable is only called if its event is logged, so
+    expensive values cost nothing when nobody will see them.
+    ``sample_rates`` maps event names to ``n``, to log only one in every
+    ``n`` of those events.
+    '''
+
+    def __init__(self, log, level='info', sample_rates=None):
+        if level not in LEVELS:
+            raise EventLogError('Unknown log level: %r' % (level,))
+        self.log = log
+        self.level = LEVELS[level]
+        self.sample_rates = dict(sample_rates or {})
+        self._counters = {}
+
+    def enabled(self, level):
+        return LEVELS[level] >= self.level
+
+    def event(self, level, name, **fields):
+        if LEVELS[level] >= self.level:
+            self._log(level, name, fields)
+
+    def _log(self, level, name, fields):
+        rate = self.sample_rates.get(name)
+        if rate > 1:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters.setdefault(name, itertools.count())
+            # next() on a count is atomic, so stack threads can share it.
+            if next(counter) % rate:
+                return
+        getattr(self.log, level)(self.render(name, fields))
+
+    def render(self, name, fields):
+        parts = [name]
+        for key in sorted(fields):
+            value = fields[key]
+            if callable(value):
+                value = value()
+            parts.append('%s=%s' % (key, value))
+        return ' '.join(parts)
+
+    def debug(self, name, **fields):
+        if self.level <= logging.DEBUG:
+            self._log('debug', name, fields)
+
+    def info(self, name, **fields):
+        if self.level <= logging.INFO:
+            self._log('info', name, fields)
+
+    def warning(self, name, **fields):
+        if self.level <= logging.WARNING:
+            self._log('warning', name, fields)
+
+    def error(self, name, **fields):
+        if self.level <= logging.ERROR:
+            self._log('error', name, fields)
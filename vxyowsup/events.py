@@ -0,0 +1,76 @@
+# -*- test-case-name: vxyowsup.tests.test_events -*-
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter
+
+
+class EventBatcher(BatchWriter):
+    '''Collects the acks and delivery receipts the server sends for outbound
+    messages and resolves them to Vumi ids in batches.
+
+    Events are collected for up to ``batch_interval`` seconds (or until
+    ``batch_size`` of them are pending). The WhatsApp ids of a batch are
+    looked up together with ``MessageIdStore.get_many`` and the events are
+    then passed on in the order they arrived: acks to ``on_ack`` and
+    receipts to ``on_receipt``, each called with the WhatsApp id and the
+    Vumi id. Receipts are passed on once per message, so a second receipt
+    for the same message in a batch (such as "read" after "delivered") is
+    dropped before it reaches Redis, and the mappings of all the messages
+    receipted are deleted together afterwards.
+    '''
+
+    def __init__(self, message_ids, on_ack, on_receipt, batch_size=100,
+                 batch_interval=0.005, metrics=None, clock=reactor):
+        super(EventBatcher, self).__init__(batch_size, batch_interval, clock)
+        self.message_ids = message_ids
+        self.on_ack = on_ack
+        self.on_receipt = on_receipt
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # (kind, whatsapp_id), waiting for the next flush
+        self._events = []
+        self._receipted = set()
+
+    def ack(self, whatsapp_id):
+        self._add('ack', whatsapp_id)
+
+    def receipt(self, whatsapp_id):
+        if whatsapp_id in self._receipted:
+            self.metrics.incr('events.duplicate_receipts')
+            return
+        self._receipted.add(whatsapp_id)
+        self._add('receipt', whatsapp_id)
+
+    def _add(self, kind, whatsapp_id):
+        self._events.append((kind, whatsapp_id))
+        self._changed(len(self._events))
+
+    def _write_pending(self):
+        events, self._events = self._events, []
+        receipted, self._receipted = self._receipted, set()
+        if events:
+            self._resolve_batch(events, receipted)
+
+    def _resolve_batch(self, events, receipted):
+        self.metrics.record('events.batch_size', len(events))
+        ids = set(whatsapp_id for _kind, whatsapp_id in events)
+        d = self.message_ids.get_many(ids)
+        d.addCallback(self._pass_on, events, receipted)
+        self._track(d)
+        d.addErrback(log.err, 'Failed to resolve acks and receipts')
+
+    def _pass_on(self, vumi_ids, events, receipted):
+        ds = []
+        for kind, whatsapp_id in events:
+            vumi_id = vumi_ids.get(whatsapp_id)
+            if vumi_id is None:
+                self.metrics.incr('events.unknown')
+                continue
+            callback = self.on_ack if kind == 'ack' else self.on_receipt
+            ds.append(defer.maybeDeferred(callback, whatsapp_id, vumi_id))
+        ds.append(self.message_ids.delete_many(
+            [i for i in receipted if i in vumi_ids]))
+        return defer.gatherResults(ds, consumeErrors=True)
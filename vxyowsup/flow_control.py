@@ -0,0 +1,52 @@
+# -*- test-case-name: vxyowsup.tests.test_flow_control -*-
+import threading
+import time
+
+from vxyowsup.metrics import Metrics
+
+
+class InFlightWindow(object):
+    '''Limits how many inbound messages may be on their way to being
+    published at once.
+
+    ``acquire`` is called by the stack thread for each message it parses and
+    blocks while ``size`` messages are already in flight, so the stack stops
+    reading from the server until ``release`` is called (from any thread)
+    for one of them. A size of 0 means no limit. Time spent blocked is
+    recorded as ``<name>.blocked_time``.
+    '''
+
+    def __init__(self, size, metrics=None, name='inbound'):
+        self.size = size
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.name = name
+        self.in_flight = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return self.in_flight
+
+    def acquire(self):
+        with self._condition:
+            if self.size and self.in_flight >= self.size and not self.closed:
+                start = time.time()
+                self.metrics.incr('%s.blocked' % (self.name,))
+                while self.in_flight >= self.size and not self.closed:
+                    # Waits with a timeout, so that close() is noticed even
+                    # if its notification is missed.
+                    self._condition.wait(1)
+                self.metrics.record(
+                    '%s.blocked_time' % (self.name,), time.time() - start)
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._condition.notify()
+
+    def close(self):
+        '''Stops blocking, for good.'''
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
@@ -0,0 +1,202 @@
+# -*- test-case-name: vxyowsup.tests.test_health -*-
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+
+
+class SlidingWindow(object):
+    '''Counts successes and failures, and sums latencies, over the last
+    ``window`` seconds.
+
+    Counts are kept in ``buckets`` slices of the window, so recording is
+    cheap and old slices are simply dropped as time moves on.
+    '''
+
+    def __init__(self, window, buckets=10, clock=reactor):
+        self.window = window
+        self.bucket_size = float(window) / buckets
+        self.clock = clock
+        # [bucket, successes, failures, latencies, total latency]
+        self._buckets = deque()
+
+    def _current(self):
+        bucket = int(self.clock.seconds() // self.bucket_size)
+        self._expire(bucket)
+        if not self._buckets or self._buckets[-1][0] != bucket:
+            self._buckets.append([bucket, 0, 0, 0, 0.0])
+        return self._buckets[-1]
+
+    def _expire(self, bucket):
+        oldest = bucket - int(round(self.window / self.bucket_size)) + 1
+        while self._buckets and self._buckets[0][0] < oldest:
+            self._buckets.popleft()
+
+    def success(self, count=1):
+        self._current()[1] += count
+
+    def failure(self, count=1):
+        self._current()[2] += count
+
+    def latency(self, value):
+        current = self._current()
+        current[3] += 1
+        current[4] += value
+
+    def totals(self):
+        '''Returns the successes, failures, number of latencies and their
+        total over the window.'''
+        self._expire(int(self.clock.seconds() // self.bucket_size))
+        totals = [0, 0, 0, 0.0]
+        for counts in self._buckets:
+            for i in range(4):
+                totals[i] += counts[i + 1]
+        return tuple(totals)
+
+
+class HealthMonitor(object):
+    '''Judges the health of the transport's components from what happened
+    to them over the last ``window`` seconds, and publishes their statuses
+    with ``add_status`` every ``interval`` seconds.
+
+    ``inbound`` and ``outbound`` are degraded once at least
+    ``degraded_error_rate`` of their messages have failed, and down once at
+    least ``down_error_rate`` have, but only once there have been
+    ``min_events`` messages to judge by. ``ack_latency`` is degraded while
+    messages take longer than ``max_ack_latency`` seconds to be acked on
+    average. ``connection`` is degraded once it has been lost
+    ``max_disconnects`` times, even if it is up again. Components with
+    nothing in the window keep the status they have.
+    '''
+
+    COMPONENTS = ('inbound', 'outbound', 'ack_latency', 'connection')
+
+    def __init__(self, add_status, window=60, interval=10,
+                 degraded_error_rate=0.05, down_error_rate=0.5,
+                 min_events=10, max_ack_latency=30, max_disconnects=3,
+                 metrics=None, clock=reactor):
+        self.add_status = add_status
+        self.window = window
+        self.interval = interval
+        self.degraded_error_rate = degraded_error_rate
+        self.down_error_rate = down_error_rate
+        self.min_events = min_events
+        self.max_ack_latency = max_ack_latency
+        self.max_disconnects = max_disconnects
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+
+        self.windows = dict(
+            (component, SlidingWindow(window, clock=clock))
+            for component in self.COMPONENTS)
+        # component -> (error, details) of its latest failure
+        self.last_error = {}
+        self.connected = None
+        self._loop = None
+
+    def start(self):
+        self._loop = LoopingCall(self.check)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False).addErrback(
+            log.err, 'Health check failed')
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def success(self, component):
+        self.windows[component].success()
+
+    def failure(self, component, error=None, details=None):
+        self.windows[component].failure()
+        self.last_error[component] = (error, details)
+
+    def latency(self, component, value):
+        self.windows[component].latency(value)
+
+    def connection_changed(self, connected, reason=None):
+        '''Notes a connection being made or lost. Losses count against the
+        connection's health.'''
+        self.connected = connected
+        if connected:
+            self.success('connection')
+        else:
+            self.failure('connection', reason)
+
+    def check(self):
+        '''Publishes the status of each component that there is something to
+        judge by.'''
+        self.metrics.incr('health.checks')
+        ds = []
+        for component in self.COMPONENTS:
+            status = self.status(component)
+            if status is not None:
+                ds.append(self.add_status(component=component, **status))
+        return defer.gatherResults(ds).addCallback(lambda _: None)
+
+    def status(self, component):
+        '''Returns the status (``status``, ``type``, ``message`` and maybe
+        ``details``) of ``component`` judged over the window, or None if
+        there is nothing to judge it by.'''
+        return getattr(self, '_%s_status' % (component,))(
+            *self.windows[component].totals())
+
+    def _error_rate_status(self, component, successes, failures, noun):
+        total = successes + failures
+        if not total:
+            return None
+        rate = float(failures) / total
+        self.metrics.set('health.%s.error_rate' % (component,), rate)
+        if rate < self.degraded_error_rate:
+            return {
+                'status': 'ok', 'type': '%s_success' % (component,),
+                'message': '%s messages successfully processed' % (noun,)}
+        if total < self.min_events:
+            return None
+        error, details = self.last_error.get(component, (None, None))
+        return {
+            'status': 'down' if rate >= self.down_error_rate else 'degraded',
+            'type': '%s_error' % (component,),
+            'message': error or '%d of %d %s messages failed' % (
+                failures, total, noun.lower()),
+            'details': dict(
+                details or {}, failures=failures, total=total,
+                window=self.window),
+        }
+
+    def _inbound_status(self, successes, failures, _latencies, _total):
+        return self._error_rate_status(
+            'inbound', successes, failures, 'Inbound')
+
+    def _outbound_status(self, successes, failures, _latencies, _total):
+        return self._error_rate_status(
+            'outbound', successes, failures, 'Outbound')
+
+    def _ack_latency_status(self, _successes, _failures, latencies, total):
+        if not latencies:
+            return None
+        mean = total / latencies
+        self.metrics.set('health.ack_latency.mean', mean)
+        message = 'Messages acked in %.1f seconds on average' % (mean,)
+        if mean > self.max_ack_latency:
+            return {'status': 'degraded', 'type': 'ack_latency_high',
+                    'message': message}
+        return {'status': 'ok', 'type': 'ack_latency_ok', 'message': message}
+
+    def _connection_status(self, _successes, failures, _latencies, _total):
+        self.metrics.set('health.connection.disconnects', failures)
+        if not self.connected:
+            # Losing the connection is published as soon as it happens.
+            return None
+        if failures >= self.max_disconnects:
+            return {
+                'status': 'degraded', 'type': 'connection_unstable',
+                'message': 'Connection lost %d times in the last %s '
+                           'seconds' % (failures, self.window)}
+        return {'status': 'ok', 'type': 'connected',
+                'message': 'Successfully connected to server'}
@@ -0,0 +1,139 @@
+# -*- test-case-name: vxyowsup.tests.test_journal -*-
+import json
+
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter
+
+
+class OutboundJournal(BatchWriter):
+    '''Keeps outbound messages in Redis until the server has acked them, so
+    they can be sent again after a restart, or by the copy of the transport
+    that takes over an account.
+
+    Messages are journaled under the account (of ``accounts``) responsible
+    for sending them, each one a field of that account's Redis hash, keyed
+    by its Vumi message id. The value is a short JSON list (see ``FIELDS``)
+    behind a sequence number, which is the time the message was journaled
+    in microseconds and gives the order to replay messages in. A message
+    sent to several recipients, or with media, has a dict at the end with
+    the list of ``recipients`` and the ``media`` from its helper metadata.
+
+    Appends and removals are collected for up to ``batch_interval`` seconds
+    (or until ``batch_size`` of them are pending) and written with one
+    ``HMSET`` per account and one ``HDEL`` per account (since a removal
+    doesn't say which account it is for). A message acked before its batch
+    is written never reaches Redis at all.
+    '''
+
+    FIELDS = ('to_addr', 'from_addr', 'content', 'in_reply_to')
+
+    def __init__(self, redis, accounts, key='outbound_journal',
+                 batch_size=100, batch_interval=0.05, metrics=None,
+                 clock=reactor):
+        super(OutboundJournal, self).__init__(
+            batch_size, batch_interval, clock)
+        self.redis = redis
+        self.accounts = list(accounts)
+        self.key = key
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # account -> {message_id: record}, waiting for the next flush
+        self._appends = {}
+        self._removes = set()
+        self._pending = 0
+        self._last_seq = 0
+
+    def account_key(self, account):
+        return '%s:%s' % (self.key, account)
+
+    def append(self, account, message, recipients=None):
+        seq = max(int(self.clock.seconds() * 1000000), self._last_seq + 1)
+        self._last_seq = seq
+        record = [seq] + [message[field] for field in self.FIELDS]
+        extra = {}
+        if recipients is not None:
+            extra['recipients'] = recipients
+        media = message['helper_metadata'].get('whatsapp', {}).get('media')
+        if media is not None:
+            extra['media'] = media
+        if extra:
+            record.append(extra)
+        self._appends.setdefault(account, {})[message['message_id']] = (
+            json.dumps(record, separators=(',', ':')))
+        self._pending += 1
+        self._changed(self._pending + len(self._removes))
+
+    def remove(self, message_id):
+        for appends in self._appends.itervalues():
+            if appends.pop(message_id, None) is not None:
+                self._pending -= 1
+                return
+        self._removes.add(message_id)
+        self._changed(self._pending + len(self._removes))
+
+    def _write_pending(self):
+        appends, self._appends = self._appends, {}
+        removes, self._removes = self._removes, set()
+        self._pending = 0
+        appends = dict(
+            (account, batch) for account, batch in appends.iteritems()
+            if batch)
+        if appends or removes:
+            self._write_batch(appends, removes)
+
+    def _write_batch(self, appends, removes):
+        start = self.clock.seconds()
+        # The commands go out back to back on the same connection, so a
+        # removal is never applied before the append it cancels.
+        ds = [self.redis.hmset(self.account_key(account), batch)
+              for account, batch in appends.iteritems()]
+        if removes:
+            ds.extend(self.redis.hdel(self.account_key(account), *removes)
+                      for account in self.accounts)
+        d = self._track(defer.gatherResults(ds, consumeErrors=True))
+
+        def written(r):
+            self.metrics.incr('journal.flushes')
+            self.metrics.record('journal.batch_size', sum(
+                len(batch) for batch in appends.itervalues()) + len(removes))
+            self.metrics.record(
+                'journal.flush_latency', self.clock.seconds() - start)
+            return r
+
+        d.addBoth(written)
+        d.addErrback(log.err, 'Failed to write outbound journal')
+
+    @defer.inlineCallbacks
+    def recover(self, account, max_age=None):
+        '''Returns the messages still in ``account``'s journal, oldest first,
+        as dicts of ``message_id`` and ``FIELDS`` (and ``recipients`` and
+        ``media``, if the message was journaled with them). Messages
+        journaled more than ``max_age`` seconds ago are dropped instead.'''
+        yield self.flush()
+        key = self.account_key(account)
+        entries = yield self.redis.hgetall(key)
+        oldest = None
+        if max_age is not None:
+            oldest = (self.clock.seconds() - max_age) * 1000000
+        messages = []
+        expired = []
+        for message_id, data in entries.iteritems():
+            record = json.loads(data)
+            if oldest is not None and record[0] < oldest:
+                expired.append(message_id)
+                continue
+            fields = dict(zip(self.FIELDS, record[1:]))
+            if len(record) > len(self.FIELDS) + 1:
+                fields.update(record[-1])
+            fields['message_id'] = message_id
+            messages.append((record[0], fields))
+        if expired:
+            yield self.redis.hdel(key, *expired)
+        messages.sort(key=lambda message: message[0])
+        if messages:
+            self._last_seq = max(self._last_seq, messages[-1][0])
+        defer.returnValue([message for _seq, message in messages])
@@ -0,0 +1,153 @@
+# -*- test-case-name: vxyowsup.tests.test_lease -*-
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+
+
+class Lease(object):
+    '''A claim on ``name`` that only one ``owner`` holds at a time, kept as
+    a Redis key holding the owner's name that expires after ``ttl``
+    seconds.
+
+    Every ``interval`` seconds the holder extends the key's expiry, and any
+    other owner tries to create the key. When the holder stops, or can't
+    reach Redis, another owner holds the lease within ``ttl`` plus
+    ``interval`` seconds. ``acquired`` is called when this owner gets the
+    lease. ``lost`` is called when this owner finds someone else holds the
+    lease, or has been unable to extend it for ``ttl`` less ``interval``
+    seconds (even while Redis doesn't answer), so that it lets go before
+    another owner can take it. Checks don't wait for either of them.
+
+    The holder reads the key before extending it, so in the moment between
+    the two another owner could take an expired lease and have it extended.
+    The holder finds out at its next check.
+    '''
+
+    def __init__(self, redis, name, owner, ttl=10, interval=3, acquired=None,
+                 lost=None, metrics=None, clock=reactor):
+        self.redis = redis
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.interval = interval
+        self.acquired = acquired
+        self.lost = lost
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+
+        self.held = False
+        self.renewed_at = None
+        self._loop = None
+        self._checking = None
+
+    def key(self):
+        return 'lease:%s' % (self.name,)
+
+    def start(self):
+        '''Checks the lease every ``interval`` seconds, starting now.
+        Returns a deferred that fires once the first check is done.'''
+        self._loop = LoopingCall(self.check)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False).addErrback(
+            log.err, 'Lease check failed')
+        return self.check()
+
+    def stop(self):
+        '''Stops checking the lease, and gives it up if it is held so that
+        another owner can take it straight away.'''
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if not self.held:
+            return defer.succeed(None)
+        self.held = False
+        d = self.redis.get(self.key())
+
+        def release(owner):
+            if owner == self.owner:
+                return self.redis.delete(self.key())
+
+        return d.addCallback(release)
+
+    def check(self):
+        '''Extends the lease if this owner holds it, or tries to take it if
+        not.'''
+        if self.held and self._stale():
+            # Redis may be hanging rather than failing, leaving the last
+            # check waiting.
+            self._lose()
+            return defer.succeed(None)
+        if self._checking is not None:
+            return self._checking
+        if self.held:
+            d = self.redis.get(self.key())
+            d.addCallback(self._renew)
+        else:
+            d = self._acquire()
+        d.addErrback(self._failed)
+
+        def done(r):
+            self._checking = None
+            return r
+
+        d.addBoth(done)
+        if not d.called:
+            self._checking = d
+        return d
+
+    def _acquire(self):
+        d = self.redis.setnx(self.key(), self.owner)
+
+        def created(added):
+            if added:
+                d = self.redis.expire(self.key(), self.ttl)
+                return d.addCallback(lambda _: self._got())
+            if self.held:
+                # It expired and someone else got it first.
+                return self._lose()
+            return self.redis.ttl(self.key()).addCallback(self._check_ttl)
+
+        return d.addCallback(created)
+
+    def _check_ttl(self, ttl):
+        # An owner that stopped between creating the key and setting its
+        # expiry would otherwise keep everyone out for good.
+        if ttl is None or ttl == -1:
+            return self.redis.expire(self.key(), self.ttl)
+
+    def _renew(self, owner):
+        if owner is None:
+            return self._acquire()
+        if owner != self.owner:
+            return self._lose()
+        d = self.redis.expire(self.key(), self.ttl)
+        return d.addCallback(lambda _: self._got())
+
+    def _got(self):
+        self.renewed_at = self.clock.seconds()
+        if self.held:
+            return
+        self.held = True
+        self.metrics.incr('lease.acquired')
+        if self.acquired is not None:
+            self.acquired()
+
+    def _lose(self):
+        if not self.held:
+            return
+        self.held = False
+        self.metrics.incr('lease.lost')
+        if self.lost is not None:
+            self.lost()
+
+    def _failed(self, f):
+        log.err(f, 'Failed to check lease %s' % (self.name,))
+        if self.held and self._stale():
+            return self._lose()
+
+    def _stale(self):
+        return self.clock.seconds() - self.renewed_at >= (
+            self.ttl - self.interval)
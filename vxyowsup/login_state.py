@@ -0,0 +1,41 @@
+# -*- test-case-name: vxyowsup.tests.test_login_state -*-
+from twisted.internet import defer
+
+from vxyowsup.metrics import Metrics
+
+
+class LoginStateStore(object):
+    '''Keeps what the server sent at each account's last login in a Redis
+    hash, keyed by its MSISDN.
+
+    The ``nonce`` is what the server expects the next login to be signed
+    with. Yowsup only keeps it on the local disk, so a stack started with it
+    from here (on any host) logs in without waiting for a challenge. The
+    other fields are the account details the server sent with it.
+    '''
+
+    FIELDS = ('nonce', 'status', 'kind', 'creation', 'expiration', 't')
+
+    def __init__(self, redis, metrics=None):
+        self.redis = redis
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def key(self, msisdn):
+        return 'login:%s' % (msisdn,)
+
+    @defer.inlineCallbacks
+    def load(self, msisdn):
+        '''Returns the state saved for ``msisdn`` (empty if there is
+        none).'''
+        state = yield self.redis.hgetall(self.key(msisdn))
+        if state.get('nonce') is not None:
+            self.metrics.incr('login.cached')
+        defer.returnValue(state)
+
+    def save(self, msisdn, state):
+        state = dict(
+            (field, state[field]) for field in self.FIELDS
+            if state.get(field) is not None)
+        if not state:
+            return defer.succeed(None)
+        return self.redis.hmset(self.key(msisdn), state)
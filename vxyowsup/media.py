@@ -0,0 +1,511 @@
+# -*- test-case-name: vxyowsup.tests.test_media -*-
+'''Uploads and downloads the media (images, audio and video) in WhatsApp
+messages.
+
+Files are never held in memory whole. Sources are read (or fetched) and
+hashed a chunk at a time, uploads stream the file into the request body and
+downloads are written to disk as they arrive. Transfers run at most
+``max_transfers`` at a time, apart from text messages, which never wait for
+them.
+'''
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import tempfile
+from StringIO import StringIO
+from urlparse import urlparse
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implementer
+
+from yowsup.layers.protocol_media.protocolentities import (
+    AudioDownloadableMediaMessageProtocolEntity,
+    DownloadableMediaMessageProtocolEntity,
+    ImageDownloadableMediaMessageProtocolEntity,
+    LocationMediaMessageProtocolEntity,
+    VCardMediaMessageProtocolEntity,
+    VideoDownloadableMediaMessageProtocolEntity)
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import timeout_after, when_done
+
+
+MEDIA_TYPES = ('image', 'audio', 'video')
+
+
+class MediaError(Exception):
+    '''A transfer failed.'''
+
+
+class MediaFile(object):
+    '''A file to upload, or one that was downloaded.
+
+    ``hash`` is the base64 encoded SHA-256 of its content, as WhatsApp
+    identifies media by. ``temporary`` files were spooled from a URL or an
+    open file and are removed once uploaded. ``url`` is where WhatsApp
+    serves it from, once known.
+    '''
+
+    def __init__(self, path, hash, size, name=None, temporary=False):
+        self.path = path
+        self.hash = hash
+        self.size = size
+        self.name = name or os.path.basename(path)
+        self.temporary = temporary
+        self.url = None
+
+    @property
+    def mimetype(self):
+        mimetype, _encoding = mimetypes.guess_type(self.name)
+        return mimetype or 'application/octet-stream'
+
+
+def encode_hash(hasher):
+    return base64.b64encode(hasher.digest())
+
+
+def url_name(url):
+    '''The file name at the end of ``url``'s path.'''
+    return posixpath.basename(urlparse(url).path) or 'media'
+
+
+def media_message(media, upload, to, caption=None):
+    '''The WhatsApp message of the ``upload`` described by ``media`` (the
+    ``media`` helper metadata of an outbound message) to send ``to``.'''
+    args = (
+        media.get('mimetype') or upload.mimetype, upload.hash, upload.url,
+        None, upload.size, upload.name)
+    if media['type'] == 'image':
+        return ImageDownloadableMediaMessageProtocolEntity(
+            *args, encoding='raw', width=media.get('width', 0),
+            height=media.get('height', 0), caption=caption, to=to)
+    if media['type'] == 'audio':
+        return AudioDownloadableMediaMessageProtocolEntity(
+            *args, abitrate=None, acodec=None, asampfreq=None,
+            duration=media.get('seconds'), encoding='raw', origin=None,
+            seconds=media.get('seconds'), to=to)
+    return VideoDownloadableMediaMessageProtocolEntity(
+        *args, abitrate=None, acodec=None, asampfmt=None, asampfreq=None,
+        duration=media.get('seconds'), encoding='raw', fps=None,
+        width=media.get('width', 0), height=media.get('height', 0),
+        seconds=media.get('seconds'), vbitrate=None, vcodec=None,
+        caption=caption, to=to)
+
+
+def inbound_media(entity):
+    '''What is known of the media in an inbound message, as plain values
+    that can be passed between processes.'''
+    if isinstance(entity, DownloadableMediaMessageProtocolEntity):
+        return {
+            'type': entity.getMediaType(),
+            'url': entity.getMediaUrl(),
+            'mimetype': entity.getMimeType(),
+            'size': entity.getMediaSize(),
+            'hash': entity.fileHash,
+            'name': entity.fileName,
+            'caption': getattr(entity, 'caption', None),
+        }
+    if isinstance(entity, LocationMediaMessageProtocolEntity):
+        return {
+            'type': 'location',
+            'latitude': entity.getLatitude(),
+            'longitude': entity.getLongitude(),
+            'name': entity.getLocationName(),
+            'url': entity.getLocationURL(),
+        }
+    if isinstance(entity, VCardMediaMessageProtocolEntity):
+        return {
+            'type': 'vcard',
+            'name': entity.getName(),
+            'card_data': entity.getCardData(),
+        }
+    return {'type': entity.getMediaType()}
+
+
+class FileWriter(Protocol):
+    '''Writes a response body to ``f`` as it arrives, hashing it on the way
+    if given a ``hasher``. ``finished`` fires with the number of bytes
+    written.'''
+
+    def __init__(self, f, hasher, finished):
+        self.f = f
+        self.hasher = hasher
+        self.finished = finished
+        self.size = 0
+
+    def dataReceived(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.f.write(data)
+        self.size += len(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return  # Given up on, and closed.
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.size)
+        else:
+            self.finished.errback(reason)
+
+
+def receive(response, f, hasher=None):
+    '''Writes ``response``'s body to ``f`` as it arrives (see
+    ``FileWriter``). Returns a deferred that fires with its size. Cancelling
+    it closes the connection, so the rest of the body stops arriving.'''
+    finished = defer.Deferred(lambda _: writer.transport.stopProducing())
+    writer = FileWriter(f, hasher, finished)
+    response.deliverBody(writer)
+    return finished
+
+
+@implementer(IBodyProducer)
+class MultipartFileProducer(object):
+    '''A ``multipart/form-data`` request body of ``fields`` and a file, read
+    from disk ``chunk_size`` bytes at a time as the connection takes them.'''
+
+    BOUNDARY = 'zzXXzzYYzzXXzzQQ'
+
+    def __init__(self, fields, media, filename, mimetype, chunk_size):
+        part = '--%s\r\nContent-Disposition: form-data; name="%%s"' % (
+            self.BOUNDARY,)
+        self.head = ''.join(
+            (part + '\r\n\r\n%s\r\n') % (name, value)
+            for name, value in fields)
+        self.head += (part + '; filename="%s"\r\nContent-Type: %s\r\n\r\n') % (
+            'file', filename, mimetype)
+        self.tail = '\r\n--%s--\r\n' % (self.BOUNDARY,)
+        self.path = media.path
+        self.chunk_size = chunk_size
+        self.length = len(self.head) + media.size + len(self.tail)
+        self.content_type = 'multipart/form-data; boundary=%s' % (
+            self.BOUNDARY,)
+        self._task = None
+
+    def startProducing(self, consumer):
+        self._task = task.cooperate(self._produce(consumer))
+        d = self._task.whenDone()
+
+        def stopped(f):
+            f.trap(task.TaskStopped)
+            return defer.Deferred()  # The request has been given up on.
+
+        return d.addCallbacks(lambda _: None, stopped)
+
+    def _produce(self, consumer):
+        consumer.write(self.head)
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                consumer.write(chunk)
+                yield None
+        consumer.write(self.tail)
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
+
+
+class MediaTransfers(object):
+    '''Uploads media to WhatsApp and downloads media from it.
+
+    Each upload is remembered in Redis by the hash of its content for
+    ``cache_ttl`` seconds, so sending the same file again (such as the image
+    of a campaign sent to each recipient in turn) reuses the first upload.
+    Uploads from URLs are also remembered by URL, so sending the same URL
+    again doesn't fetch it again either.
+    Downloads are written to ``store_path``, which is also where sources
+    fetched from URLs are spooled (the system's temporary directory if it is
+    not set). Local files are only read from within ``upload_dir``, and not
+    at all if it is not set.
+    '''
+
+    def __init__(self, redis, store_path=None, upload_dir=None,
+                 max_transfers=4, chunk_size=64 * 1024,
+                 cache_ttl=7 * 24 * 60 * 60, timeout=300, metrics=None,
+                 agent=None, clock=reactor):
+        self.redis = redis
+        self.store_path = store_path
+        self.upload_dir = upload_dir
+        self.max_transfers = max_transfers
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.agent = agent if agent is not None else Agent(clock)
+        self.clock = clock
+        self.semaphore = defer.DeferredSemaphore(max_transfers)
+        # hash -> upload in progress, so the same content is only uploaded
+        # once even when it is sent again before the first upload is done.
+        self._uploads = {}
+
+    @property
+    def waiting(self):
+        return len(self.semaphore.waiting)
+
+    @property
+    def active(self):
+        return self.max_transfers - self.semaphore.tokens
+
+    def cache_key(self, media_hash):
+        return 'media:%s' % (media_hash,)
+
+    def url_cache_key(self, url):
+        return 'media:url:%s' % (
+            hashlib.sha256(url.encode('utf-8')).hexdigest(),)
+
+    def _timed(self, name, d):
+        '''Gives up on the transfer ``d`` after ``timeout`` seconds, and
+        records how long it took (including any wait for room to run it) as
+        ``media.<name>_time``.'''
+        start = self.clock.seconds()
+        if self.timeout:
+            timeout_after(d, self.timeout, self.clock)
+
+        def done(r):
+            self.metrics.record(
+                'media.%s_time' % (name,), self.clock.seconds() - start)
+            return r
+
+        return d.addCallback(done)
+
+    def _pump(self, source, hasher, sink=None):
+        '''Reads ``source`` a chunk at a time, without blocking the reactor
+        for long, hashing each chunk and writing it to ``sink`` if given.
+        Returns a deferred that fires with the number of bytes read.'''
+        size = [0]
+
+        def chunks():
+            while True:
+                chunk = source.read(self.chunk_size)
+                if not chunk:
+                    return
+                hasher.update(chunk)
+                size[0] += len(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                yield None
+
+        d = task.cooperate(chunks()).whenDone()
+        return d.addCallback(lambda _: size[0])
+
+    def _temp_file(self, suffix=''):
+        fd, path = tempfile.mkstemp(
+            suffix=suffix, prefix='.spool-', dir=self.store_path)
+        return os.fdopen(fd, 'wb'), path
+
+    @defer.inlineCallbacks
+    def spool(self, source, name=None):
+        '''Returns a ``MediaFile`` for ``source``: the URL of a file to
+        fetch, the path of a local file in ``upload_dir`` (or a ``file://``
+        URL) or an open file to read it from.'''
+        hasher = hashlib.sha256()
+        if hasattr(source, 'read'):
+            f, path = self._temp_file()
+            try:
+                with f:
+                    size = yield self._pump(source, hasher, f)
+            except Exception:
+                os.remove(path)
+                raise
+            defer.returnValue(MediaFile(
+                path, encode_hash(hasher), size,
+                name=name or os.path.basename(getattr(source, 'name', '')),
+                temporary=True))
+
+        scheme = urlparse(source).scheme
+        if scheme in ('http', 'https'):
+            f, path = self._temp_file()
+            media = yield self.fetch(source, path, f)
+            media.name = name or url_name(source)
+            media.temporary = True
+            defer.returnValue(media)
+
+        source = self.local_path(source)
+        with open(source, 'rb') as f:
+            size = yield self._pump(f, hasher)
+        defer.returnValue(MediaFile(source, encode_hash(hasher), size, name))
+
+    def local_path(self, source):
+        '''The real path of the local file ``source`` (a path, relative to
+        ``upload_dir`` or not, or a ``file://`` URL) names. Raises
+        ``MediaError`` if it is not in ``upload_dir``.'''
+        scheme = urlparse(source).scheme
+        if scheme == 'file':
+            source = urlparse(source).path
+        elif scheme:
+            raise MediaError('Unsupported media URL: %s' % (source,))
+        if self.upload_dir is None:
+            raise MediaError('Local media files are not allowed')
+        root = os.path.realpath(self.upload_dir)
+        path = os.path.realpath(os.path.join(root, source))
+        if not path.startswith(root + os.sep):
+            raise MediaError(
+                'Media file is outside the upload directory: %s' % (source,))
+        return path
+
+    @defer.inlineCallbacks
+    def fetch(self, url, path, f=None):
+        '''Downloads ``url`` to ``path``, a chunk at a time as it arrives,
+        and returns its ``MediaFile``.'''
+        if f is None:
+            f = open(path, 'wb')
+        hasher = hashlib.sha256()
+        try:
+            with f:
+                response = yield self.agent.request(
+                    'GET', url.encode('utf-8'))
+                if response.code != 200:
+                    # Nobody wants the body, so stop it arriving.
+                    response.deliverBody(Protocol())
+                    raise MediaError('Fetching %s failed with status %s' % (
+                        url, response.code))
+                size = yield receive(response, f, hasher)
+        except Exception:
+            os.remove(path)
+            raise
+        self.metrics.record('media.bytes_down', size)
+        defer.returnValue(MediaFile(path, encode_hash(hasher), size))
+
+    def download(self, url, name):
+        '''Downloads the media at ``url`` to ``name`` in the store, once
+        there is room for another transfer. Returns a deferred that fires
+        with its ``MediaFile``.'''
+        self.metrics.incr('media.downloads')
+        return self._timed(
+            'download', self.semaphore.run(self._download, url, name))
+
+    @defer.inlineCallbacks
+    def _download(self, url, name):
+        path = os.path.join(self.store_path, name)
+        # Written under another name and then renamed, so the path never
+        # holds part of a file.
+        f, spool_path = self._temp_file(suffix=os.path.splitext(name)[1])
+        media = yield self.fetch(url, spool_path, f)
+        os.rename(spool_path, path)
+        media.path = path
+        media.name = name
+        media.url = url
+        defer.returnValue(media)
+
+    def upload(self, source, request_slot, fields, name=None):
+        '''Uploads ``source`` (see ``spool``), once there is room for
+        another transfer, unless the same content has been uploaded before.
+
+        ``request_slot`` is called with the ``MediaFile`` and returns a
+        deferred that fires with the URL to upload it to and whether the
+        server already has it (in which case that URL is where it is served
+        from). ``fields`` are the form fields to post with the file. Returns
+        a deferred that fires with the ``MediaFile``, with its ``url`` set.
+        '''
+        return self._timed(
+            'upload', self._upload(source, request_slot, fields, name))
+
+    @defer.inlineCallbacks
+    def _upload(self, source, request_slot, fields, name):
+        url_key = None
+        if (isinstance(source, basestring) and
+                urlparse(source).scheme in ('http', 'https')):
+            url_key = self.url_cache_key(source)
+            cached = yield self.redis.get(url_key)
+            if cached is not None:
+                self.metrics.incr('media.url_cache_hits')
+                cached = json.loads(cached)
+                media = MediaFile(
+                    None, cached['hash'], cached['size'],
+                    name=name or cached['name'])
+                media.url = cached['url']
+                defer.returnValue(media)
+            self.metrics.incr('media.url_cache_misses')
+
+        media = yield self.semaphore.run(self.spool, source, name)
+        try:
+            # Waiting for another upload of the same content doesn't hold
+            # up other transfers.
+            while media.hash in self._uploads:
+                yield when_done(self._uploads[media.hash])
+            d = self._uploads[media.hash] = self._upload_once(
+                media, request_slot, fields)
+            try:
+                media.url = yield d
+            finally:
+                del self._uploads[media.hash]
+        finally:
+            if media.temporary:
+                os.remove(media.path)
+        if url_key is not None:
+            yield self.redis.setex(url_key, self.cache_ttl, json.dumps({
+                'hash': media.hash,
+                'size': media.size,
+                'name': media.name,
+                'url': media.url,
+            }))
+        defer.returnValue(media)
+
+    @defer.inlineCallbacks
+    def _upload_once(self, media, request_slot, fields):
+        key = self.cache_key(media.hash)
+        url = yield self.redis.get(key)
+        if url is not None:
+            self.metrics.incr('media.cache_hits')
+            defer.returnValue(url)
+        self.metrics.incr('media.cache_misses')
+        url = yield self.semaphore.run(
+            self._post_new, media, request_slot, fields)
+        yield self.redis.setex(key, self.cache_ttl, url)
+        defer.returnValue(url)
+
+    @defer.inlineCallbacks
+    def _post_new(self, media, request_slot, fields):
+        url, duplicate = yield request_slot(media)
+        if not duplicate:
+            url = yield self.post(url, media, fields)
+        defer.returnValue(url)
+
+    @defer.inlineCallbacks
+    def post(self, url, media, fields):
+        '''Streams ``media`` to the upload ``url`` and returns the URL it is
+        served from.'''
+        self.metrics.incr('media.uploads')
+        name = media.name
+        if isinstance(name, unicode):
+            # As it is when it came from a message's JSON.
+            name = name.encode('utf-8')
+        # The name the server gets, as yowsup's own uploader makes it.
+        filename = hashlib.md5(name).hexdigest() + os.path.splitext(name)[1]
+        body = MultipartFileProducer(
+            fields, media, filename, media.mimetype, self.chunk_size)
+        response = yield self.agent.request(
+            'POST', url.encode('utf-8'), Headers({
+                'Content-Type': [body.content_type],
+            }), body)
+        content = StringIO()
+        yield receive(response, content)
+        content = content.getvalue()
+        if response.code != 200:
+            raise MediaError('Upload to %s failed with status %s' % (
+                url, response.code))
+        for line in content.splitlines():
+            if line.startswith('{'):
+                served = json.loads(line).get('url')
+                if served:
+                    break
+        else:
+            raise MediaError('Upload to %s returned no URL: %r' % (
+                url, content))
+        self.metrics.record('media.bytes_up', media.size)
+        defer.returnValue(served)
@@ -0,0 +1,294 @@
+# -*- test-case-name: vxyowsup.tests.test_message_store -*-
+import binascii
+import re
+import struct
+
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.util import BatchWriter, LRUCache, when_done
+
+
+class MessageIdStore(BatchWriter):
+    '''Maps WhatsApp message ids to Vumi message ids.
+
+    Writes are collected for up to ``batch_interval`` seconds (or until
+    ``batch_size`` mappings are pending) and then written to Redis together.
+    Lookups read through mappings that haven't been written yet, so an ack
+    that arrives before its mapping is flushed is not lost.
+
+    Recently seen mappings are also kept in a local ``LRUCache`` of up to
+    ``cache_size`` entries, so most lookups never reach Redis.
+    '''
+
+    def __init__(self, redis, ttl, batch_size=100, batch_interval=0.05,
+                 cache_size=10000, metrics=None, clock=reactor):
+        super(MessageIdStore, self).__init__(batch_size, batch_interval, clock)
+        self.redis = redis
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cache = LRUCache(
+            cache_size, ttl, metrics=self.metrics, clock=clock,
+            name='message_ids.cache')
+
+        # whatsapp_id -> vumi_id, waiting for the next flush
+        self._pending = {}
+        # whatsapp_id -> (vumi_id, write deferred), currently being written
+        self._flushing = {}
+
+    def add(self, whatsapp_id, vumi_id):
+        self._pending[whatsapp_id] = vumi_id
+        self.cache.set(whatsapp_id, vumi_id)
+        self._changed(len(self._pending))
+
+    def _get_local(self, whatsapp_id):
+        vumi_id = self.cache.get(whatsapp_id)
+        if vumi_id is not None:
+            return vumi_id
+        if whatsapp_id in self._pending:
+            return self._pending[whatsapp_id]
+        if whatsapp_id in self._flushing:
+            return self._flushing[whatsapp_id][0]
+        return None
+
+    def get(self, whatsapp_id):
+        vumi_id = self._get_local(whatsapp_id)
+        if vumi_id is not None:
+            return defer.succeed(vumi_id)
+        d = self._read(whatsapp_id)
+        d.addCallback(self._cache_result, whatsapp_id, self.clock.seconds())
+        return d
+
+    def get_many(self, whatsapp_ids):
+        '''Returns a deferred that fires with a dict of the Vumi ids of
+        those of ``whatsapp_ids`` that are known. Ids not held locally are
+        all looked up in Redis together.'''
+        found = {}
+        missing = []
+        for whatsapp_id in whatsapp_ids:
+            vumi_id = self._get_local(whatsapp_id)
+            if vumi_id is not None:
+                found[whatsapp_id] = vumi_id
+            else:
+                missing.append(whatsapp_id)
+        if not missing:
+            return defer.succeed(found)
+
+        def got(vumi_ids):
+            self.metrics.record(
+                'message_ids.get_latency', self.clock.seconds() - start)
+            for whatsapp_id, vumi_id in zip(missing, vumi_ids):
+                if vumi_id is not None:
+                    self.cache.set(whatsapp_id, vumi_id)
+                    found[whatsapp_id] = vumi_id
+            return found
+
+        start = self.clock.seconds()
+        # Issued back to back on the same connection, so the lookups are
+        # pipelined rather than each waiting for a round trip.
+        d = defer.gatherResults(
+            [self._read(whatsapp_id) for whatsapp_id in missing],
+            consumeErrors=True)
+        return d.addCallback(got)
+
+    def _cache_result(self, vumi_id, whatsapp_id, start):
+        self.metrics.record(
+            'message_ids.get_latency', self.clock.seconds() - start)
+        if vumi_id is not None:
+            self.cache.set(whatsapp_id, vumi_id)
+        return vumi_id
+
+    def delete(self, whatsapp_id):
+        self.cache.delete(whatsapp_id)
+        self._pending.pop(whatsapp_id, None)
+        if whatsapp_id in self._flushing:
+            # The write is already on its way, so delete once it has landed.
+            d = when_done(self._flushing[whatsapp_id][1])
+            return d.addCallback(lambda _: self._remove(whatsapp_id))
+        return self._remove(whatsapp_id)
+
+    def delete_many(self, whatsapp_ids):
+        return defer.gatherResults(
+            [self.delete(whatsapp_id) for whatsapp_id in whatsapp_ids],
+            consumeErrors=True)
+
+    def _write_pending(self):
+        batch, self._pending = self._pending, {}
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        start = self.clock.seconds()
+        done = self._track(defer.Deferred())
+        for whatsapp_id, vumi_id in batch.iteritems():
+            self._flushing[whatsapp_id] = (vumi_id, done)
+
+        def written(r):
+            for whatsapp_id in batch:
+                if self._flushing.get(whatsapp_id, (None, None))[1] is done:
+                    del self._flushing[whatsapp_id]
+            self.metrics.incr('message_ids.flushes')
+            self.metrics.record('message_ids.batch_size', len(batch))
+            self.metrics.record(
+                'message_ids.flush_latency', self.clock.seconds() - start)
+            done.callback(None)
+            return r
+
+        # The writes are issued back to back on the same connection, so they
+        # are pipelined rather than each waiting for a round trip.
+        d = defer.gatherResults(self._write(batch), consumeErrors=True)
+        d.addBoth(written)
+        d.addErrback(log.err, 'Failed to write message id mappings')
+        return d
+
+    # How mappings are laid out in Redis: one key per mapping, each with its
+    # own expiry.
+
+    def _read(self, whatsapp_id):
+        return self.redis.get(whatsapp_id)
+
+    def _write(self, batch):
+        '''Starts writing ``batch`` and returns a list of deferreds for the
+        writes.'''
+        return [
+            self.redis.setex(whatsapp_id, self.ttl, vumi_id)
+            for whatsapp_id, vumi_id in batch.iteritems()]
+
+    def _remove(self, whatsapp_id):
+        return self.redis.delete(whatsapp_id)
+
+
+# The ids yowsup gives messages: the time they were made and a counter.
+WHATSAPP_ID = re.compile(r'^(\d{1,10})-(\d{1,10})$')
+PACKED = '\x01'
+
+
+def whatsapp_id_time(whatsapp_id):
+    '''The time (in seconds) a WhatsApp id made by yowsup was made at, or
+    None for any other id.'''
+    match = WHATSAPP_ID.match(whatsapp_id)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def pack_whatsapp_id(whatsapp_id):
+    '''Packs a WhatsApp id made by yowsup into 9 bytes. Other ids are left
+    as they are.'''
+    match = WHATSAPP_ID.match(whatsapp_id)
+    if match is not None:
+        made, count = int(match.group(1)), int(match.group(2))
+        if made < 2 ** 32 and count < 2 ** 32:
+            return PACKED + struct.pack('>II', made, count)
+    return whatsapp_id.encode('utf-8')
+
+
+def pack_vumi_id(vumi_id):
+    '''Packs a Vumi message id (a hex UUID) into 17 bytes. Other ids are
+    left as they are.'''
+    vumi_id = vumi_id.encode('utf-8')
+    if len(vumi_id) == 32:
+        try:
+            packed = binascii.unhexlify(vumi_id)
+        except TypeError:
+            return vumi_id
+        if binascii.hexlify(packed) == vumi_id:
+            return PACKED + packed
+    return vumi_id
+
+
+def unpack_vumi_id(value):
+    if value is None:
+        return None
+    if len(value) == 17 and value.startswith(PACKED):
+        return binascii.hexlify(value[1:])
+    return value
+
+
+class BucketedMessageIdStore(MessageIdStore):
+    '''A ``MessageIdStore`` that keeps mappings in one Redis hash for every
+    ``bucket_size`` seconds instead of a key each.
+
+    A mapping goes in the bucket for the time its WhatsApp id was made (or
+    when it was added, for ids not made by yowsup). Each bucket expires as a
+    whole ``ttl`` seconds after its end, so there is one expiry per bucket
+    rather than per mapping. Ids are packed to a few bytes each (see
+    ``pack_whatsapp_id`` and ``pack_vumi_id``). A lookup only needs the
+    bucket its id's time falls in. Ids that don't carry a time are looked
+    for in every bucket that could still hold them.
+
+    Unless ``read_old_keys`` is False, mappings not found in a bucket are
+    looked for in the one key per mapping layout of ``MessageIdStore`` too,
+    until ``ttl`` seconds after the store was made. After that, any mappings
+    written that way have expired.
+    '''
+
+    def __init__(self, redis, ttl, bucket_size=3600, read_old_keys=True,
+                 **kw):
+        super(BucketedMessageIdStore, self).__init__(redis, ttl, **kw)
+        self.bucket_size = bucket_size
+        self._old_keys_until = None
+        if read_old_keys:
+            self._old_keys_until = self.clock.seconds() + ttl
+
+    def bucket_key(self, bucket):
+        return 'ids:%d' % (bucket,)
+
+    def _buckets(self, whatsapp_id):
+        '''The buckets a mapping for ``whatsapp_id`` could be in, newest
+        first.'''
+        made = whatsapp_id_time(whatsapp_id)
+        if made is not None:
+            return [made // self.bucket_size]
+        now = int(self.clock.seconds()) // self.bucket_size
+        oldest = int(self.clock.seconds() - self.ttl) // self.bucket_size
+        return range(now, oldest - 1, -1)
+
+    def _reading_old_keys(self):
+        return (
+            self._old_keys_until is not None and
+            self.clock.seconds() < self._old_keys_until)
+
+    def _read(self, whatsapp_id):
+        field = pack_whatsapp_id(whatsapp_id)
+        d = defer.gatherResults([
+            self.redis.hget(self.bucket_key(bucket), field)
+            for bucket in self._buckets(whatsapp_id)], consumeErrors=True)
+
+        def found(values):
+            for value in values:
+                if value is not None:
+                    return unpack_vumi_id(value)
+            if self._reading_old_keys():
+                self.metrics.incr('message_ids.old_key_reads')
+                return self.redis.get(whatsapp_id)
+            return None
+
+        return d.addCallback(found)
+
+    def _write(self, batch):
+        now = self.clock.seconds()
+        buckets = {}
+        for whatsapp_id, vumi_id in batch.iteritems():
+            made = whatsapp_id_time(whatsapp_id)
+            bucket = int(now if made is None else made) // self.bucket_size
+            buckets.setdefault(bucket, {})[
+                pack_whatsapp_id(whatsapp_id)] = pack_vumi_id(vumi_id)
+        ds = []
+        for bucket, fields in buckets.iteritems():
+            key = self.bucket_key(bucket)
+            expires = (bucket + 1) * self.bucket_size + self.ttl
+            ds.append(self.redis.hmset(key, fields))
+            ds.append(self.redis.expire(key, max(1, int(expires - now))))
+        return ds
+
+    def _remove(self, whatsapp_id):
+        field = pack_whatsapp_id(whatsapp_id)
+        ds = [
+            self.redis.hdel(self.bucket_key(bucket), field)
+            for bucket in self._buckets(whatsapp_id)]
+        if self._reading_old_keys():
+            ds.append(self.redis.delete(whatsapp_id))
+        return defer.gatherResults(ds, consumeErrors=True)
@@ -0,0 +1,134 @@
+# -*- test-case-name: vxyowsup.tests.test_metrics -*-
+import threading
+from collections import OrderedDict, deque
+
+from twisted.internet import reactor
+
+
+class Histogram(object):
+    """ Summary of observed values (count, total, min, max and percentiles
+    of the most recent values). Values may be recorded from any thread. """
+
+    SAMPLES = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.recent = deque(maxlen=self.SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            self.recent.append(value)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    def percentile(self, pct):
+        '''The ``pct`` percentile of the most recent ``SAMPLES`` values.'''
+        with self._lock:
+            # Sorting the deque itself would fail if a value was recorded
+            # meanwhile.
+            values = list(self.recent)
+        if not values:
+            return None
+        values.sort()
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class Metrics(object):
+    """ Counters and histograms for the transport's hot paths.
+
+    Safe to update from the stack threads as well as the reactor thread.
+    Gauges registered with ``poll`` are only read when metrics are exported.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.polled = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def gauge(self, name):
+        if name in self.polled:
+            return self.polled[name]()
+        return self.gauges.get(name)
+
+    def poll(self, name, func):
+        self.polled[name] = func
+
+    def all_gauges(self):
+        gauges = dict(self.gauges)
+        for name, func in self.polled.items():
+            gauges[name] = func()
+        return gauges
+
+    def record(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+        histogram.record(value)
+
+    def histogram(self, name):
+        return self.histograms.get(name) or Histogram()
+
+
+class StageTimer(object):
+    """ Times how long messages take from one stage of the transport to
+    another, recording each time in a histogram of ``metrics``.
+
+    Messages are identified by any key both stages know. Only the most
+    recent ``max_size`` starts are kept, so messages that never reach the
+    end of a stage don't pile up.
+    """
+
+    def __init__(self, metrics, max_size=10000, clock=reactor):
+        self.metrics = metrics
+        self.max_size = max_size
+        self.clock = clock
+        self._started = OrderedDict()
+
+    def __len__(self):
+        return len(self._started)
+
+    def start(self, key):
+        self._started.pop(key, None)
+        self._started[key] = self.clock.seconds()
+        while len(self._started) > self.max_size:
+            self._started.popitem(last=False)
+
+    def stop(self, name, key, keep=False):
+        '''Records the time since ``key`` was started as ``name``, and
+        returns it (or None if ``key`` wasn't started). The start is
+        forgotten unless ``keep`` is set.'''
+        if keep:
+            started = self._started.get(key)
+        else:
+            started = self._started.pop(key, None)
+        if started is not None:
+            elapsed = self.clock.seconds() - started
+            self.metrics.record(name, elapsed)
+            return elapsed
@@ -0,0 +1,119 @@
+# -*- test-case-name: vxyowsup.tests.test_metrics_export -*-
+'''Exports ``Metrics`` through Vumi's metrics publisher and as Prometheus
+style text.'''
+import re
+
+from twisted.web.resource import Resource
+
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, SUM, AVG, MAX, LAST)
+
+
+QUANTILES = (50, 95, 99)
+
+
+class MetricsPublisher(MetricManager):
+    '''Publishes what has changed in ``metrics`` since the last publish
+    every ``publish_interval`` seconds.
+
+    Counters are published as how much they went up by (summed), gauges as
+    their current value and each histogram as ``<name>.count`` (values
+    recorded since the last publish), ``<name>.avg`` (their mean),
+    ``<name>.max`` (the largest value ever recorded) and ``<name>.p50``,
+    ``.p95`` and ``.p99`` (percentiles of the most recent values).
+    '''
+
+    def __init__(self, metrics, prefix, publish_interval=5, on_publish=None,
+                 publisher=None):
+        MetricManager.__init__(
+            self, prefix, publish_interval=publish_interval,
+            on_publish=on_publish, publisher=publisher)
+        self.metrics = metrics
+        self._counters = {}
+        # name -> (count, total) at the last publish
+        self._histograms = {}
+        self._metric_objects = {}
+
+    def publish_metrics(self):
+        self.collect()
+        MetricManager.publish_metrics(self)
+
+    def _metric(self, name, aggregator):
+        metric = self._metric_objects.get(name)
+        if metric is None:
+            metric = self._metric_objects[name] = Metric(name, [aggregator])
+        return metric
+
+    def collect(self):
+        '''Queues a value for every metric that has one to publish.'''
+        for name, value in self.metrics.counters.items():
+            delta = value - self._counters.get(name, 0)
+            self._counters[name] = value
+            if delta:
+                self.oneshot(self._metric(name, SUM), delta)
+
+        for name, value in self.metrics.all_gauges().iteritems():
+            if value is not None:
+                self.oneshot(self._metric(name, LAST), value)
+
+        for name, histogram in self.metrics.histograms.items():
+            count, total = self._histograms.get(name, (0, 0))
+            self._histograms[name] = (histogram.count, histogram.total)
+            count = histogram.count - count
+            if not count:
+                continue
+            total = histogram.total - total
+            self.oneshot(self._metric(name + '.count', SUM), count)
+            self.oneshot(
+                self._metric(name + '.avg', AVG), float(total) / count)
+            self.oneshot(self._metric(name + '.max', MAX), histogram.max)
+            for pct in QUANTILES:
+                self.oneshot(
+                    self._metric('%s.p%d' % (name, pct), LAST),
+                    histogram.percentile(pct))
+
+
+def prometheus_name(namespace, name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '%s_%s' % (namespace, name))
+
+
+def render_prometheus(metrics, namespace='vxyowsup'):
+    '''Renders ``metrics`` in the Prometheus text exposition format, with
+    histograms as summaries of their most recent values.'''
+    lines = []
+
+    def add(kind, name, samples):
+        name = prometheus_name(namespace, name)
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s %s' % (name, suffix, labels, value))
+
+    for name, value in sorted(metrics.counters.items()):
+        add('counter', name, [('', '', value)])
+    for name, value in sorted(metrics.all_gauges().iteritems()):
+        if value is not None:
+            add('gauge', name, [('', '', value)])
+    for name, histogram in sorted(metrics.histograms.items()):
+        samples = [
+            ('', '{quantile="%s"}' % (pct / 100.0,),
+             histogram.percentile(pct))
+            for pct in QUANTILES]
+        samples.append(('_sum', '', histogram.total))
+        samples.append(('_count', '', histogram.count))
+        add('summary', name, samples)
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusResource(Resource):
+    ''' Serves ``metrics`` for Prometheus to scrape. '''
+
+    isLeaf = True
+
+    def __init__(self, metrics, namespace='vxyowsup'):
+        Resource.__init__(self)
+        self.metrics = metrics
+        self.namespace = namespace
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return render_prometheus(self.metrics, self.namespace)
@@ -0,0 +1,388 @@
+# -*- test-case-name: vxyowsup.tests.test_process_stack -*-
+'''Runs a yowsup stack in a child process.
+
+The transport side (``ProcessStackClient``) and the child (``main``) exchange
+length-prefixed pickled records over the child's stdin and stdout. Outbound
+entities go down as ``('send', entity)`` and the calls ``WhatsAppInterface``
+would make on the transport come back up as ``('call', name, args, kw)``.
+'''
+import cPickle as pickle
+import os
+import Queue
+import struct
+import sys
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ProcessDone
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python.reflect import namedAny
+
+from vxyowsup.event_log import EventLog
+from vxyowsup.metrics import Metrics
+
+
+HEADER = struct.Struct('>I')
+
+# Worked out at import time, in case the working directory changes later.
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def encode_record(record):
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+class RecordDecoder(object):
+    ''' Splits a stream of bytes back into records. '''
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        self._buffer += data
+        records = []
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(self._buffer, offset)
+            end = offset + HEADER.size + size
+            if len(self._buffer) < end:
+                break
+            records.append(
+                pickle.loads(self._buffer[offset + HEADER.size:end]))
+            offset = end
+        self._buffer = self._buffer[offset:]
+        return records
+
+
+class StackProcessProtocol(ProcessProtocol):
+
+    def __init__(self, client):
+        self.client = client
+        self.decoder = RecordDecoder()
+
+    def outReceived(self, data):
+        for record in self.decoder.feed(data):
+            self.client.handle_record(record)
+
+    def errReceived(self, data):
+        for line in data.rstrip().split('\n'):
+            self.client.transport.log.info(
+                '[%s] %s' % (self.client.msisdn, line))
+
+    def processEnded(self, reason):
+        self.client.process_ended(reason)
+
+
+class ProcessStackClient(object):
+    '''Stands in for ``StackClient`` in the transport, running the stack
+    itself in a child process.
+
+    If the child ends once it has started, other than by being stopped, the
+    transport is told the account has disconnected, and the next attempt to
+    reconnect starts a new child from the account's state as it was last
+    written to redis. If the first child fails to start, ``connect_d`` fails.
+    '''
+
+    def __init__(self, credentials, transport, setup=None,
+                 axolotl_state=None, login_state=None):
+        self.credentials = credentials
+        self.transport = transport
+        self.setup = setup
+        self.axolotl_state = axolotl_state
+        self.login_state = login_state
+        self.msisdn = "+" + credentials[0]
+        self.connect_d = defer.Deferred()
+        self.ended_d = defer.Deferred()
+        self.protocol = None
+        self.stopping = False
+
+    def start(self, thread_pool=None):
+        '''Starts the child. Returns a deferred that fires once the client
+        has been stopped and its child has ended.'''
+        self.spawn()
+        return self.ended_d
+
+    def spawn(self):
+        self.protocol = StackProcessProtocol(self)
+        # The child should import the same code we did.
+        path = os.pathsep.join([PACKAGE_ROOT] + sys.path)
+        env = dict(os.environ, PYTHONPATH=path)
+        reactor.spawnProcess(
+            self.protocol, sys.executable,
+            [sys.executable, '-m', 'vxyowsup.process_stack'], env=env)
+        self.write_record(('start', {
+            'credentials': self.credentials,
+            'echo_to': self.transport.config.echo_to,
+            'inbound_receipts': self.transport.config.inbound_receipts,
+            'inbound_receipt_type': self.transport.config.inbound_receipt_type,
+            'max_inbound_in_flight':
+                self.transport.config.max_inbound_in_flight,
+            'inbound_receipt_batch_interval':
+                self.transport.config.inbound_receipt_batch_interval,
+            'inbound_receipt_batch_size':
+                self.transport.config.inbound_receipt_batch_size,
+            'media': self.transport.config.media,
+            'capture_dir': self.transport.config.capture_dir,
+            'log_level': self.transport.config.log_level,
+            'log_sample_rates': self.transport.config.log_sample_rates,
+            'transport_type': self.transport.transport_type,
+            'setup': self.setup,
+            'axolotl_state': self.axolotl_state,
+            'login_state': self.login_state,
+        }))
+
+    def process_ended(self, reason):
+        self.protocol = None
+        if not self.connect_d.called:
+            self.connect_d.errback(reason)
+        elif not self.stopping:
+            self.transport.log.error(
+                'Stack process for %s ended: %s' % (
+                    self.msisdn, reason.getErrorMessage()))
+            self.transport.metrics.incr('stack.process_ended')
+            # Queued behind the calls the child made before it ended.
+            self.transport.reactor_queue.call(
+                'handle_disconnected', 'Stack process ended',
+                msisdn=self.msisdn)
+            return
+        if reason.check(ProcessDone):
+            self.ended_d.callback(None)
+        else:
+            self.ended_d.errback(reason)
+
+    def write_record(self, record):
+        if self.protocol is None:
+            # The child has ended. Messages sent meanwhile are sent again
+            # once the next one connects.
+            return
+        self.protocol.transport.write(encode_record(record))
+
+    def handle_record(self, record):
+        kind = record[0]
+        if kind == 'call':
+            _, name, args, kw = record
+            self.transport.reactor_queue.call(name, *args, **kw)
+        elif kind == 'started':
+            if not self.connect_d.called:
+                self.connect_d.callback(None)
+        elif kind == 'log':
+            _, level, msg = record
+            getattr(self.transport.log, level)(msg)
+
+    def send_to_stack(self, msg):
+        self.write_record(('send', msg))
+
+    def reconnect(self):
+        if self.protocol is not None:
+            self.write_record(('reconnect',))
+            return
+        d = self.transport.load_account_state(self.msisdn)
+        d.addCallback(self._respawn)
+        d.addErrback(self.transport.log.error)
+
+    def _respawn(self, states):
+        if self.stopping or self.protocol is not None:
+            return
+        self.refresh_state(*states)
+        self.transport.log.info(
+            'Starting a new stack process for %s' % (self.msisdn,))
+        self.spawn()
+
+    def disconnect(self):
+        self.write_record(('disconnect',))
+
+    def refresh_state(self, axolotl_state=None, login_state=None):
+        '''Replaces the account's axolotl and login state with what was
+        loaded from redis, in the child if it is running and for when it is
+        next started.'''
+        if axolotl_state is not None:
+            self.axolotl_state = axolotl_state
+        if login_state is not None:
+            self.login_state = login_state
+        if self.protocol is not None:
+            self.write_record(('refresh_state', axolotl_state, login_state))
+
+    def inbound_done(self, receipt=None):
+        self.write_record(('inbound_done', receipt))
+
+    def request_upload(self, entity):
+        self.write_record(('request_upload', entity))
+
+    def sync_contacts(self, entity):
+        self.write_record(('sync_contacts', entity))
+
+    def client_stop(self):
+        self.transport.log.info("Stopping client ...")
+        self.stopping = True
+        if self.protocol is not None:
+            self.write_record(('stop',))
+            self.protocol.transport.closeStdin()
+        elif not self.ended_d.called:
+            self.ended_d.callback(None)
+
+
+# The rest of this module runs in the child process.
+
+
+class RecordWriter(object):
+    '''Writes records from any thread. Records that pile up while a write is
+    in progress go out together in the next one.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, record):
+        self.pending.put(encode_record(record))
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            chunks = [self.pending.get()]
+            while not self.pending.empty():
+                chunks.append(self.pending.get())
+            closed = chunks[-1] is None
+            if closed:
+                chunks.pop()
+            self.stream.write(''.join(chunks))
+            self.stream.flush()
+            if closed:
+                return
+
+
+def read_record(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    return pickle.loads(stream.read(size))
+
+
+class ChildConfig(object):
+    def __init__(self, options):
+        self.echo_to = options['echo_to']
+        self.inbound_receipts = options['inbound_receipts']
+        self.inbound_receipt_type = options['inbound_receipt_type']
+        self.max_inbound_in_flight = options['max_inbound_in_flight']
+        self.inbound_receipt_batch_interval = options[
+            'inbound_receipt_batch_interval']
+        self.inbound_receipt_batch_size = options['inbound_receipt_batch_size']
+        self.media = options['media']
+        self.capture_dir = options['capture_dir']
+
+
+class ChildLog(object):
+    ''' Forwards log messages to the transport's log. '''
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def _log(self, level, msg, *args, **kw):
+        if not isinstance(msg, basestring):
+            msg = str(msg)
+        self.writer.write(('log', level, msg))
+
+    def debug(self, msg, *args, **kw):
+        self._log('debug', msg)
+
+    def info(self, msg, *args, **kw):
+        self._log('info', msg)
+
+    def warning(self, msg, *args, **kw):
+        self._log('warning', msg)
+
+    def err(self, msg=None, *args, **kw):
+        self._log('error', msg)
+
+    msg = info
+    error = err
+
+
+class ChildReactorQueue(object):
+    ''' Sends calls meant for the transport up to the parent process. '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.metrics = Metrics()
+
+    def call(self, name, *args, **kw):
+        self.writer.write(('call', name, args, kw))
+
+
+class ChildTransport(object):
+    ''' What ``WhatsAppInterface`` sees of the transport in a child. '''
+
+    def __init__(self, options, writer):
+        self.config = ChildConfig(options)
+        self.transport_type = options['transport_type']
+        self.log = ChildLog(writer)
+        self.event_log = EventLog(
+            self.log, options['log_level'], options['log_sample_rates'])
+        self.reactor_queue = ChildReactorQueue(writer)
+        # Only kept so the stack can record its metrics, which stay here.
+        self.metrics = self.reactor_queue.metrics
+
+
+def read_commands(stream, client):
+    while True:
+        record = read_record(stream)
+        if record is None or record[0] == 'stop':
+            break
+        if record[0] == 'send':
+            client.send_to_stack(record[1])
+        elif record[0] == 'reconnect':
+            client.reconnect()
+        elif record[0] == 'refresh_state':
+            client.refresh_state(record[1], record[2])
+        elif record[0] == 'disconnect':
+            client.disconnect()
+        elif record[0] == 'inbound_done':
+            client.inbound_done(record[1])
+        elif record[0] == 'request_upload':
+            client.request_upload(record[1])
+        elif record[0] == 'sync_contacts':
+            client.sync_contacts(record[1])
+    client.client_stop()
+
+
+def main():
+    # Anything printed by yowsup must not end up in the record stream, so
+    # records get a private copy of stdout and fd 1 goes to stderr.
+    out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    stdin = os.fdopen(0, 'rb')
+    writer = RecordWriter(out)
+
+    _, options = read_record(stdin)
+    if options['setup']:
+        namedAny(options['setup'])()
+
+    # Imported here because vxyowsup.whatsapp imports this module.
+    from vxyowsup.whatsapp import StackClient
+
+    class ChildStackClient(StackClient):
+        def started(self):
+            writer.write(('started',))
+
+    transport = ChildTransport(options, writer)
+    client = ChildStackClient(
+        tuple(options['credentials']), transport, options['axolotl_state'],
+        options['login_state'])
+    reader = threading.Thread(target=read_commands, args=(stdin, client))
+    reader.daemon = True
+    reader.start()
+    try:
+        client.client_start()
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
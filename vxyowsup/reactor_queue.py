@@ -0,0 +1,75 @@
+# -*- test-case-name: vxyowsup.tests.test_reactor_queue -*-
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor
+
+from vumi import log
+
+from vxyowsup.metrics import Metrics
+
+
+class ReactorQueue(object):
+    '''Hands method calls from the yowsup loop thread to the reactor thread.
+
+    Calls are queued in order and the reactor is only woken once for however
+    many calls arrive before it gets around to draining the queue, instead of
+    once per call. Calls are made on ``target`` in the order they were queued,
+    so events for a conversation are never reordered.
+    '''
+
+    def __init__(self, target, metrics=None, reactor=reactor):
+        self.target = target
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.reactor = reactor
+        self._queue = deque()
+        self._wakeup_pending = False
+        self._wakeup_at = None
+        # Called with the name and the seconds taken for each call, when
+        # profiling.
+        self.timer = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def call(self, name, *args, **kw):
+        '''Queues ``target.<name>(*args, **kw)`` to be called in the reactor
+        thread.'''
+        # deque.append() and popleft() are atomic, and drain() clears the
+        # flag before it starts emptying the queue, so at worst two threads
+        # racing here schedule an extra (empty) drain.
+        self._queue.append((name, args, kw))
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._wakeup_at = time.time()
+            self.reactor.callFromThread(self.drain)
+
+    def drain(self):
+        '''Makes all queued calls. Must be called in the reactor thread.'''
+        woken_at = self._wakeup_at
+        self._wakeup_pending = False
+        if woken_at is not None:
+            self.metrics.record(
+                'reactor_queue.hop_delay', time.time() - woken_at)
+        batch_size = 0
+        while self._queue:
+            name, args, kw = self._queue.popleft()
+            batch_size += 1
+            if self.timer is None:
+                self._call(name, args, kw)
+            else:
+                started = time.time()
+                self._call(name, args, kw)
+                self.timer(name, time.time() - started)
+        self.metrics.incr('reactor_queue.wakeups')
+        self.metrics.record('reactor_queue.batch_size', batch_size)
+
+    def _call(self, name, args, kw):
+        try:
+            result = getattr(self.target, name)(*args, **kw)
+        except Exception:
+            log.err(None, 'Error calling %s from reactor queue' % (name,))
+            return
+        if isinstance(result, defer.Deferred):
+            result.addErrback(
+                log.err, 'Error calling %s from reactor queue' % (name,))
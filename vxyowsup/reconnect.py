@@ -0,0 +1,94 @@
+# -*- test-case-name: vxyowsup.tests.test_reconnect -*-
+import random
+
+from twisted.internet import reactor
+
+from vxyowsup.metrics import Metrics
+
+
+class Reconnector(object):
+    '''Decides when a stack should try to connect again after losing its
+    connection.
+
+    The first attempt is made after about ``delay`` seconds and each failure
+    after that doubles the wait, up to ``max_delay``. Up to ``jitter`` of each
+    wait (as a fraction) is taken off at random, so stacks that drop together
+    don't all come back at once. A connection only counts as a success once it
+    has stayed up for ``stable_after`` seconds, so a flapping connection keeps
+    backing off.
+
+    After ``failure_threshold`` failures in a row the circuit opens: attempts
+    are only made every ``max_delay`` seconds until a connection succeeds.
+    Until that connection proves stable, one more failure opens it again.
+    '''
+
+    def __init__(self, reconnect, delay=1, max_delay=300, jitter=0.5,
+                 failure_threshold=10, stable_after=60, metrics=None,
+                 clock=reactor, random=random.random):
+        self.reconnect = reconnect
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.stable_after = stable_after
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+        self.random = random
+
+        self.failures = 0
+        self.connected_at = None
+        self.down_since = None
+        self.circuit_open = False
+        self.stopped = False
+        self._attempt_call = None
+
+    def next_delay(self):
+        if self.circuit_open:
+            delay = self.max_delay
+        else:
+            delay = min(self.max_delay, self.delay * 2 ** (self.failures - 1))
+        return delay * (1 - self.jitter * self.random())
+
+    def connected(self):
+        self._cancel()
+        self.circuit_open = False
+        now = self.clock.seconds()
+        if self.down_since is not None:
+            self.metrics.record('reconnect.downtime', now - self.down_since)
+            self.down_since = None
+        self.connected_at = now
+
+    def disconnected(self):
+        '''Schedules the next attempt to connect. Returns the delay before
+        it, or ``None`` if we've stopped.'''
+        if self.stopped:
+            return None
+        now = self.clock.seconds()
+        if self.down_since is None:
+            self.down_since = now
+            self.metrics.incr('reconnect.disconnects')
+        if (self.connected_at is not None and
+                now - self.connected_at >= self.stable_after):
+            self.failures = 0
+        self.connected_at = None
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.circuit_open = True
+        self._cancel()
+        delay = self.next_delay()
+        self._attempt_call = self.clock.callLater(delay, self._attempt)
+        return delay
+
+    def _attempt(self):
+        self._attempt_call = None
+        self.metrics.incr('reconnect.attempts')
+        self.reconnect()
+
+    def _cancel(self):
+        if self._attempt_call is not None and self._attempt_call.active():
+            self._attempt_call.cancel()
+        self._attempt_call = None
+
+    def stop(self):
+        self.stopped = True
+        self._cancel()
@@ -0,0 +1,61 @@
+# -*- test-case-name: vxyowsup.tests.test_routing -*-
+import itertools
+import zlib
+
+
+class RoutingError(Exception):
+    """ Raised for an unknown routing strategy. """
+
+
+class StackRouter(object):
+    '''Chooses which of the transport's stack clients sends a message.
+
+    Messages sent from one of our own numbers always go out on that number.
+    Other messages are routed by ``strategy`` to one of the clients that are
+    connected (or to any client, if none are):
+
+    ``round_robin``: each client in turn.
+    ``least_queued``: the client with the fewest messages waiting to be sent.
+    ``sticky``: always the same client for a given recipient while the
+    same clients are connected, so a conversation stays on one number.
+
+    A message sent to several recipients is routed once for each of them,
+    by passing each one as ``to_addr``.
+    '''
+
+    STRATEGIES = ('round_robin', 'least_queued', 'sticky')
+
+    def __init__(self, clients, strategy='sticky'):
+        if strategy not in self.STRATEGIES:
+            raise RoutingError('Unknown routing strategy: %r' % (strategy,))
+        self.clients = list(clients)
+        self.strategy = strategy
+        self.by_msisdn = dict(
+            (client.msisdn, client) for client in self.clients)
+        self._cycle = itertools.cycle(self.clients)
+
+    def route(self, message, to_addr=None):
+        if to_addr is None:
+            to_addr = message['to_addr']
+        client = self.by_msisdn.get(message['from_addr'])
+        if client is not None:
+            return client
+        if len(self.clients) == 1:
+            return self.clients[0]
+        # A client's scheduler is held while it is disconnected.
+        connected = [c for c in self.clients if not c.scheduler.held]
+        return getattr(self, 'route_%s' % (self.strategy,))(
+            to_addr, connected or self.clients)
+
+    def route_round_robin(self, to_addr, clients):
+        for client in self._cycle:
+            if client in clients:
+                return client
+
+    def route_least_queued(self, to_addr, clients):
+        return min(clients, key=lambda client: client.scheduler.queued)
+
+    def route_sticky(self, to_addr, clients):
+        # crc32 rather than hash(), so the choice survives a restart.
+        index = zlib.crc32(to_addr.encode('utf-8')) & 0xffffffff
+        return clients[index % len(clients)]
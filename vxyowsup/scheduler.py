@@ -0,0 +1,332 @@
+# -*- test-case-name: vxyowsup.tests.test_scheduler -*-
+import heapq
+import itertools
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+
+from vxyowsup.metrics import Metrics
+
+
+class TokenBucket(object):
+    '''Allows ``rate`` operations per second on average, with bursts of up to
+    ``burst`` operations. A ``rate`` of zero means no limit.'''
+
+    def __init__(self, rate, burst, clock=reactor):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        return self.tokens >= self.burst
+
+    def delay(self):
+        '''Seconds until a token is available.'''
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RecipientLane(object):
+    '''The messages waiting in one of the scheduler's lanes when each
+    recipient has its own rate limit.
+
+    Each recipient's messages are queued separately. Recipients whose next
+    message may be sent now are kept in ``ready``, a heap ordered by when
+    that message was queued, and the rest in ``waiting``, a heap ordered by
+    when they may be sent to again. So finding the next message doesn't
+    look at the messages of recipients that are being throttled.
+
+    ``buckets`` holds the recipients' ``TokenBucket``s, shared by all the
+    lanes. A recipient without one hasn't been sent to lately and may be
+    sent to now.
+    '''
+
+    def __init__(self, buckets, rate, burst, clock=reactor):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.queues = {}
+        self.ready = []
+        self.waiting = []
+        self._length = 0
+        # Messages put back at the front come before any already queued.
+        self._back = itertools.count()
+        self._front = itertools.count(-1, -1)
+
+    def __len__(self):
+        return self._length
+
+    def append(self, item):
+        self._add(item, next(self._back), front=False)
+
+    def appendleft(self, item):
+        self._add(item, next(self._front), front=True)
+
+    def _add(self, item, seq, front):
+        recipient = item[1]
+        queue = self.queues.get(recipient)
+        if queue is None:
+            queue = self.queues[recipient] = deque()
+        if front:
+            queue.appendleft((seq, item))
+        else:
+            queue.append((seq, item))
+        self._length += 1
+        if front or len(queue) == 1:
+            # Any entry for the old first message is left in the heaps, and
+            # skipped once it no longer matches.
+            self._schedule(recipient, queue, self.clock.seconds())
+
+    def _delay(self, recipient):
+        bucket = self.buckets.get(recipient)
+        return bucket.delay() if bucket is not None else 0
+
+    def _schedule(self, recipient, queue, now):
+        seq = queue[0][0]
+        delay = self._delay(recipient)
+        if delay > 0:
+            heapq.heappush(self.waiting, (now + delay, seq, recipient))
+        else:
+            heapq.heappush(self.ready, (seq, recipient))
+
+    def pop_ready(self):
+        '''Takes the first message whose recipient may be sent to now, and
+        returns it and None, or None and the seconds until there will be
+        one.'''
+        now = self.clock.seconds()
+        while self.waiting and self.waiting[0][0] <= now:
+            _, seq, recipient = heapq.heappop(self.waiting)
+            heapq.heappush(self.ready, (seq, recipient))
+        while self.ready:
+            seq, recipient = heapq.heappop(self.ready)
+            queue = self.queues.get(recipient)
+            if not queue or queue[0][0] != seq:
+                continue
+            delay = self._delay(recipient)
+            if delay > 0:
+                heapq.heappush(self.waiting, (now + delay, seq, recipient))
+                continue
+            _, item = queue.popleft()
+            self._length -= 1
+            bucket = self.buckets.get(recipient)
+            if bucket is None:
+                bucket = self.buckets[recipient] = TokenBucket(
+                    self.rate, self.burst, clock=self.clock)
+            bucket.consume()
+            if queue:
+                self._schedule(recipient, queue, now)
+            else:
+                del self.queues[recipient]
+            return item, None
+        if self.waiting:
+            return None, self.waiting[0][0] - now
+        return None, None
+
+
+class OutboundScheduler(object):
+    '''Paces messages handed to ``send``.
+
+    Messages are queued in priority lanes (earlier lanes in ``LANES`` are
+    always served first) and released at no more than ``rate`` per second
+    overall and ``recipient_rate`` per second to any one recipient. Once
+    ``max_queued`` messages are waiting, ``pause`` is called and ``unpause``
+    follows when the queue has drained to half that.
+
+    Messages enqueued with a ``key`` are remembered once sent, until ``done``
+    is called with that key. While the scheduler is held (for instance while
+    the connection is down) nothing is sent, and releasing it puts those
+    unfinished messages back at the front of their lanes, in the order they
+    were first sent. At most ``max_in_flight`` of them are remembered.
+    Everything that piled up meanwhile is then sent at no more than
+    ``drain_rate`` per second, until the queue is empty again.
+    '''
+
+    LANES = ('reply', 'bulk')
+
+    def __init__(self, send, rate=0, burst=1, recipient_rate=0,
+                 recipient_burst=1, max_queued=0, pause=None, unpause=None,
+                 max_in_flight=10000, drain_rate=0, metrics=None,
+                 clock=reactor):
+        self.send = send
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_queued = max_queued
+        self.max_in_flight = max_in_flight
+        self.drain_rate = drain_rate
+        self.pause = pause
+        self.unpause = unpause
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self.drain_bucket = None
+        self.recipient_buckets = {}
+        # A heap of (time, recipient) for each message sent: by then the
+        # recipient's bucket will be full again, and can go if it is idle.
+        self._bucket_expiry = []
+        if recipient_rate > 0:
+            self._bucket_lifetime = (
+                float(max(recipient_burst, 1)) / recipient_rate)
+            self.lanes = dict(
+                (lane, RecipientLane(
+                    self.recipient_buckets, recipient_rate, recipient_burst,
+                    clock=clock))
+                for lane in self.LANES)
+        else:
+            self.lanes = dict((lane, deque()) for lane in self.LANES)
+        self.queued = 0
+        self.paused = False
+        self.held = False
+        self.in_flight = OrderedDict()
+        self._process_call = None
+
+    def enqueue(self, msg, recipient, lane='bulk', key=None):
+        self.lanes[lane].append((msg, recipient, key, self.clock.seconds()))
+        self.queued += 1
+        self.process()
+        if self.max_queued and self.queued >= self.max_queued:
+            self._pause()
+        self.metrics.set('outbound.queue_depth', self.queued)
+
+    def done(self, key):
+        self.in_flight.pop(key, None)
+
+    def hold(self):
+        self.held = True
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        now = self.clock.seconds()
+        while self.in_flight:
+            key, (msg, recipient, lane) = self.in_flight.popitem()
+            self.lanes[lane].appendleft((msg, recipient, key, now))
+            self.queued += 1
+            self.metrics.incr('outbound.resent')
+        if self.queued and self.drain_rate > 0:
+            self.drain_bucket = TokenBucket(
+                self.drain_rate, 1, clock=self.clock)
+        self.process()
+
+    def stop(self):
+        if self._process_call is not None and self._process_call.active():
+            self._process_call.cancel()
+        self._process_call = None
+
+    def _pause(self):
+        if not self.paused:
+            self.paused = True
+            self.metrics.incr('outbound.paused')
+            if self.pause is not None:
+                self.pause()
+
+    def _unpause(self):
+        if self.paused:
+            self.paused = False
+            if self.unpause is not None:
+                self.unpause()
+
+    def _expire_recipient_buckets(self):
+        # A full bucket behaves just like a new one, so there's no need to
+        # keep it once nothing is waiting to be sent to its recipient.
+        now = self.clock.seconds()
+        later = []
+        while self._bucket_expiry and self._bucket_expiry[0][0] <= now:
+            _, recipient = heapq.heappop(self._bucket_expiry)
+            bucket = self.recipient_buckets.get(recipient)
+            if bucket is None or any(
+                    recipient in self.lanes[lane].queues
+                    for lane in self.LANES):
+                # It will be looked at again after its next message is sent.
+                continue
+            if bucket.is_full():
+                del self.recipient_buckets[recipient]
+            else:
+                later.append((now + self._bucket_lifetime, recipient))
+        for entry in later:
+            heapq.heappush(self._bucket_expiry, entry)
+
+    def _next_message(self):
+        '''Takes the first message in the highest priority lane whose
+        recipient isn't being throttled, and returns it and None, or None
+        and the delay until one will be ready.'''
+        delays = []
+        for lane in self.LANES:
+            queue = self.lanes[lane]
+            if not queue:
+                continue
+            if self.recipient_rate <= 0:
+                return (lane,) + queue.popleft(), None
+            item, delay = queue.pop_ready()
+            if item is not None:
+                heapq.heappush(self._bucket_expiry, (
+                    self.clock.seconds() + self._bucket_lifetime, item[1]))
+                return (lane,) + item, None
+            if delay is not None:
+                delays.append(delay)
+        return None, min(delays) if delays else None
+
+    def process(self):
+        # Called directly (on enqueue or release) as well as by the timer,
+        # which is set again below for when the next message is due.
+        if self._process_call is not None and self._process_call.active():
+            self._process_call.cancel()
+        self._process_call = None
+        delay = None
+        while self.queued and not self.held:
+            delay = self.bucket.delay()
+            if self.drain_bucket is not None:
+                delay = max(delay, self.drain_bucket.delay())
+            if delay > 0:
+                break
+            item, delay = self._next_message()
+            if item is None:
+                break
+            lane, msg, recipient, key, queued_at = item
+            self.bucket.consume()
+            if self.drain_bucket is not None:
+                self.drain_bucket.consume()
+            self.queued -= 1
+            self.metrics.record(
+                'outbound.wait_time', self.clock.seconds() - queued_at)
+            if key is not None:
+                self.in_flight[key] = (msg, recipient, lane)
+                if len(self.in_flight) > self.max_in_flight:
+                    self.in_flight.popitem(last=False)
+            self.send(msg)
+
+        if not self.queued:
+            self.drain_bucket = None
+        if self._bucket_expiry:
+            self._expire_recipient_buckets()
+        if self.paused and self.queued <= self.max_queued // 2:
+            self._unpause()
+        self.metrics.set('outbound.queue_depth', self.queued)
+        if self.queued and not self.held and self._process_call is None:
+            self._process_call = self.clock.callLater(delay, self.process)
@@ -0,0 +1,25 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+
+class RedisTestCase(VumiTestCase):
+    '''A test case with a fake Redis (``self.redis``) and a ``Clock``
+    (``self.clock``) that starts at ``start_time``, for testing the things
+    the transport keeps in Redis.'''
+
+    start_time = 1000
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(self.start_time)
+
+    def with_clock(self, cls, *args, **kw):
+        '''Makes a ``cls`` that uses ``self.clock``, unless ``kw`` gives it
+        another clock.'''
+        kw.setdefault('clock', self.clock)
+        return cls(*args, **kw)
@@ -0,0 +1,167 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase
+
+from axolotl.invalidkeyidexception import InvalidKeyIdException
+from axolotl.state.sessionrecord import SessionRecord
+from axolotl.util.keyhelper import KeyHelper
+
+from yowsup.layers import YowLayerEvent
+from yowsup.layers.network import YowNetworkLayer
+
+from vxyowsup.axolotl_store import (
+    AxolotlStateStore, MemoryAxolotlStore, StoredAxolotlLayer)
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestMemoryAxolotlStore(VumiTestCase):
+
+    def setUp(self):
+        self.changes = []
+        self.store = MemoryAxolotlStore(
+            on_change=lambda field, value: self.changes.append(field))
+
+    def test_local_data(self):
+        self.assertEqual(self.store.getLocalRegistrationId(), None)
+        key_pair = KeyHelper.generateIdentityKeyPair()
+        self.store.storeLocalData(1234, key_pair)
+        self.assertEqual(self.changes, [
+            'local:public_key', 'local:private_key', 'local:registration_id'])
+
+        store = MemoryAxolotlStore(self.store.state)
+        self.assertEqual(store.getLocalRegistrationId(), 1234)
+        loaded = store.getIdentityKeyPair()
+        self.assertEqual(
+            loaded.getPublicKey().serialize(),
+            key_pair.getPublicKey().serialize())
+        self.assertEqual(
+            loaded.getPrivateKey().serialize(),
+            key_pair.getPrivateKey().serialize())
+
+    def test_identities(self):
+        key = KeyHelper.generateIdentityKeyPair().getPublicKey()
+        other = KeyHelper.generateIdentityKeyPair().getPublicKey()
+        self.assertTrue(self.store.isTrustedIdentity('27123', key))
+        self.store.saveIdentity('27123', key)
+        self.assertTrue(self.store.isTrustedIdentity('27123', key))
+        self.assertFalse(self.store.isTrustedIdentity('27123', other))
+
+    def test_prekeys(self):
+        prekeys = KeyHelper.generatePreKeys(1, 3)
+        for prekey in prekeys:
+            self.store.storePreKey(prekey.getId(), prekey)
+        self.assertTrue(self.store.containsPreKey(2))
+        self.assertEqual(
+            self.store.loadPreKey(2).serialize(), prekeys[1].serialize())
+        self.assertEqual(
+            [prekey.getId() for prekey in self.store.loadPreKeys()],
+            [1, 2, 3])
+
+        self.store.removePreKey(2)
+        self.assertFalse(self.store.containsPreKey(2))
+        self.assertRaises(InvalidKeyIdException, self.store.loadPreKey, 2)
+        self.assertEqual(self.changes[-1], 'prekey:2')
+        self.assertEqual(self.store.state.get('prekey:2'), None)
+
+    def test_signed_prekeys(self):
+        key_pair = KeyHelper.generateIdentityKeyPair()
+        signed = KeyHelper.generateSignedPreKey(key_pair, 5)
+        self.store.storeSignedPreKey(5, signed)
+        self.assertTrue(self.store.containsSignedPreKey(5))
+        self.assertEqual(
+            self.store.loadSignedPreKey(5).serialize(), signed.serialize())
+        self.assertEqual(len(self.store.loadSignedPreKeys()), 1)
+        self.store.removeSignedPreKey(5)
+        self.assertRaises(
+            InvalidKeyIdException, self.store.loadSignedPreKey, 5)
+
+    def test_sessions(self):
+        self.assertTrue(self.store.loadSession('27123', 1).isFresh())
+        record = SessionRecord()
+        record.getSessionState().setLocalRegistrationId(99)
+        self.store.storeSession('27123', 1, record)
+        self.store.storeSession('27123', 2, SessionRecord())
+        self.assertEqual(self.store.getSubDeviceSessions('27123'), [1, 2])
+        self.assertEqual(self.store.getSubDeviceSessions('2712'), [])
+
+        loaded = self.store.loadSession('27123', 1)
+        self.assertEqual(
+            loaded.getSessionState().getLocalRegistrationId(), 99)
+        # Changing what was loaded doesn't change what is stored.
+        loaded.getSessionState().setLocalRegistrationId(100)
+        self.assertEqual(
+            self.store.loadSession('27123', 1).getSessionState()
+            .getLocalRegistrationId(), 99)
+
+        self.store.deleteAllSessions('27123')
+        self.assertFalse(self.store.containsSession('27123', 1))
+        self.assertEqual(self.store.getSubDeviceSessions('27123'), [])
+
+
+class TestStoredAxolotlLayer(VumiTestCase):
+
+    def test_store_kept_after_disconnect(self):
+        store = MemoryAxolotlStore()
+        layer = StoredAxolotlLayer(store)
+        self.assertTrue(layer.isInitState())
+        store.storeLocalData(1234, KeyHelper.generateIdentityKeyPair())
+        layer.onDisconnected(YowLayerEvent(
+            YowNetworkLayer.EVENT_STATE_DISCONNECTED))
+        self.assertIdentical(layer.store, store)
+        self.assertFalse(layer.isInitState())
+
+
+class TestAxolotlStateStore(RedisTestCase):
+
+    def get_state_store(self, **kw):
+        return self.with_clock(AxolotlStateStore, self.redis, **kw)
+
+    @inlineCallbacks
+    def test_update_is_written_after_interval(self):
+        states = self.get_state_store(batch_interval=0.5)
+        states.update('+27123', 'session:27456:1', 'one')
+        states.update('+27123', 'session:27456:1', 'two')
+        self.assertEqual((yield self.redis.hgetall('axolotl:+27123')), {})
+        self.clock.advance(0.5)
+        yield states.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('axolotl:+27123')),
+            {'session:27456:1': 'two'})
+        self.assertEqual(states.metrics.get('axolotl.flushes'), 1)
+
+    @inlineCallbacks
+    def test_batch_size(self):
+        states = self.get_state_store(batch_size=2)
+        states.update('+27123', 'prekey:1', 'one')
+        states.update('+27123', 'prekey:1', 'one again')
+        self.assertEqual(states.metrics.get('axolotl.flushes'), 0)
+        states.update('+27456', 'prekey:1', 'other')
+        yield states.flush()
+        self.assertEqual(states.metrics.get('axolotl.flushes'), 1)
+        self.assertEqual(
+            (yield self.redis.hgetall('axolotl:+27456')),
+            {'prekey:1': 'other'})
+
+    @inlineCallbacks
+    def test_remove(self):
+        states = self.get_state_store()
+        states.update('+27123', 'prekey:1', 'one')
+        states.update('+27123', 'prekey:2', 'two')
+        yield states.flush()
+        states.update('+27123', 'prekey:1', None)
+        yield states.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('axolotl:+27123')), {'prekey:2': 'two'})
+
+    @inlineCallbacks
+    def test_load_includes_pending_changes(self):
+        states = self.get_state_store()
+        states.update('+27123', 'prekey:1', 'one')
+        states.update('+27123', 'prekey:2', 'two')
+        yield states.flush()
+        states.update('+27123', 'prekey:1', None)
+        states.update('+27123', 'prekey:3', 'three')
+        self.assertEqual(
+            (yield states.load('+27123')),
+            {'prekey:2': 'two', 'prekey:3': 'three'})
+        self.assertEqual((yield states.load('+27456')), {})
@@ -0,0 +1,133 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from yowsup.stacks import YowStackBuilder
+from yowsup.layers.protocol_acks.protocolentities import AckProtocolEntity
+from yowsup.layers.protocol_messages.protocolentities import (
+    TextMessageProtocolEntity)
+from yowsup.layers.protocol_receipts.protocolentities import (
+    IncomingReceiptProtocolEntity)
+from yowsup.layers.interface import YowInterfaceLayer
+from yowsup.layers.axolotl import YowAxolotlLayer
+
+from vxyowsup.bench.dedupe import run_claims
+from vxyowsup.bench.message_ids import run_layout
+from vxyowsup.bench.replay import replay
+from vxyowsup.bench.transport import SCENARIOS, run_scenario
+from vxyowsup.capture import (
+    EVENT, INBOUND, OUTBOUND, CaptureWriter, event_node)
+from vxyowsup.dedupe import SentMessages
+from vxyowsup.message_store import BucketedMessageIdStore, MessageIdStore
+
+
+def restore_stack_builder(test):
+    '''The transport bench patches these for good, so put them back after
+    ``test``.'''
+    for cls, name in [
+            (YowStackBuilder, 'getCoreLayers'),
+            (YowInterfaceLayer, 'getLayerInterface'),
+            (YowAxolotlLayer, 'send')]:
+        if name in cls.__dict__:
+            test.patch(cls, name, cls.__dict__[name])
+        else:
+            test.add_cleanup(delattr, cls, name)
+
+
+class TestTransportBench(VumiTestCase):
+
+    def setUp(self):
+        restore_stack_builder(self)
+
+    @inlineCallbacks
+    def test_scenarios(self):
+        for name in sorted(SCENARIOS):
+            rate, growth, stages = yield run_scenario(reactor, name, 20)
+            self.assertTrue(rate > 0)
+            self.assertEqual(stages.order[0], 'start -> ready')
+            self.assertEqual(stages.count('start -> ready'), 1)
+            for stage in stages.order[1:]:
+                self.assertEqual(stages.count(stage), 20)
+
+
+class TestMessageIdsBench(VumiTestCase):
+
+    @inlineCallbacks
+    def test_layouts(self):
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        mappings = [('1480000000-%d' % i, 'vumi-%d' % i) for i in range(20)]
+        keys, size, memory, _, _ = yield run_layout(
+            redis.sub_manager('keys'),
+            MessageIdStore(redis.sub_manager('keys'), 60), mappings)
+        self.assertEqual((keys, memory), (20, None))
+        bucketed = redis.sub_manager('buckets')
+        keys, bucketed_size, _, _, _ = yield run_layout(
+            bucketed, BucketedMessageIdStore(bucketed, 60), mappings)
+        self.assertEqual(keys, 1)
+        self.assertTrue(bucketed_size < size)
+
+
+class TestDedupeBench(VumiTestCase):
+
+    @inlineCallbacks
+    def test_claims(self):
+        persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield persistence_helper.get_redis_manager()
+        sent = SentMessages(redis, 60, capacity=100)
+        ids = ['vumi-%d' % i for i in range(50)]
+        new, rate, per_claim = yield run_claims(sent, ids)
+        self.assertEqual(new, 50)
+        self.assertTrue(rate > 0 and per_claim > 0)
+        new, _, _ = yield run_claims(sent, ids[:10])
+        self.assertEqual(new, 0)
+
+
+class TestReplayBench(VumiTestCase):
+
+    def setUp(self):
+        restore_stack_builder(self)
+
+    def write_capture(self):
+        path = self.mktemp()
+        times = iter(range(10))
+        writer = CaptureWriter(path, clock=lambda: next(times) / 100.0)
+        jid = '27123@s.whatsapp.net'
+        sent = TextMessageProtocolEntity(
+            'hello', to=jid).toProtocolTreeNode()
+        for direction, node in [
+                (INBOUND, TextMessageProtocolEntity(
+                    'hi', _from=jid).toProtocolTreeNode()),
+                (OUTBOUND, sent),
+                (INBOUND, AckProtocolEntity(
+                    sent['id'], 'message').toProtocolTreeNode()),
+                (INBOUND, IncomingReceiptProtocolEntity(
+                    sent['id'], jid, '0').toProtocolTreeNode()),
+                (EVENT, event_node('disconnected', 'Lost'))]:
+            writer.write(direction, node)
+        writer.close()
+        return path
+
+    @inlineCallbacks
+    def test_replay(self):
+        path = self.write_capture()
+        for profile, heading in [('none', None),
+                                 ('cprofile', 'reactor thread (cProfile):'),
+                                 ('sample', 'samples:')]:
+            report = yield replay(reactor, path, 0, profile)
+            lines = report.splitlines()
+            self.assertTrue('5 records (3 fed)' in lines[0])
+            # Not captured here, the transport's receipt for the inbound
+            # message and ack for the receipt are counted too.
+            self.assertEqual(
+                lines[1], '  sent (replayed/captured): '
+                'ack 1/0 message 1/1 receipt 1/0')
+            callbacks = [line.split()[0] for line in lines[3:] if line]
+            # The ack and receipt came back for the message the replay sent.
+            for name in ['publish_inbound', '_send_ack',
+                         '_send_delivery_report', 'stack:message',
+                         'stack:ack', 'stack:receipt']:
+                self.assertTrue(name in callbacks, name)
+            if heading is not None:
+                self.assertTrue(heading in lines)
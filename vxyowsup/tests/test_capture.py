@@ -0,0 +1,75 @@
+import os
+import stat
+
+from vumi.tests.helpers import VumiTestCase
+
+from yowsup.layers.protocol_acks.protocolentities import AckProtocolEntity
+from yowsup.layers.protocol_messages.protocolentities import (
+    TextMessageProtocolEntity)
+from yowsup.structs import ProtocolTreeNode
+
+from vxyowsup.capture import (
+    EVENT, INBOUND, OUTBOUND, CaptureWriter, event_node, read_capture)
+
+
+class TestCapture(VumiTestCase):
+
+    def write_capture(self, records):
+        path = self.mktemp()
+        times = iter(range(len(records)))
+        writer = CaptureWriter(path, clock=lambda: next(times))
+        for direction, node in records:
+            writer.write(direction, node)
+        writer.close()
+        return path
+
+    def test_round_trip(self):
+        message = TextMessageProtocolEntity(
+            u'h\xe9llo'.encode('utf-8'),
+            _from='27123@s.whatsapp.net').toProtocolTreeNode()
+        ack = AckProtocolEntity('1', 'message').toProtocolTreeNode()
+        event = event_node('disconnected', 'Lost')
+        path = self.write_capture(
+            [(INBOUND, message), (OUTBOUND, ack), (EVENT, event)])
+        self.assertEqual(list(read_capture(path)), [
+            (0, INBOUND, message), (1, OUTBOUND, ack), (2, EVENT, event)])
+        # Much smaller than the nodes' text.
+        with open(path, 'rb') as f:
+            size = len(f.read())
+        self.assertTrue(size < len(str(message) + str(ack) + str(event)))
+
+    def test_cut_short(self):
+        ack = AckProtocolEntity('1', 'message').toProtocolTreeNode()
+        path = self.write_capture([(INBOUND, ack), (INBOUND, ack)])
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-3])
+        self.assertEqual(list(read_capture(path)), [(0, INBOUND, ack)])
+
+    def test_not_a_capture(self):
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write('nonsense')
+        self.assertRaises(ValueError, list, read_capture(path))
+
+    def test_private(self):
+        path = self.mktemp()
+        CaptureWriter(path).close()
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+
+    def test_closed(self):
+        path = self.mktemp()
+        writer = CaptureWriter(path)
+        writer.close()
+        writer.write(EVENT, event_node('connected'))
+        self.assertEqual(writer.records, 0)
+        self.assertEqual(list(read_capture(path)), [])
+
+    def test_none_attributes_left_out(self):
+        node = ProtocolTreeNode('message', {'id': '1', 'participant': None}, [
+            ProtocolTreeNode('body', {'x': None}, data='hi')])
+        path = self.write_capture([(INBOUND, node)])
+        [(_, _, read)] = list(read_capture(path))
+        self.assertEqual(read, ProtocolTreeNode('message', {'id': '1'}, [
+            ProtocolTreeNode('body', {}, data='hi')]))
@@ -0,0 +1,104 @@
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+
+from vxyowsup.contacts import ContactStore, ContactSync
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestContactStore(RedisTestCase):
+
+    def get_store(self, **kw):
+        return self.with_clock(ContactStore, self.redis, 3600, **kw)
+
+    @inlineCallbacks
+    def test_set_and_get(self):
+        store = self.get_store()
+        yield store.set_many({
+            '+27123': '27123@s.whatsapp.net', '+27456': None})
+        self.assertEqual((yield self.redis.get('contact:+27123')),
+                         '1000 27123@s.whatsapp.net')
+        self.assertEqual((yield self.redis.ttl('contact:+27456')), 3600)
+        self.assertEqual(
+            (yield store.get_many(['+27123', '+27456', '+27789'])), {
+                '+27123': ('27123@s.whatsapp.net', 1000),
+                '+27456': (None, 1000),
+            })
+        self.assertEqual(store.metrics.get('contacts.cache.hits'), 2)
+
+    @inlineCallbacks
+    def test_get_from_redis(self):
+        yield self.get_store().set_many({'+27456': None})
+        store = self.get_store()
+        self.assertEqual(
+            (yield store.get_many(['+27456'])), {'+27456': (None, 1000)})
+        self.assertEqual(store.metrics.get('contacts.cache.misses'), 1)
+        # It is now in the local cache.
+        yield store.get_many(['+27456'])
+        self.assertEqual(store.metrics.get('contacts.cache.hits'), 1)
+
+
+class TestContactSync(RedisTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestContactSync, self).setUp()
+        self.store = self.with_clock(ContactStore, self.redis, 3600)
+        self.syncs = []
+
+    def sync(self, msisdns):
+        d = defer.Deferred()
+        self.syncs.append((sorted(msisdns), d))
+        return d
+
+    def lookups_done(self):
+        '''Fires once the lookups in Redis before now have been answered.'''
+        return self.redis.get('nothing')
+
+    def get_sync(self, **kw):
+        return self.with_clock(ContactSync, self.store, self.sync, **kw)
+
+    @inlineCallbacks
+    def test_check_batched(self):
+        contacts = self.get_sync(batch_interval=0.5)
+        d1 = contacts.check(['+27123', '+27456'])
+        d2 = contacts.check(['+27456', '+27789'])
+        yield self.lookups_done()
+        self.assertEqual(self.syncs, [])
+        self.clock.advance(0.5)
+        [(msisdns, sync)] = self.syncs
+        self.assertEqual(msisdns, ['+27123', '+27456', '+27789'])
+        sync.callback({
+            '+27123': '27123@s.whatsapp.net', '+27456': None,
+            '+27789': None})
+        self.assertEqual((yield d1), {
+            '+27123': '27123@s.whatsapp.net', '+27456': None})
+        self.assertEqual((yield d2), {'+27456': None, '+27789': None})
+        self.assertEqual(contacts.metrics.get('contacts.non_users'), 2)
+
+        # Known now, so not synced again.
+        self.assertEqual(
+            (yield contacts.check(['+27123'])),
+            {'+27123': '27123@s.whatsapp.net'})
+        self.assertEqual(len(self.syncs), 1)
+
+    @inlineCallbacks
+    def test_batch_size(self):
+        contacts = self.get_sync(batch_size=2)
+        contacts.check(['+27123', '+27456', '+27789'])
+        yield self.lookups_done()
+        self.assertEqual(len(self.syncs), 1)
+        contacts.flush()
+        self.assertEqual(len(self.syncs), 2)
+
+    @inlineCallbacks
+    def test_sync_failed(self):
+        contacts = self.get_sync()
+        d = contacts.check(['+27123'])
+        yield self.lookups_done()
+        contacts.flush()
+        [(_msisdns, sync)] = self.syncs
+        sync.errback(Exception('Timed out'))
+        # Numbers that couldn't be checked are left out.
+        self.assertEqual((yield d), {})
+        self.assertEqual(contacts.metrics.get('contacts.sync_failures'), 1)
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
@@ -0,0 +1,104 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.dedupe import BloomFilter, SentMessages
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestBloomFilter(VumiTestCase):
+
+    def test_sized_for_error_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual((bloom.size, bloom.hashes), (9586, 7))
+        self.assertEqual(len(bloom.bits), 1199)
+
+    def test_contains(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('added-%d' % i)
+        self.assertTrue(all('added-%d' % i in bloom for i in range(1000)))
+        false_positives = sum(
+            1 for i in range(10000) if 'other-%d' % i in bloom)
+        self.assertTrue(false_positives < 200)
+
+
+class TestSentMessages(RedisTestCase):
+
+    def get_sent(self, **kw):
+        return self.with_clock(
+            SentMessages, self.redis, 100, capacity=1000, **kw)
+
+    @inlineCallbacks
+    def test_claim(self):
+        sent = self.get_sent(batch_interval=0.5)
+        self.assertEqual((yield sent.claim('msg-1')), (True, None))
+        # Caught while it is being sent.
+        self.assertEqual((yield sent.claim('msg-1')), (False, None))
+        sent.sent('msg-1', 'wa-1')
+        # And once it has been, before it has been written to Redis.
+        self.assertEqual((yield sent.claim('msg-1')), (False, 'wa-1'))
+        self.assertEqual((yield self.redis.hgetall('sent:10')), {})
+        self.clock.advance(0.5)
+        yield sent.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('sent:10')), {'msg-1': 'wa-1'})
+        self.assertEqual((yield self.redis.ttl('sent:10')), 200)
+        self.assertEqual(sent.metrics.get('dedupe.new'), 1)
+        self.assertEqual(sent.metrics.get('dedupe.duplicates'), 2)
+
+    @inlineCallbacks
+    def test_forget_failed(self):
+        sent = self.get_sent()
+        yield sent.claim('msg-1')
+        sent.forget('msg-1')
+        self.assertEqual((yield sent.claim('msg-1')), (True, None))
+        yield sent.flush()
+        self.assertEqual((yield self.redis.hgetall('sent:10')), {})
+
+    @inlineCallbacks
+    def test_first_ack_kept(self):
+        sent = self.get_sent()
+        yield sent.claim('msg-1')
+        sent.sent('msg-1', 'wa-1')
+        sent.sent('msg-1', 'wa-2')
+        # Sent again without being claimed, as recovered messages are.
+        sent.sent('msg-2', 'wa-3')
+        yield sent.flush()
+        self.assertEqual((yield self.redis.hgetall('sent:10')), {
+            'msg-1': 'wa-1', 'msg-2': 'wa-3'})
+
+    @inlineCallbacks
+    def test_loaded_after_restart(self):
+        sent = self.get_sent()
+        yield sent.claim('msg-1')
+        sent.sent('msg-1', 'wa-1')
+        yield sent.flush()
+        self.clock.advance(100)
+
+        restarted = self.get_sent()
+        yield restarted.load()
+        self.assertEqual(restarted.metrics.get('dedupe.loaded'), 1)
+        self.assertEqual((yield restarted.claim('msg-1')), (False, 'wa-1'))
+        self.assertEqual(restarted.metrics.get('dedupe.confirmations'), 1)
+        self.assertEqual((yield restarted.claim('msg-2')), (True, None))
+        self.assertEqual(restarted.metrics.get('dedupe.confirmations'), 1)
+
+    @inlineCallbacks
+    def test_false_positive_confirmed(self):
+        sent = self.get_sent()
+        sent._filters()[1][sent.generation()].add('msg-1')
+        self.assertEqual((yield sent.claim('msg-1')), (True, None))
+        self.assertEqual(sent.metrics.get('dedupe.false_positives'), 1)
+        self.assertEqual((yield sent.claim('msg-1')), (False, None))
+
+    @inlineCallbacks
+    def test_remembered_for_horizon(self):
+        sent = self.get_sent()
+        yield sent.claim('msg-1')
+        sent.sent('msg-1', 'wa-1')
+        self.clock.advance(100)
+        self.assertEqual((yield sent.claim('msg-1')), (False, 'wa-1'))
+        self.clock.advance(200)
+        self.assertEqual((yield sent.claim('msg-1')), (True, None))
+        self.assertEqual(sorted(sent.filters), [13])
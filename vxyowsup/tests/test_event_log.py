@@ -0,0 +1,52 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.event_log import EventLog, EventLogError
+
+
+class RecordingLog(object):
+    def __init__(self):
+        self.logged = []
+
+    def __getattr__(self, level):
+        return lambda msg: self.logged.append((level, msg))
+
+
+class TestEventLog(VumiTestCase):
+
+    def setUp(self):
+        self.log = RecordingLog()
+
+    def test_render(self):
+        event_log = EventLog(self.log)
+        event_log.info('ack.received', id='123-1', type=None)
+        self.assertEqual(
+            self.log.logged, [('info', 'ack.received id=123-1 type=None')])
+
+    def test_below_level_not_rendered(self):
+        event_log = EventLog(self.log, level='info')
+        calls = []
+        event_log.debug('message.received', entity=lambda: calls.append(1))
+        self.assertEqual(self.log.logged, [])
+        self.assertEqual(calls, [])
+        self.assertFalse(event_log.enabled('debug'))
+        self.assertTrue(event_log.enabled('error'))
+
+    def test_callable_rendered_when_enabled(self):
+        event_log = EventLog(self.log, level='debug')
+        event_log.debug('message.received', entity=lambda: '<message/>')
+        self.assertEqual(self.log.logged, [
+            ('debug', 'message.received entity=<message/>')])
+
+    def test_sampling(self):
+        event_log = EventLog(self.log, sample_rates={'ack.received': 3})
+        for i in range(7):
+            event_log.info('ack.received', id=i)
+            event_log.info('receipt.received', id=i)
+        self.assertEqual(
+            [msg for level, msg in self.log.logged
+             if msg.startswith('ack')],
+            ['ack.received id=0', 'ack.received id=3', 'ack.received id=6'])
+        self.assertEqual(len(self.log.logged), 10)
+
+    def test_unknown_level(self):
+        self.assertRaises(EventLogError, EventLog, self.log, level='loud')
@@ -0,0 +1,76 @@
+from twisted.internet.defer import inlineCallbacks
+
+
+from vxyowsup.events import EventBatcher
+from vxyowsup.message_store import MessageIdStore
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestEventBatcher(RedisTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestEventBatcher, self).setUp()
+        self.message_ids = self.with_clock(MessageIdStore, self.redis, 60)
+        self.passed_on = []
+
+    def get_batcher(self, **kw):
+        return self.with_clock(
+            EventBatcher, self.message_ids,
+            lambda *ids: self.passed_on.append(('ack',) + ids),
+            lambda *ids: self.passed_on.append(('receipt',) + ids), **kw)
+
+    @inlineCallbacks
+    def test_passed_on_in_order_after_interval(self):
+        self.message_ids.add('wa-1', 'vumi-1')
+        yield self.message_ids.flush()
+        yield self.redis.set('wa-2', 'vumi-2')
+        batcher = self.get_batcher(batch_interval=0.01)
+        batcher.ack('wa-2')
+        batcher.ack('wa-1')
+        batcher.receipt('wa-2')
+        self.assertEqual(self.passed_on, [])
+        self.clock.advance(0.01)
+        yield batcher.flush()
+        self.assertEqual(self.passed_on, [
+            ('ack', 'wa-2', 'vumi-2'),
+            ('ack', 'wa-1', 'vumi-1'),
+            ('receipt', 'wa-2', 'vumi-2'),
+        ])
+        self.assertEqual(
+            batcher.metrics.histogram('events.batch_size').max, 3)
+
+    @inlineCallbacks
+    def test_passed_on_at_batch_size(self):
+        self.message_ids.add('wa-1', 'vumi-1')
+        batcher = self.get_batcher(batch_size=2)
+        batcher.ack('wa-1')
+        self.assertEqual(self.passed_on, [])
+        batcher.receipt('wa-1')
+        yield batcher.flush()
+        self.assertEqual(len(self.passed_on), 2)
+
+    @inlineCallbacks
+    def test_duplicate_receipts_dropped(self):
+        self.message_ids.add('wa-1', 'vumi-1')
+        yield self.message_ids.flush()
+        batcher = self.get_batcher()
+        batcher.receipt('wa-1')
+        batcher.receipt('wa-1')
+        yield batcher.flush()
+        self.assertEqual(self.passed_on, [('receipt', 'wa-1', 'vumi-1')])
+        self.assertEqual(batcher.metrics.get('events.duplicate_receipts'), 1)
+        # The mapping is gone once the receipt has been passed on.
+        self.assertEqual((yield self.redis.get('wa-1')), None)
+        batcher.receipt('wa-1')
+        yield batcher.flush()
+        self.assertEqual(len(self.passed_on), 1)
+
+    @inlineCallbacks
+    def test_unknown_ids_skipped(self):
+        batcher = self.get_batcher()
+        batcher.ack('wa-1')
+        batcher.receipt('wa-1')
+        yield batcher.flush()
+        self.assertEqual(self.passed_on, [])
+        self.assertEqual(batcher.metrics.get('events.unknown'), 2)
@@ -0,0 +1,50 @@
+import threading
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.flow_control import InFlightWindow
+
+
+class TestInFlightWindow(VumiTestCase):
+
+    def acquire_in_thread(self, window):
+        acquired = threading.Event()
+
+        def acquire():
+            window.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.daemon = True
+        thread.start()
+        self.add_cleanup(thread.join)
+        return acquired
+
+    def test_unlimited(self):
+        window = InFlightWindow(0)
+        for i in range(5):
+            window.acquire()
+        self.assertEqual(len(window), 5)
+        self.assertEqual(window.metrics.get('inbound.blocked'), 0)
+
+    def test_blocks_until_release(self):
+        window = InFlightWindow(1)
+        window.acquire()
+        acquired = self.acquire_in_thread(window)
+        self.assertFalse(acquired.wait(0.05))
+        window.release()
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.metrics.get('inbound.blocked'), 1)
+        self.assertTrue(
+            window.metrics.histogram('inbound.blocked_time').max >= 0.05)
+
+    def test_close_unblocks(self):
+        window = InFlightWindow(1)
+        window.acquire()
+        acquired = self.acquire_in_thread(window)
+        self.assertFalse(acquired.wait(0.05))
+        window.close()
+        self.assertTrue(acquired.wait(5))
+        window.acquire()
+        self.assertEqual(len(window), 3)
@@ -0,0 +1,109 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.health import HealthMonitor, SlidingWindow
+
+
+class TestSlidingWindow(VumiTestCase):
+
+    def test_counts_expire(self):
+        clock = Clock()
+        window = SlidingWindow(10, buckets=5, clock=clock)
+        window.success()
+        window.failure()
+        clock.advance(5)
+        window.success(2)
+        window.latency(1.5)
+        self.assertEqual(window.totals(), (3, 1, 1, 1.5))
+        clock.advance(6)
+        self.assertEqual(window.totals(), (2, 0, 1, 1.5))
+        clock.advance(10)
+        self.assertEqual(window.totals(), (0, 0, 0, 0.0))
+
+
+class TestHealthMonitor(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.statuses = []
+
+    def add_status(self, **kw):
+        self.statuses.append(kw)
+        return defer.succeed(None)
+
+    def get_monitor(self, **kw):
+        kw.setdefault('clock', self.clock)
+        kw.setdefault('min_events', 4)
+        return HealthMonitor(self.add_status, **kw)
+
+    def test_nothing_to_judge(self):
+        monitor = self.get_monitor()
+        monitor.check()
+        self.assertEqual(self.statuses, [])
+
+    def test_error_rate(self):
+        monitor = self.get_monitor()
+        monitor.success('inbound')
+        monitor.failure('inbound', 'Cannot decode', {'message': 'x'})
+        # Too few messages to judge a failure by.
+        self.assertEqual(monitor.status('inbound'), None)
+        monitor.success('inbound')
+        monitor.success('inbound')
+        self.assertEqual(monitor.status('inbound'), {
+            'status': 'degraded', 'type': 'inbound_error',
+            'message': 'Cannot decode', 'details': {
+                'message': 'x', 'failures': 1, 'total': 4, 'window': 60}})
+        monitor.failure('outbound')
+        monitor.failure('outbound')
+        monitor.failure('outbound')
+        monitor.success('outbound')
+        status = monitor.status('outbound')
+        self.assertEqual(status['status'], 'down')
+        self.assertEqual(status['message'], '3 of 4 outbound messages failed')
+        self.assertEqual(
+            monitor.metrics.gauge('health.outbound.error_rate'), 0.75)
+
+    def test_recovers_as_failures_leave_window(self):
+        monitor = self.get_monitor(window=10)
+        for _ in range(4):
+            monitor.failure('outbound')
+        self.assertEqual(monitor.status('outbound')['status'], 'down')
+        self.clock.advance(11)
+        monitor.success('outbound')
+        self.assertEqual(monitor.status('outbound')['status'], 'ok')
+
+    def test_ack_latency(self):
+        monitor = self.get_monitor(max_ack_latency=5)
+        monitor.latency('ack_latency', 2)
+        self.assertEqual(monitor.status('ack_latency')['status'], 'ok')
+        monitor.latency('ack_latency', 12)
+        self.assertEqual(monitor.status('ack_latency'), {
+            'status': 'degraded', 'type': 'ack_latency_high',
+            'message': 'Messages acked in 7.0 seconds on average'})
+
+    def test_connection(self):
+        monitor = self.get_monitor(max_disconnects=2)
+        monitor.connection_changed(True)
+        self.assertEqual(monitor.status('connection')['type'], 'connected')
+        monitor.connection_changed(False, 'Lost')
+        self.assertEqual(monitor.status('connection'), None)
+        monitor.connection_changed(True)
+        monitor.connection_changed(False, 'Lost')
+        monitor.connection_changed(True)
+        self.assertEqual(monitor.status('connection'), {
+            'status': 'degraded', 'type': 'connection_unstable',
+            'message': 'Connection lost 2 times in the last 60 seconds'})
+
+    def test_checked_on_interval(self):
+        monitor = self.get_monitor(interval=10)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        monitor.success('inbound')
+        self.assertEqual(self.statuses, [])
+        self.clock.advance(10)
+        self.assertEqual(self.statuses, [{
+            'component': 'inbound', 'status': 'ok', 'type': 'inbound_success',
+            'message': 'Inbound messages successfully processed'}])
+        self.assertEqual(monitor.metrics.get('health.checks'), 1)
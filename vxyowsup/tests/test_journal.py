@@ -0,0 +1,132 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.message import TransportUserMessage
+
+from vxyowsup.journal import OutboundJournal
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestOutboundJournal(RedisTestCase):
+
+    def get_journal(self, **kw):
+        return self.with_clock(
+            OutboundJournal, self.redis, ['+27000', '+27001'], **kw)
+
+    def mkmsg(self, content, **kw):
+        return TransportUserMessage(
+            to_addr='+27123', from_addr='vumi', content=content,
+            transport_name='whatsapp', transport_type='whatsapp', **kw)
+
+    @inlineCallbacks
+    def test_append_is_written_after_interval(self):
+        journal = self.get_journal(batch_interval=0.5)
+        msg = self.mkmsg('hello')
+        journal.append('+27000', msg)
+        self.assertEqual(
+            (yield self.redis.hgetall('outbound_journal:+27000')), {})
+        self.clock.advance(0.5)
+        yield journal.flush()
+        entries = yield self.redis.hgetall('outbound_journal:+27000')
+        self.assertEqual(
+            json.loads(entries[msg['message_id']]),
+            [1000000000, '+27123', 'vumi', 'hello', None])
+        self.assertEqual(journal.metrics.get('journal.flushes'), 1)
+
+    @inlineCallbacks
+    def test_remove_before_flush(self):
+        journal = self.get_journal()
+        msg = self.mkmsg('hello')
+        journal.append('+27000', msg)
+        journal.remove(msg['message_id'])
+        yield journal.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('outbound_journal:+27000')), {})
+        self.assertEqual(journal.metrics.get('journal.flushes'), 0)
+
+    @inlineCallbacks
+    def test_remove_after_flush(self):
+        journal = self.get_journal(batch_size=2)
+        msg1 = self.mkmsg('one')
+        msg2 = self.mkmsg('two')
+        journal.append('+27000', msg1)
+        journal.append('+27001', msg2)
+        yield journal.flush()
+        journal.remove(msg1['message_id'])
+        yield journal.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('outbound_journal:+27000')), {})
+        entries = yield self.redis.hgetall('outbound_journal:+27001')
+        self.assertEqual(entries.keys(), [msg2['message_id']])
+
+    @inlineCallbacks
+    def test_recover_in_order(self):
+        journal = self.get_journal()
+        msgs = [self.mkmsg('msg%s' % i) for i in range(5)]
+        for msg in msgs:
+            journal.append('+27000', msg)
+        yield journal.flush()
+
+        recovered = yield self.get_journal().recover('+27000')
+        self.assertEqual(
+            [fields['message_id'] for fields in recovered],
+            [msg['message_id'] for msg in msgs])
+        self.assertEqual(recovered[0], {
+            'message_id': msgs[0]['message_id'], 'to_addr': '+27123',
+            'from_addr': 'vumi', 'content': 'msg0', 'in_reply_to': None})
+
+    @inlineCallbacks
+    def test_recover_recipients(self):
+        journal = self.get_journal()
+        msg = self.mkmsg('bulk')
+        journal.append('+27000', msg, ['+27111', '+27222'])
+        yield journal.flush()
+
+        [fields] = yield self.get_journal().recover('+27000')
+        self.assertEqual(fields['recipients'], ['+27111', '+27222'])
+        self.assertEqual(fields['content'], 'bulk')
+
+    @inlineCallbacks
+    def test_recover_media(self):
+        journal = self.get_journal()
+        media = {'type': 'image', 'url': 'http://example.com/a.jpg'}
+        msg = self.mkmsg(None, helper_metadata={'whatsapp': {'media': media}})
+        journal.append('+27000', msg)
+        yield journal.flush()
+
+        [fields] = yield self.get_journal().recover('+27000')
+        self.assertEqual(fields['media'], media)
+        self.assertEqual(fields['content'], None)
+        self.assertFalse('recipients' in fields)
+
+    @inlineCallbacks
+    def test_recover_drops_expired(self):
+        journal = self.get_journal()
+        old = self.mkmsg('old')
+        journal.append('+27000', old)
+        self.clock.advance(100)
+        new = self.mkmsg('new')
+        journal.append('+27000', new)
+        yield journal.flush()
+
+        recovered = yield journal.recover('+27000', max_age=50)
+        self.assertEqual(
+            [fields['message_id'] for fields in recovered],
+            [new['message_id']])
+        entries = yield self.redis.hgetall('outbound_journal:+27000')
+        self.assertEqual(entries.keys(), [new['message_id']])
+
+    @inlineCallbacks
+    def test_recover_one_account(self):
+        journal = self.get_journal()
+        msg1 = self.mkmsg('one')
+        msg2 = self.mkmsg('two')
+        journal.append('+27000', msg1)
+        journal.append('+27001', msg2)
+        yield journal.flush()
+
+        recovered = yield self.get_journal().recover('+27001')
+        self.assertEqual(
+            [fields['message_id'] for fields in recovered],
+            [msg2['message_id']])
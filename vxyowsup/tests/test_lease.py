@@ -0,0 +1,117 @@
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+
+
+from vxyowsup.lease import Lease
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestLease(RedisTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestLease, self).setUp()
+        self.events = []
+
+    def get_lease(self, owner, **kw):
+        return self.with_clock(
+            Lease, self.redis, 'account:+27123', owner, ttl=10, interval=3,
+            acquired=lambda: self.events.append((owner, 'acquired')),
+            lost=lambda: self.events.append((owner, 'lost')), **kw)
+
+    def expire_keys(self, seconds):
+        self.redis._client.clock.advance(seconds)
+
+    @inlineCallbacks
+    def test_one_holder(self):
+        a = self.get_lease('a')
+        b = self.get_lease('b')
+        yield a.check()
+        yield b.check()
+        self.assertEqual((a.held, b.held), (True, False))
+        self.assertEqual(self.events, [('a', 'acquired')])
+        self.assertEqual((yield self.redis.get('lease:account:+27123')), 'a')
+        self.assertEqual((yield self.redis.ttl('lease:account:+27123')), 10)
+
+        # Renewing pushes the expiry back.
+        self.expire_keys(5)
+        yield a.check()
+        self.assertEqual((yield self.redis.ttl('lease:account:+27123')), 10)
+        self.assertEqual(a.metrics.get('lease.acquired'), 1)
+
+    @inlineCallbacks
+    def test_taken_over_once_expired(self):
+        a = self.get_lease('a')
+        b = self.get_lease('b')
+        yield a.check()
+        # a stops renewing.
+        self.expire_keys(10)
+        yield b.check()
+        self.assertTrue(b.held)
+        yield a.check()
+        self.assertFalse(a.held)
+        self.assertEqual(self.events, [
+            ('a', 'acquired'), ('b', 'acquired'), ('a', 'lost')])
+
+    @inlineCallbacks
+    def test_stop_releases(self):
+        a = self.get_lease('a')
+        b = self.get_lease('b')
+        yield a.start()
+        yield a.stop()
+        yield b.check()
+        self.assertTrue(b.held)
+
+    @inlineCallbacks
+    def test_checked_on_interval(self):
+        a = self.get_lease('a')
+        b = self.get_lease('b')
+        yield a.start()
+        self.addCleanup(a.stop)
+        yield b.start()
+        self.addCleanup(b.stop)
+        a._loop.stop()
+        self.expire_keys(10)
+        self.clock.advance(3)
+        yield b.check()
+        self.assertTrue(b.held)
+
+    @inlineCallbacks
+    def test_lost_when_redis_unreachable(self):
+        a = self.get_lease('a')
+        yield a.check()
+        self.patch(
+            self.redis, 'get', lambda key: defer.fail(ZeroDivisionError()))
+        self.clock.advance(5)
+        yield a.check()
+        self.assertTrue(a.held)
+        # It lets go an interval before the key could expire.
+        self.clock.advance(2)
+        yield a.check()
+        self.assertFalse(a.held)
+        self.assertEqual(self.events, [('a', 'acquired'), ('a', 'lost')])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    @inlineCallbacks
+    def test_lost_when_redis_hangs(self):
+        a = self.get_lease('a')
+        yield a.check()
+        self.patch(self.redis, 'get', lambda key: defer.Deferred())
+        self.clock.advance(3)
+        d = a.check()
+        self.assertFalse(d.called)
+        self.clock.advance(3)
+        self.assertTrue(a.held)
+        # The next check doesn't wait for the one still in progress.
+        self.clock.advance(1)
+        yield a.check()
+        self.assertFalse(a.held)
+        self.assertEqual(self.events, [('a', 'acquired'), ('a', 'lost')])
+
+    @inlineCallbacks
+    def test_key_without_expiry(self):
+        yield self.redis.set('lease:account:+27123', 'gone')
+        a = self.get_lease('a')
+        yield a.check()
+        self.assertFalse(a.held)
+        self.assertEqual((yield self.redis.ttl('lease:account:+27123')), 10)
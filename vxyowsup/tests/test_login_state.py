@@ -0,0 +1,33 @@
+from twisted.internet.defer import inlineCallbacks
+
+
+from vxyowsup.login_state import LoginStateStore
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestLoginStateStore(RedisTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestLoginStateStore, self).setUp()
+        self.logins = LoginStateStore(self.redis)
+
+    @inlineCallbacks
+    def test_save_and_load(self):
+        self.assertEqual((yield self.logins.load('+27123')), {})
+        self.assertEqual(self.logins.metrics.get('login.cached'), 0)
+        yield self.logins.save('+27123', {
+            'nonce': 'abc', 'status': 'active', 'kind': 'free', 't': None,
+            'props': '1'})
+        self.assertEqual(
+            (yield self.logins.load('+27123')),
+            {'nonce': 'abc', 'status': 'active', 'kind': 'free'})
+        self.assertEqual(self.logins.metrics.get('login.cached'), 1)
+
+    @inlineCallbacks
+    def test_save_keeps_last_nonce(self):
+        yield self.logins.save('+27123', {'nonce': 'abc'})
+        yield self.logins.save('+27123', {'nonce': None, 'status': 'active'})
+        self.assertEqual(
+            (yield self.logins.load('+27123')),
+            {'nonce': 'abc', 'status': 'active'})
@@ -0,0 +1,356 @@
+import base64
+import hashlib
+import json
+import os
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionDone
+from twisted.internet.defer import TimeoutError, inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.static import Data
+
+from vumi.tests.helpers import VumiTestCase
+
+from yowsup.layers.protocol_media.protocolentities import (
+    ImageDownloadableMediaMessageProtocolEntity,
+    LocationMediaMessageProtocolEntity)
+
+from vxyowsup.media import (
+    MediaError, MediaFile, MediaTransfers, inbound_media, media_message)
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+CONTENT = ''.join(chr(i % 256) for i in range(10000))
+CONTENT_HASH = base64.b64encode(hashlib.sha256(CONTENT).digest())
+
+
+class UploadResource(Resource):
+    '''Takes uploads as WhatsApp's media servers do.'''
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.uploads = []
+
+    def render_POST(self, request):
+        self.uploads.append((
+            request.getHeader('content-type'), request.content.read()))
+        return json.dumps({'url': 'http://media.example.com/served.jpg'})
+
+
+class HangingResource(Resource):
+    '''Sends the start of a file and then nothing more.'''
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render_GET(self, request):
+        request.setHeader('content-length', str(len(CONTENT)))
+        request.write(CONTENT[:100])
+        self.requests.append(request.notifyFinish())
+        return NOT_DONE_YET
+
+    def render_POST(self, request):
+        request.setHeader('content-length', '1000')
+        request.write('{')
+        self.requests.append(request.notifyFinish())
+        return NOT_DONE_YET
+
+
+class MediaServer(object):
+
+    def __init__(self):
+        self.root = Resource()
+        self.root.putChild('image.jpg', Data(CONTENT, 'image/jpeg'))
+        self.upload = UploadResource()
+        self.root.putChild('upload', self.upload)
+        self.hanging = HangingResource()
+        self.root.putChild('hanging.jpg', self.hanging)
+        self.port = reactor.listenTCP(
+            0, Site(self.root), interface='127.0.0.1')
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.port.getHost().port, path)
+
+    def stop(self):
+        return self.port.stopListening()
+
+
+class TestMediaTransfers(RedisTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestMediaTransfers, self).setUp()
+        self.server = MediaServer()
+        self.add_cleanup(self.server.stop)
+        self.store_path = os.path.abspath(self.mktemp())
+        os.mkdir(self.store_path)
+        self.slots = []
+
+    def get_transfers(self, **kw):
+        kw.setdefault('store_path', self.store_path)
+        kw.setdefault('upload_dir', self.store_path)
+        kw.setdefault('chunk_size', 1000)
+        return MediaTransfers(self.redis, **kw)
+
+    def request_slot(self, media):
+        self.slots.append(media.hash)
+        return defer.succeed((self.server.url('upload'), False))
+
+    def write_source(self):
+        path = os.path.join(self.store_path, 'source.jpg')
+        with open(path, 'wb') as f:
+            f.write(CONTENT)
+        return path
+
+    @inlineCallbacks
+    def test_spool_path(self):
+        transfers = self.get_transfers()
+        path = self.write_source()
+        media = yield transfers.spool(path)
+        self.assertEqual(
+            (media.path, media.hash, media.size, media.name),
+            (path, CONTENT_HASH, len(CONTENT), 'source.jpg'))
+        self.assertFalse(media.temporary)
+        self.assertEqual(media.mimetype, 'image/jpeg')
+
+        media = yield transfers.spool('file://' + path)
+        self.assertEqual(media.path, path)
+        media = yield transfers.spool('source.jpg')
+        self.assertEqual(media.path, path)
+
+    @inlineCallbacks
+    def test_spool_path_outside_upload_dir(self):
+        upload_dir = os.path.join(self.store_path, 'uploads')
+        os.mkdir(upload_dir)
+        self.write_source()
+        transfers = self.get_transfers(upload_dir=upload_dir)
+        for source in ['../source.jpg', os.path.join(upload_dir, '..', 'x'),
+                       '/etc/passwd', 'file:///etc/passwd',
+                       'ftp://example.com/a.jpg']:
+            yield self.assertFailure(transfers.spool(source), MediaError)
+
+        # No local files at all without an upload directory.
+        transfers = self.get_transfers(upload_dir=None)
+        yield self.assertFailure(
+            transfers.spool(self.write_source()), MediaError)
+
+    @inlineCallbacks
+    def test_spool_file(self):
+        transfers = self.get_transfers()
+        media = yield transfers.spool(StringIO(CONTENT), name='campaign.png')
+        self.assertTrue(media.temporary)
+        self.assertEqual(media.name, 'campaign.png')
+        self.assertEqual(media.hash, CONTENT_HASH)
+        with open(media.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    @inlineCallbacks
+    def test_spool_url(self):
+        transfers = self.get_transfers()
+        media = yield transfers.spool(self.server.url('image.jpg'))
+        self.assertTrue(media.temporary)
+        self.assertEqual(media.name, 'image.jpg')
+        self.assertEqual((media.hash, media.size), (CONTENT_HASH, 10000))
+        self.assertEqual(os.path.dirname(media.path), self.store_path)
+        self.assertEqual(
+            transfers.metrics.histogram('media.bytes_down').max, 10000)
+
+    @inlineCallbacks
+    def test_download(self):
+        transfers = self.get_transfers()
+        media = yield transfers.download(
+            self.server.url('image.jpg'), 'inbound.jpg')
+        self.assertEqual(
+            media.path, os.path.join(self.store_path, 'inbound.jpg'))
+        with open(media.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        # Only the downloaded file is left.
+        self.assertEqual(os.listdir(self.store_path), ['inbound.jpg'])
+        self.assertEqual(transfers.metrics.get('media.downloads'), 1)
+
+    @inlineCallbacks
+    def test_download_missing(self):
+        transfers = self.get_transfers()
+        yield self.assertFailure(
+            transfers.download(self.server.url('missing.jpg'), 'x.jpg'),
+            MediaError)
+        self.assertEqual(os.listdir(self.store_path), [])
+
+    @inlineCallbacks
+    def test_download_timeout(self):
+        transfers = self.get_transfers(timeout=0.1)
+        yield self.assertFailure(
+            transfers.download(self.server.url('hanging.jpg'), 'x.jpg'),
+            TimeoutError)
+        # The connection is closed, rather than left to go on arriving.
+        [request] = self.server.hanging.requests
+        yield self.assertFailure(request, ConnectionDone)
+        self.assertEqual(os.listdir(self.store_path), [])
+        self.assertEqual((transfers.active, transfers.waiting), (0, 0))
+
+    @inlineCallbacks
+    def test_upload(self):
+        transfers = self.get_transfers()
+        media = yield transfers.upload(
+            self.server.url('image.jpg'), self.request_slot,
+            [('to', '27123@s.whatsapp.net'), ('from', '27456')])
+        self.assertEqual(media.url, 'http://media.example.com/served.jpg')
+        self.assertEqual(self.slots, [CONTENT_HASH])
+        # The spooled copy is removed once it has been uploaded.
+        self.assertEqual(os.listdir(self.store_path), [])
+
+        [(content_type, body)] = self.server.upload.uploads
+        self.assertEqual(
+            content_type, 'multipart/form-data; boundary=zzXXzzYYzzXXzzQQ')
+        self.assertTrue(body.startswith(
+            '--zzXXzzYYzzXXzzQQ\r\nContent-Disposition: form-data; '
+            'name="to"\r\n\r\n27123@s.whatsapp.net\r\n'))
+        self.assertTrue(
+            'Content-Type: image/jpeg\r\n\r\n' + CONTENT +
+            '\r\n--zzXXzzYYzzXXzzQQ--\r\n' in body)
+        self.assertEqual(transfers.metrics.get('media.uploads'), 1)
+        self.assertEqual(
+            (yield self.redis.get('media:%s' % (CONTENT_HASH,))),
+            'http://media.example.com/served.jpg')
+
+    @inlineCallbacks
+    def test_upload_cached(self):
+        transfers = self.get_transfers()
+        path = self.write_source()
+        first = yield transfers.upload(path, self.request_slot, [])
+        second = yield transfers.upload(
+            StringIO(CONTENT), self.request_slot, [])
+        self.assertEqual(first.url, second.url)
+        self.assertEqual(len(self.server.upload.uploads), 1)
+        self.assertEqual(len(self.slots), 1)
+        self.assertEqual(transfers.metrics.get('media.cache_hits'), 1)
+        self.assertEqual(transfers.metrics.get('media.cache_misses'), 1)
+
+    @inlineCallbacks
+    def test_upload_timeout(self):
+        transfers = self.get_transfers(timeout=0.1)
+        yield self.assertFailure(transfers.upload(
+            self.write_source(),
+            lambda media: defer.succeed(
+                (self.server.url('hanging.jpg'), False)),
+            []), TimeoutError)
+        [request] = self.server.hanging.requests
+        yield self.assertFailure(request, ConnectionDone)
+        self.assertEqual((transfers.active, transfers.waiting), (0, 0))
+
+    @inlineCallbacks
+    def test_upload_url_cached(self):
+        transfers = self.get_transfers()
+        url = self.server.url('image.jpg')
+        first = yield transfers.upload(url, self.request_slot, [])
+        second = yield transfers.upload(url, self.request_slot, [])
+        self.assertEqual(
+            (second.hash, second.size, second.name, second.url),
+            (CONTENT_HASH, len(CONTENT), 'image.jpg', first.url))
+        # It was only fetched once.
+        self.assertEqual(
+            transfers.metrics.histogram('media.bytes_down').count, 1)
+        self.assertEqual(transfers.metrics.get('media.url_cache_hits'), 1)
+        self.assertEqual(transfers.metrics.get('media.url_cache_misses'), 1)
+        self.assertEqual(len(self.slots), 1)
+
+    @inlineCallbacks
+    def test_upload_same_content_at_once(self):
+        transfers = self.get_transfers()
+        path = self.write_source()
+        uploads = yield defer.gatherResults([
+            transfers.upload(path, self.request_slot, []) for _ in range(3)])
+        self.assertEqual(set(media.url for media in uploads), set([
+            'http://media.example.com/served.jpg']))
+        self.assertEqual(len(self.server.upload.uploads), 1)
+
+    @inlineCallbacks
+    def test_upload_duplicate(self):
+        transfers = self.get_transfers()
+        media = yield transfers.upload(
+            self.write_source(),
+            lambda media: defer.succeed(('http://known.example.com/', True)),
+            [])
+        self.assertEqual(media.url, 'http://known.example.com/')
+        self.assertEqual(self.server.upload.uploads, [])
+
+    @inlineCallbacks
+    def test_transfers_limited(self):
+        transfers = self.get_transfers(max_transfers=1)
+        slot = defer.Deferred()
+        first = transfers.upload(
+            self.write_source(), lambda media: slot, [])
+        second = transfers.download(self.server.url('image.jpg'), 'in.jpg')
+        yield self.wait_for(lambda: transfers.active == 1)
+        self.assertEqual(transfers.waiting, 1)
+        self.assertFalse(second.called)
+        slot.callback((self.server.url('upload'), False))
+        yield first
+        yield second
+        self.assertEqual((transfers.active, transfers.waiting), (0, 0))
+
+    @inlineCallbacks
+    def test_waiting_for_same_content_leaves_room(self):
+        transfers = self.get_transfers(max_transfers=2)
+        path = self.write_source()
+        slot = defer.Deferred()
+        first = transfers.upload(path, lambda media: slot, [])
+        second = transfers.upload(path, self.request_slot, [])
+        # The second upload waits for the first without taking up room.
+        yield self.wait_for(lambda: transfers.active == 1)
+        self.assertEqual(transfers.waiting, 0)
+        yield transfers.download(self.server.url('image.jpg'), 'in.jpg')
+        slot.callback((self.server.url('upload'), False))
+        yield first
+        media = yield second
+        self.assertEqual(media.url, 'http://media.example.com/served.jpg')
+        self.assertEqual(len(self.server.upload.uploads), 1)
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        while not condition():
+            yield deferLater(reactor, 0.01, lambda: None)
+
+
+class TestMediaMessages(VumiTestCase):
+
+    def test_media_message(self):
+        upload = MediaFile('/tmp/campaign.jpg', CONTENT_HASH, 10000)
+        upload.url = 'http://media.example.com/served.jpg'
+        entity = media_message(
+            {'type': 'image', 'width': 10, 'height': 20}, upload,
+            '27123@s.whatsapp.net', caption='Look')
+        node = entity.toProtocolTreeNode()
+        media = node.getChild('media')
+        self.assertEqual(node['to'], '27123@s.whatsapp.net')
+        self.assertEqual(media['type'], 'image')
+        self.assertEqual(media['url'], upload.url)
+        self.assertEqual(media['filehash'], CONTENT_HASH)
+        self.assertEqual(media['mimetype'], 'image/jpeg')
+        self.assertEqual(media['size'], '10000')
+        self.assertEqual(media['caption'], 'Look')
+        self.assertEqual(media['width'], '10')
+
+    def test_inbound_image(self):
+        entity = ImageDownloadableMediaMessageProtocolEntity(
+            'image/jpeg', CONTENT_HASH, 'http://media.example.com/in.jpg',
+            None, 10000, 'in.jpg', 'raw', 10, 20, 'Hi', _from='27123')
+        self.assertEqual(inbound_media(entity), {
+            'type': 'image', 'url': 'http://media.example.com/in.jpg',
+            'mimetype': 'image/jpeg', 'size': 10000, 'hash': CONTENT_HASH,
+            'name': 'in.jpg', 'caption': 'Hi',
+        })
+
+    def test_inbound_location(self):
+        entity = LocationMediaMessageProtocolEntity(
+            '-33.9', '18.4', 'Cape Town', None, 'raw', _from='27123')
+        self.assertEqual(inbound_media(entity), {
+            'type': 'location', 'latitude': '-33.9', 'longitude': '18.4',
+            'name': 'Cape Town', 'url': None,
+        })
@@ -0,0 +1,215 @@
+import struct
+import uuid
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.message_store import (
+    MessageIdStore, BucketedMessageIdStore, pack_whatsapp_id, pack_vumi_id,
+    unpack_vumi_id, whatsapp_id_time)
+from vxyowsup.tests.helpers import RedisTestCase
+
+
+class TestMessageIdStore(RedisTestCase):
+
+    def get_store(self, **kw):
+        return self.with_clock(MessageIdStore, self.redis, 60, **kw)
+
+    @inlineCallbacks
+    def test_add_is_written_after_interval(self):
+        store = self.get_store(batch_interval=0.5)
+        store.add('wa-1', 'vumi-1')
+        self.assertEqual((yield self.redis.get('wa-1')), None)
+        self.clock.advance(0.5)
+        yield store.flush()
+        self.assertEqual((yield self.redis.get('wa-1')), 'vumi-1')
+        self.assertEqual((yield self.redis.ttl('wa-1')), 60)
+
+    @inlineCallbacks
+    def test_add_is_written_at_batch_size(self):
+        store = self.get_store(batch_size=2)
+        store.add('wa-1', 'vumi-1')
+        store.add('wa-2', 'vumi-2')
+        yield store.flush()
+        self.assertEqual((yield self.redis.get('wa-1')), 'vumi-1')
+        self.assertEqual((yield self.redis.get('wa-2')), 'vumi-2')
+        self.assertEqual(store.metrics.get('message_ids.flushes'), 1)
+        self.assertEqual(
+            store.metrics.histogram('message_ids.batch_size').max, 2)
+
+    @inlineCallbacks
+    def test_get_reads_through_pending(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        self.assertEqual((yield store.get('wa-1')), 'vumi-1')
+        self.assertEqual((yield store.get('wa-2')), None)
+
+    @inlineCallbacks
+    def test_get_from_redis(self):
+        yield self.redis.set('wa-1', 'vumi-1')
+        store = self.get_store()
+        self.assertEqual((yield store.get('wa-1')), 'vumi-1')
+
+    @inlineCallbacks
+    def test_delete_pending(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        yield store.delete('wa-1')
+        yield store.flush()
+        self.assertEqual((yield store.get('wa-1')), None)
+        self.assertEqual((yield self.redis.get('wa-1')), None)
+
+    @inlineCallbacks
+    def test_delete_while_flushing(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        flush_d = store.flush()
+        yield store.delete('wa-1')
+        yield flush_d
+        self.assertEqual((yield self.redis.get('wa-1')), None)
+
+    @inlineCallbacks
+    def test_get_served_from_cache(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        yield store.flush()
+        yield self.redis.delete('wa-1')
+        self.assertEqual((yield store.get('wa-1')), 'vumi-1')
+        self.assertEqual(store.metrics.get('message_ids.cache.hits'), 1)
+
+    @inlineCallbacks
+    def test_get_falls_back_to_redis(self):
+        yield self.redis.set('wa-1', 'vumi-1')
+        store = self.get_store()
+        self.assertEqual((yield store.get('wa-1')), 'vumi-1')
+        self.assertEqual(store.metrics.get('message_ids.cache.misses'), 1)
+        self.assertEqual(store.cache.get('wa-1'), 'vumi-1')
+
+    @inlineCallbacks
+    def test_delete_removes_from_cache(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        yield store.flush()
+        yield store.delete('wa-1')
+        self.assertEqual(store.cache.get('wa-1'), None)
+        self.assertEqual((yield store.get('wa-1')), None)
+
+    @inlineCallbacks
+    def test_get_many(self):
+        yield self.redis.set('wa-1', 'vumi-1')
+        store = self.get_store()
+        store.add('wa-2', 'vumi-2')
+        found = yield store.get_many(['wa-1', 'wa-2', 'wa-3'])
+        self.assertEqual(found, {'wa-1': 'vumi-1', 'wa-2': 'vumi-2'})
+        self.assertEqual(store.cache.get('wa-1'), 'vumi-1')
+
+    @inlineCallbacks
+    def test_delete_many(self):
+        store = self.get_store()
+        store.add('wa-1', 'vumi-1')
+        store.add('wa-2', 'vumi-2')
+        yield store.flush()
+        yield store.delete_many(['wa-1', 'wa-2'])
+        self.assertEqual((yield store.get_many(['wa-1', 'wa-2'])), {})
+        self.assertEqual((yield self.redis.get('wa-2')), None)
+
+
+class TestPacking(VumiTestCase):
+
+    def test_whatsapp_id(self):
+        self.assertEqual(
+            pack_whatsapp_id('1480000000-12'),
+            '\x01' + struct.pack('>II', 1480000000, 12))
+        self.assertEqual(pack_whatsapp_id('wa-1'), 'wa-1')
+        self.assertEqual(whatsapp_id_time('1480000000-12'), 1480000000)
+        self.assertEqual(whatsapp_id_time('wa-1'), None)
+
+    def test_vumi_id(self):
+        vumi_id = uuid.uuid4().hex
+        packed = pack_vumi_id(vumi_id)
+        self.assertEqual(len(packed), 17)
+        self.assertEqual(unpack_vumi_id(packed), vumi_id)
+        self.assertEqual(pack_vumi_id(u'vumi-1'), 'vumi-1')
+        self.assertEqual(unpack_vumi_id('vumi-1'), 'vumi-1')
+        # Not lower case hex, so it can't be packed without changing it.
+        self.assertEqual(pack_vumi_id(vumi_id.upper()), vumi_id.upper())
+
+
+class TestBucketedMessageIdStore(RedisTestCase):
+
+    start_time = 1480000100
+
+    def get_store(self, **kw):
+        kw.setdefault('cache_size', 0)
+        return self.with_clock(BucketedMessageIdStore, self.redis, 60, **kw)
+
+    @inlineCallbacks
+    def test_add_is_written_to_bucket(self):
+        store = self.get_store()
+        vumi_id = uuid.uuid4().hex
+        store.add('1480000000-12', vumi_id)
+        yield store.flush()
+        key = 'ids:%d' % (1480000000 // 3600,)
+        self.assertEqual((yield self.redis.hgetall(key)), {
+            pack_whatsapp_id('1480000000-12'): pack_vumi_id(vumi_id)})
+        # The bucket ends at 1480003200, and expires a minute after that.
+        self.assertEqual((yield self.redis.ttl(key)), 3160)
+        self.assertEqual((yield store.get('1480000000-12')), vumi_id)
+
+    @inlineCallbacks
+    def test_id_without_time(self):
+        store = self.get_store(bucket_size=60)
+        store.add('wa-1', 'vumi-1')
+        yield store.flush()
+        self.assertEqual(
+            (yield self.redis.hgetall('ids:%d' % (1480000100 // 60,))),
+            {'wa-1': 'vumi-1'})
+        self.clock.advance(60)
+        self.assertEqual((yield store.get('wa-1')), 'vumi-1')
+        yield store.delete('wa-1')
+        self.assertEqual((yield store.get('wa-1')), None)
+
+    @inlineCallbacks
+    def test_get_many(self):
+        store = self.get_store()
+        store.add('1480000000-1', 'vumi-1')
+        store.add('1480000000-2', 'vumi-2')
+        yield store.flush()
+        found = yield store.get_many(
+            ['1480000000-1', '1480000000-2', '1480000000-3'])
+        self.assertEqual(found, {
+            '1480000000-1': 'vumi-1', '1480000000-2': 'vumi-2'})
+
+    @inlineCallbacks
+    def test_delete(self):
+        store = self.get_store()
+        store.add('1480000000-1', 'vumi-1')
+        store.add('1480000000-2', 'vumi-2')
+        yield store.flush()
+        yield store.delete('1480000000-1')
+        self.assertEqual((yield store.get('1480000000-1')), None)
+        self.assertEqual((yield store.get('1480000000-2')), 'vumi-2')
+
+    @inlineCallbacks
+    def test_reads_old_keys(self):
+        yield self.redis.set('1480000000-1', 'vumi-1')
+        store = self.get_store()
+        self.assertEqual((yield store.get('1480000000-1')), 'vumi-1')
+        self.assertEqual(store.metrics.get('message_ids.old_key_reads'), 1)
+        yield store.delete('1480000000-1')
+        self.assertEqual((yield self.redis.get('1480000000-1')), None)
+
+    @inlineCallbacks
+    def test_stops_reading_old_keys_after_ttl(self):
+        yield self.redis.set('1480000000-1', 'vumi-1')
+        store = self.get_store()
+        self.clock.advance(60)
+        self.assertEqual((yield store.get('1480000000-1')), None)
+        self.assertEqual(store.metrics.get('message_ids.old_key_reads'), 0)
+
+    @inlineCallbacks
+    def test_not_reading_old_keys(self):
+        yield self.redis.set('1480000000-1', 'vumi-1')
+        store = self.get_store(read_old_keys=False)
+        self.assertEqual((yield store.get('1480000000-1')), None)
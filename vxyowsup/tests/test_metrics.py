@@ -0,0 +1,82 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.metrics import Histogram, Metrics, StageTimer
+
+
+class TestHistogram(VumiTestCase):
+
+    def test_record(self):
+        histogram = Histogram()
+        for value in [3, 1, 2]:
+            histogram.record(value)
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 3)
+        self.assertEqual(histogram.mean, 2.0)
+
+    def test_percentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for value in xrange(100):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(50), 50)
+        self.assertEqual(histogram.percentile(99), 99)
+        self.assertEqual(histogram.percentile(100), 99)
+
+    def test_percentile_of_recent_values(self):
+        histogram = Histogram()
+        for value in xrange(Histogram.SAMPLES):
+            histogram.record(1000)
+        for value in xrange(Histogram.SAMPLES):
+            histogram.record(1)
+        self.assertEqual(histogram.percentile(99), 1)
+        self.assertEqual(histogram.max, 1000)
+
+
+class TestMetrics(VumiTestCase):
+
+    def test_poll(self):
+        metrics = Metrics()
+        values = [1]
+        metrics.poll('depth', lambda: values[0])
+        metrics.set('other', 2)
+        values[0] = 3
+        self.assertEqual(metrics.gauge('depth'), 3)
+        self.assertEqual(metrics.all_gauges(), {'depth': 3, 'other': 2})
+
+
+class TestStageTimer(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics()
+
+    def test_stop(self):
+        timer = StageTimer(self.metrics, clock=self.clock)
+        timer.start('a')
+        self.clock.advance(2)
+        timer.stop('stage', 'a')
+        timer.stop('stage', 'a')
+        histogram = self.metrics.histogram('stage')
+        self.assertEqual((histogram.count, histogram.max), (1, 2))
+        self.assertEqual(len(timer), 0)
+
+    def test_stop_keep(self):
+        timer = StageTimer(self.metrics, clock=self.clock)
+        timer.start('a')
+        self.clock.advance(1)
+        timer.stop('first', 'a', keep=True)
+        self.clock.advance(1)
+        timer.stop('second', 'a')
+        self.assertEqual(self.metrics.histogram('first').max, 1)
+        self.assertEqual(self.metrics.histogram('second').max, 2)
+
+    def test_max_size(self):
+        timer = StageTimer(self.metrics, max_size=2, clock=self.clock)
+        for key in ['a', 'b', 'c']:
+            timer.start(key)
+        timer.stop('stage', 'a')
+        self.assertEqual(self.metrics.histogram('stage').count, 0)
+        self.assertEqual(len(timer), 2)
@@ -0,0 +1,99 @@
+from twisted.web.test.requesthelper import DummyRequest
+from zope.interface import implementer
+
+from vumi.blinkenlights.metrics import IMetricPublisher
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.metrics import Metrics
+from vxyowsup.metrics_export import (
+    MetricsPublisher, PrometheusResource, render_prometheus)
+
+
+@implementer(IMetricPublisher)
+class RecordingPublisher(object):
+    def __init__(self):
+        self.msgs = []
+
+    def publish_message(self, msg):
+        self.msgs.append(msg)
+
+
+class TestMetricsPublisher(VumiTestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.publisher = RecordingPublisher()
+        self.manager = MetricsPublisher(
+            self.metrics, 'whatsapp.', publisher=self.publisher)
+
+    def published(self):
+        self.manager.publish_metrics()
+        msg = self.publisher.msgs.pop()
+        return dict(
+            (name, (aggs, [value for _time, value in values]))
+            for name, aggs, values in msg.datapoints())
+
+    def test_counters_published_as_increase(self):
+        self.metrics.incr('acks', 3)
+        self.assertEqual(self.published(), {
+            'whatsapp.acks': (('sum',), [3]),
+        })
+        self.metrics.incr('acks')
+        self.assertEqual(self.published(), {
+            'whatsapp.acks': (('sum',), [1]),
+        })
+        self.assertEqual(self.published(), {})
+
+    def test_gauges(self):
+        self.metrics.set('depth', 4)
+        self.metrics.poll('polled', lambda: 5)
+        self.assertEqual(self.published(), {
+            'whatsapp.depth': (('last',), [4]),
+            'whatsapp.polled': (('last',), [5]),
+        })
+
+    def test_histograms(self):
+        for value in [1, 2, 3]:
+            self.metrics.record('latency', value)
+        published = self.published()
+        self.assertEqual(published['whatsapp.latency.count'], (('sum',), [3]))
+        self.assertEqual(published['whatsapp.latency.avg'], (('avg',), [2.0]))
+        self.assertEqual(published['whatsapp.latency.max'], (('max',), [3]))
+        self.assertEqual(published['whatsapp.latency.p50'], (('last',), [2]))
+
+        self.metrics.record('latency', 5)
+        published = self.published()
+        self.assertEqual(published['whatsapp.latency.count'], (('sum',), [1]))
+        self.assertEqual(published['whatsapp.latency.avg'], (('avg',), [5.0]))
+        self.assertEqual(self.published(), {})
+
+
+class TestPrometheus(VumiTestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.incr('message_ids.flushes', 2)
+        self.metrics.set('outbound.queue_depth', 7)
+        self.metrics.record('outbound.send_to_ack', 0.5)
+
+    def test_render(self):
+        self.assertEqual(render_prometheus(self.metrics), '\n'.join([
+            '# TYPE vxyowsup_message_ids_flushes counter',
+            'vxyowsup_message_ids_flushes 2',
+            '# TYPE vxyowsup_outbound_queue_depth gauge',
+            'vxyowsup_outbound_queue_depth 7',
+            '# TYPE vxyowsup_outbound_send_to_ack summary',
+            'vxyowsup_outbound_send_to_ack{quantile="0.5"} 0.5',
+            'vxyowsup_outbound_send_to_ack{quantile="0.95"} 0.5',
+            'vxyowsup_outbound_send_to_ack{quantile="0.99"} 0.5',
+            'vxyowsup_outbound_send_to_ack_sum 0.5',
+            'vxyowsup_outbound_send_to_ack_count 1',
+        ]) + '\n')
+
+    def test_resource(self):
+        request = DummyRequest([''])
+        body = PrometheusResource(self.metrics, 'wa').render_GET(request)
+        self.assertIn('wa_message_ids_flushes 2\n', body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('Content-Type'),
+            ['text/plain; version=0.0.4'])
@@ -0,0 +1,108 @@
+import base64
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxyowsup.process_stack import (
+    encode_record, read_commands, RecordDecoder, ProcessStackClient)
+from vxyowsup.whatsapp import WhatsAppTransport
+
+
+class TestRecords(VumiTestCase):
+
+    def test_round_trip(self):
+        records = [('call', '_send_ack', ('123-1',), {}), ('started',)]
+        data = ''.join(encode_record(record) for record in records)
+        self.assertEqual(RecordDecoder().feed(data), records)
+
+    def test_partial_records(self):
+        data = encode_record(('send', u'Zo\xeb')) + encode_record(('stop',))
+        decoder = RecordDecoder()
+        received = []
+        for i in range(len(data)):
+            received.extend(decoder.feed(data[i]))
+        self.assertEqual(received, [('send', u'Zo\xeb'), ('stop',)])
+
+
+class RecordingClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+
+class TestReadCommands(VumiTestCase):
+
+    def test_refresh_state(self):
+        stream = StringIO(''.join(encode_record(record) for record in [
+            ('refresh_state', {'identity': 'x'}, None),
+            ('reconnect',),
+            ('stop',)]))
+        client = RecordingClient()
+        read_commands(stream, client)
+        self.assertEqual(client.calls, [
+            ('refresh_state', {'identity': 'x'}, None),
+            ('reconnect',),
+            ('client_stop',)])
+
+
+class TestProcessStackTransport(VumiTestCase):
+
+    timeout = 30
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(WhatsAppTransport))
+        self.config = {
+            'phone': '27010203040',
+            'password': base64.b64encode("xxx"),
+            'stack_mode': 'process',
+            'stack_process_setup':
+                'vxyowsup.tests.test_whatsapp.use_auto_ack_stack',
+            'publish_status': True,
+            'reconnect_delay': 0.1,
+            'reconnect_jitter': 0,
+        }
+        self.transport = yield self.tx_helper.get_transport(self.config)
+
+    def test_uses_process_client(self):
+        self.assertTrue(
+            isinstance(self.transport.stack_client, ProcessStackClient))
+
+    @inlineCallbacks
+    def test_outbound_acked(self):
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            content='hello', to_addr='27999', from_addr='vumi')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_child_started_again_after_ending(self):
+        client = self.transport.stack_client
+        first = client.protocol
+        self.tx_helper.clear_dispatched_statuses()
+        first.transport.signalProcess('KILL')
+        [status] = yield self.tx_helper.wait_for_dispatched_statuses(1)
+        self.assertEqual(
+            (status['component'], status['status'], status['type']),
+            ('connection', 'down', 'disconnected'))
+        self.assertTrue(client.scheduler.held)
+        self.assertEqual(
+            self.transport.metrics.get('stack.process_ended'), 1)
+
+        # The reconnector starts a new child, which connects.
+        while client.protocol in (None, first):
+            yield deferLater(reactor, 0.05, lambda: None)
+        yield self.transport.handle_connected(msisdn=client.msisdn)
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            content='hello', to_addr='27999', from_addr='vumi')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
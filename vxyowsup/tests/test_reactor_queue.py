@@ -0,0 +1,76 @@
+from twisted.internet.defer import fail
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.reactor_queue import ReactorQueue
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, f, *args, **kw):
+        self.calls.append((f, args, kw))
+
+    def run_calls(self):
+        calls, self.calls = self.calls, []
+        for f, args, kw in calls:
+            f(*args, **kw)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def record(self, *args, **kw):
+        self.calls.append((args, kw))
+
+    def broken(self):
+        return fail(ValueError('broken'))
+
+
+class TestReactorQueue(VumiTestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.target = Recorder()
+        self.queue = ReactorQueue(self.target, reactor=self.reactor)
+
+    def test_calls_batched_into_one_wakeup(self):
+        self.queue.call('record', 1)
+        self.queue.call('record', 2, foo='bar')
+        self.queue.call('record', 3)
+        self.assertEqual(len(self.reactor.calls), 1)
+        self.assertEqual(len(self.queue), 3)
+
+        self.reactor.run_calls()
+        self.assertEqual(self.target.calls, [
+            ((1,), {}), ((2,), {'foo': 'bar'}), ((3,), {})])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.metrics.get('reactor_queue.wakeups'), 1)
+        self.assertEqual(
+            self.queue.metrics.histogram('reactor_queue.batch_size').max, 3)
+
+    def test_new_wakeup_after_drain(self):
+        self.queue.call('record', 1)
+        self.reactor.run_calls()
+        self.queue.call('record', 2)
+        self.assertEqual(len(self.reactor.calls), 1)
+        self.reactor.run_calls()
+        self.assertEqual(self.target.calls, [((1,), {}), ((2,), {})])
+
+    def test_errors_logged(self):
+        self.queue.call('broken')
+        self.queue.call('record', 1)
+        self.reactor.run_calls()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(self.target.calls, [((1,), {})])
+
+    def test_calls_timed(self):
+        timings = []
+        self.queue.timer = lambda name, elapsed: timings.append(name)
+        self.queue.call('record', 1)
+        self.queue.call('broken')
+        self.reactor.run_calls()
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(timings, ['record', 'broken'])
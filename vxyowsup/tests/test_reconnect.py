@@ -0,0 +1,71 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.reconnect import Reconnector
+
+
+class TestReconnector(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.attempts = []
+
+    def get_reconnector(self, **kw):
+        kw.setdefault('clock', self.clock)
+        kw.setdefault('jitter', 0)
+        return Reconnector(lambda: self.attempts.append(True), **kw)
+
+    def test_backoff(self):
+        reconnector = self.get_reconnector(delay=1, max_delay=5)
+        self.assertEqual(
+            [reconnector.disconnected() for i in range(5)], [1, 2, 4, 5, 5])
+        self.clock.advance(5)
+        self.assertEqual(self.attempts, [True])
+        self.assertEqual(reconnector.metrics.get('reconnect.attempts'), 1)
+        self.assertEqual(reconnector.metrics.get('reconnect.disconnects'), 1)
+
+    def test_jitter(self):
+        reconnector = self.get_reconnector(
+            delay=4, jitter=0.5, random=lambda: 0.5)
+        self.assertEqual(reconnector.disconnected(), 3)
+
+    def test_connected_cancels_attempt(self):
+        reconnector = self.get_reconnector()
+        reconnector.disconnected()
+        self.clock.advance(0.5)
+        reconnector.connected()
+        self.clock.advance(1)
+        self.assertEqual(self.attempts, [])
+        self.assertEqual(
+            reconnector.metrics.histogram('reconnect.downtime').max, 0.5)
+
+    def test_flapping_keeps_backing_off(self):
+        reconnector = self.get_reconnector(stable_after=10)
+        self.assertEqual(reconnector.disconnected(), 1)
+        reconnector.connected()
+        self.clock.advance(5)
+        self.assertEqual(reconnector.disconnected(), 2)
+        reconnector.connected()
+        self.clock.advance(10)
+        self.assertEqual(reconnector.disconnected(), 1)
+
+    def test_circuit(self):
+        reconnector = self.get_reconnector(
+            max_delay=30, failure_threshold=2)
+        reconnector.disconnected()
+        self.assertFalse(reconnector.circuit_open)
+        self.assertEqual(reconnector.disconnected(), 30)
+        self.assertTrue(reconnector.circuit_open)
+        reconnector.connected()
+        self.assertFalse(reconnector.circuit_open)
+        reconnector.disconnected()
+        self.assertTrue(reconnector.circuit_open)
+
+    def test_stop(self):
+        reconnector = self.get_reconnector()
+        reconnector.disconnected()
+        reconnector.stop()
+        self.assertEqual(reconnector.disconnected(), None)
+        self.clock.advance(10)
+        self.assertEqual(self.attempts, [])
@@ -0,0 +1,77 @@
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.routing import StackRouter, RoutingError
+
+
+class FakeScheduler(object):
+    def __init__(self, queued):
+        self.queued = queued
+        self.held = False
+
+
+class FakeClient(object):
+    def __init__(self, msisdn, queued=0):
+        self.msisdn = msisdn
+        self.scheduler = FakeScheduler(queued)
+
+
+def mkmsg(to_addr, from_addr='vumi'):
+    return {'to_addr': to_addr, 'from_addr': from_addr}
+
+
+class TestStackRouter(VumiTestCase):
+
+    def setUp(self):
+        self.clients = [
+            FakeClient('+271', queued=5), FakeClient('+272', queued=1),
+            FakeClient('+273', queued=3)]
+
+    def test_unknown_strategy(self):
+        self.assertRaises(RoutingError, StackRouter, self.clients, 'random')
+
+    def test_from_our_number(self):
+        router = StackRouter(self.clients, 'round_robin')
+        for i in range(3):
+            self.assertEqual(
+                router.route(mkmsg('+2799', from_addr='+273')),
+                self.clients[2])
+
+    def test_round_robin(self):
+        router = StackRouter(self.clients, 'round_robin')
+        self.assertEqual(
+            [router.route(mkmsg('+2799')) for i in range(4)],
+            self.clients + self.clients[:1])
+
+    def test_least_queued(self):
+        router = StackRouter(self.clients, 'least_queued')
+        self.assertEqual(router.route(mkmsg('+2799')), self.clients[1])
+        self.clients[1].scheduler.queued = 10
+        self.assertEqual(router.route(mkmsg('+2799')), self.clients[2])
+
+    def test_sticky(self):
+        router = StackRouter(self.clients, 'sticky')
+        chosen = set(router.route(mkmsg('+2799')) for i in range(5))
+        self.assertEqual(len(chosen), 1)
+        recipients = ['+27%s' % i for i in range(20)]
+        chosen = set(router.route(mkmsg(to_addr)) for to_addr in recipients)
+        self.assertEqual(len(chosen), 3)
+
+    def test_sticky_to_addr(self):
+        router = StackRouter(self.clients, 'sticky')
+        for to_addr in ['+27%s' % i for i in range(5)]:
+            self.assertEqual(
+                router.route(mkmsg('+2799'), to_addr),
+                router.route(mkmsg(to_addr)))
+
+    def test_skips_disconnected(self):
+        router = StackRouter(self.clients, 'round_robin')
+        self.clients[1].scheduler.held = True
+        self.assertEqual(
+            [router.route(mkmsg('+2799')) for i in range(3)],
+            [self.clients[0], self.clients[2], self.clients[0]])
+
+    def test_all_disconnected(self):
+        router = StackRouter(self.clients, 'least_queued')
+        for client in self.clients:
+            client.scheduler.held = True
+        self.assertEqual(router.route(mkmsg('+2799')), self.clients[1])
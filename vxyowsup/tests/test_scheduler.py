@@ -0,0 +1,196 @@
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.scheduler import TokenBucket, OutboundScheduler
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0, 1, clock=self.clock)
+        for i in range(100):
+            self.assertTrue(bucket.consume())
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3, clock=self.clock)
+        self.assertEqual([bucket.consume() for i in range(4)], [
+            True, True, True, False])
+        self.assertEqual(bucket.delay(), 0.5)
+        self.clock.advance(0.5)
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_is_full(self):
+        bucket = TokenBucket(1, 2, clock=self.clock)
+        self.assertTrue(bucket.is_full())
+        bucket.consume()
+        self.assertFalse(bucket.is_full())
+        self.clock.advance(1)
+        self.assertTrue(bucket.is_full())
+
+
+class TestOutboundScheduler(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sent = []
+        self.pauses = []
+
+    def get_scheduler(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return OutboundScheduler(
+            self.sent.append,
+            pause=lambda: self.pauses.append('pause'),
+            unpause=lambda: self.pauses.append('unpause'), **kw)
+
+    def test_unlimited_sends_immediately(self):
+        scheduler = self.get_scheduler()
+        scheduler.enqueue('msg1', '+271')
+        scheduler.enqueue('msg2', '+271')
+        self.assertEqual(self.sent, ['msg1', 'msg2'])
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_rate_limited(self):
+        scheduler = self.get_scheduler(rate=2, burst=1)
+        for i in range(3):
+            scheduler.enqueue('msg%s' % i, '+27%s' % i)
+        self.assertEqual(self.sent, ['msg0'])
+        self.assertEqual(scheduler.metrics.gauge('outbound.queue_depth'), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, ['msg0', 'msg1'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(scheduler.metrics.gauge('outbound.queue_depth'), 0)
+        self.assertEqual(
+            scheduler.metrics.histogram('outbound.wait_time').max, 1)
+
+    def test_one_timer_while_throttled(self):
+        scheduler = self.get_scheduler(rate=1, burst=1)
+        for i in range(50):
+            scheduler.enqueue('msg%d' % (i,), '+27%d' % (i,))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['msg0', 'msg1'])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_recipient_rate_limited(self):
+        scheduler = self.get_scheduler(recipient_rate=1)
+        scheduler.enqueue('a1', '+27a')
+        scheduler.enqueue('a2', '+27a')
+        scheduler.enqueue('b1', '+27b')
+        self.assertEqual(self.sent, ['a1', 'b1'])
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['a1', 'b1', 'a2'])
+
+    def test_recipient_backlog_does_not_hold_up_others(self):
+        scheduler = self.get_scheduler(recipient_rate=1)
+        for i in range(100):
+            scheduler.enqueue('a%d' % (i,), '+27a')
+        scheduler.enqueue('b0', '+27b')
+        self.assertEqual(self.sent, ['a0', 'b0'])
+        self.assertEqual(
+            sorted(scheduler.recipient_buckets), ['+27a', '+27b'])
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['a0', 'b0', 'a1'])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_idle_recipient_buckets_dropped(self):
+        scheduler = self.get_scheduler(recipient_rate=1)
+        scheduler.enqueue('a0', '+27a')
+        scheduler.enqueue('a1', '+27a')
+        scheduler.enqueue('b0', '+27b')
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['a0', 'b0', 'a1'])
+        self.assertEqual(scheduler.recipient_buckets.keys(), ['+27a'])
+        scheduler.enqueue('c0', '+27c')
+        self.assertEqual(sorted(scheduler.recipient_buckets), ['+27a', '+27c'])
+        self.clock.advance(1)
+        scheduler.enqueue('d0', '+27d')
+        self.assertEqual(scheduler.recipient_buckets.keys(), ['+27d'])
+
+    def test_release_with_recipient_rate(self):
+        scheduler = self.get_scheduler(recipient_rate=1)
+        scheduler.enqueue('a0', '+27a', key='id0')
+        scheduler.hold()
+        scheduler.enqueue('a1', '+27a', key='id1')
+        scheduler.enqueue('b0', '+27b', key='id2')
+        self.clock.advance(1)
+        scheduler.release()
+        self.assertEqual(self.sent, ['a0', 'a0', 'b0'])
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['a0', 'a0', 'b0', 'a1'])
+
+    def test_reply_lane_first(self):
+        scheduler = self.get_scheduler(rate=1)
+        scheduler.enqueue('bulk0', '+270')
+        scheduler.enqueue('bulk1', '+271')
+        scheduler.enqueue('reply', '+272', lane='reply')
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['bulk0', 'reply'])
+
+    def test_pause_and_unpause(self):
+        scheduler = self.get_scheduler(rate=1, max_queued=4)
+        for i in range(5):
+            scheduler.enqueue('msg%s' % i, '+27%s' % i)
+        self.assertEqual(self.pauses, ['pause'])
+        self.clock.advance(1)
+        self.assertEqual(self.pauses, ['pause'])
+        self.clock.advance(1)
+        self.assertEqual(self.pauses, ['pause', 'unpause'])
+
+    def test_stop(self):
+        scheduler = self.get_scheduler(rate=1)
+        scheduler.enqueue('msg0', '+270')
+        scheduler.enqueue('msg1', '+271')
+        scheduler.stop()
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ['msg0'])
+
+    def test_hold_and_release(self):
+        scheduler = self.get_scheduler()
+        scheduler.enqueue('msg0', '+270', key='id0')
+        scheduler.enqueue('msg1', '+271', key='id1')
+        scheduler.enqueue('msg2', '+272', key='id2')
+        scheduler.done('id1')
+        scheduler.hold()
+        scheduler.enqueue('msg3', '+273', key='id3')
+        self.assertEqual(self.sent, ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(scheduler.queued, 1)
+
+        scheduler.release()
+        self.assertEqual(
+            self.sent, ['msg0', 'msg1', 'msg2', 'msg0', 'msg2', 'msg3'])
+        self.assertEqual(scheduler.metrics.get('outbound.resent'), 2)
+
+    def test_release_without_hold(self):
+        scheduler = self.get_scheduler()
+        scheduler.enqueue('msg0', '+270', key='id0')
+        scheduler.release()
+        self.assertEqual(self.sent, ['msg0'])
+
+    def test_max_in_flight(self):
+        scheduler = self.get_scheduler(max_in_flight=2)
+        for i in range(3):
+            scheduler.enqueue('msg%s' % i, '+27%s' % i, key='id%s' % i)
+        self.assertEqual(scheduler.in_flight.keys(), ['id1', 'id2'])
+
+    def test_drain_rate(self):
+        scheduler = self.get_scheduler(drain_rate=2)
+        scheduler.hold()
+        for i in range(3):
+            scheduler.enqueue('msg%s' % i, '+27%s' % i)
+        scheduler.release()
+        self.assertEqual(self.sent, ['msg0'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, ['msg0', 'msg1'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.sent, ['msg0', 'msg1', 'msg2'])
+        self.assertEqual(scheduler.drain_bucket, None)
+        scheduler.enqueue('msg3', '+273')
+        scheduler.enqueue('msg4', '+274')
+        self.assertEqual(self.sent[3:], ['msg3', 'msg4'])
@@ -0,0 +1,110 @@
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxyowsup.util import BatchWriter, LRUCache, timeout_after
+
+
+class TestTimeoutAfter(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_fires_in_time(self):
+        d = timeout_after(Deferred(), 5, self.clock)
+        d.callback('done')
+        self.assertEqual(self.successResultOf(d), 'done')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_times_out(self):
+        d = timeout_after(Deferred(), 5, self.clock)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, TimeoutError)
+
+
+class ListWriter(BatchWriter):
+
+    def __init__(self, **kw):
+        super(ListWriter, self).__init__(**kw)
+        self.pending = []
+        self.batches = []
+        self.writes = []
+
+    def add(self, item):
+        self.pending.append(item)
+        self._changed(len(self.pending))
+
+    def _write_pending(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            self.batches.append(batch)
+            self.writes.append(self._track(Deferred()))
+
+
+class TestBatchWriter(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_written_after_interval_or_size(self):
+        writer = ListWriter(batch_size=3, batch_interval=1, clock=self.clock)
+        writer.add(1)
+        writer.add(2)
+        self.assertEqual(writer.batches, [])
+        self.clock.advance(1)
+        self.assertEqual(writer.batches, [[1, 2]])
+        for item in [3, 4, 5]:
+            writer.add(item)
+        self.assertEqual(writer.batches, [[1, 2], [3, 4, 5]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush_waits_for_writes(self):
+        writer = ListWriter(batch_size=3, batch_interval=1, clock=self.clock)
+        writer.add(1)
+        d = writer.flush()
+        self.assertEqual(writer.batches, [[1]])
+        self.assertNoResult(d)
+        writer.writes[0].callback(None)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(writer._writes, set())
+
+
+class TestLRUCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_and_set(self):
+        cache = LRUCache(2, 10, clock=self.clock)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.metrics.get('cache.hits'), 1)
+        self.assertEqual(cache.metrics.get('cache.misses'), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2, 10, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.metrics.get('cache.evictions'), 1)
+
+    def test_expires_after_ttl(self):
+        cache = LRUCache(2, 10, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.metrics.get('cache.evictions'), 1)
+
+    def test_disabled(self):
+        cache = LRUCache(0, 10, clock=self.clock)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
@@ -1,16 +1,33 @@
 # -*- coding: UTF-8 -*-
 
+import asyncore
 import base64
+import os
+import random
+import threading
 import time
+from collections import deque
 
-from twisted.internet.defer import inlineCallbacks, DeferredQueue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredQueue, fail)
 from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.web.client import Agent, readBody
 
+from vumi.config import ConfigError
 from vumi.tests.helpers import VumiTestCase
 from vumi.message import TransportUserMessage
+from vumi.persist.txredis_manager import TxRedisManager
 from vumi.transports.tests.helpers import TransportHelper
 
-from vxyowsup.whatsapp import WhatsAppTransport, msisdn_to_whatsapp
+from vxyowsup.axolotl_store import StoredAxolotlLayer
+from vxyowsup.capture import INBOUND, OUTBOUND, read_capture
+from vxyowsup.media import MediaError
+from vxyowsup.message_store import pack_vumi_id, whatsapp_id_time
+from vxyowsup.tests.test_media import CONTENT, CONTENT_HASH, MediaServer
+from vxyowsup.whatsapp import (
+    WhatsAppTransport, LoopWaker, msisdn_to_whatsapp)
+from yowsup.common.tools import StorageTools
 from yowsup.stacks import YowStackBuilder
 from yowsup.layers.logger import YowLoggerLayer
 from yowsup.layers import YowLayer
@@ -18,10 +35,20 @@ from yowsup.layers.interface import YowInterfaceLayer
 from yowsup.layers.protocol_messages.protocolentities import (
     TextMessageProtocolEntity)
 from yowsup.layers.protocol_acks.protocolentities import AckProtocolEntity
+from yowsup.layers.protocol_contacts.protocolentities import (
+    ResultSyncIqProtocolEntity)
+from yowsup.layers.protocol_iq.protocolentities import ErrorIqProtocolEntity
+from yowsup.layers.protocol_media.protocolentities import (
+    ImageDownloadableMediaMessageProtocolEntity,
+    LocationMediaMessageProtocolEntity, ResultRequestUploadIqProtocolEntity)
+from yowsup.layers.auth.protocolentities import SuccessProtocolEntity
 from yowsup.layers.protocol_receipts.protocolentities import (
     IncomingReceiptProtocolEntity)
 from yowsup.layers.interface.interface import YowLayerEvent
 from yowsup.layers.network import YowNetworkLayer
+from yowsup.layers.axolotl import YowAxolotlLayer
+
+from axolotl.util.keyhelper import KeyHelper
 
 
 string_of_doom = u"Zoë the Destroyer of ASCII".encode("UTF-8")
@@ -97,7 +124,7 @@ class TestWhatsAppTransport(VumiTestCase):
     @inlineCallbacks
     def assert_ack(self, ack, node):
         whatsapp_id = node['id']
-        vumi_id = yield self.redis.get(whatsapp_id)
+        vumi_id = yield self.transport.message_ids.get(whatsapp_id)
         self.assertEqual(ack.payload['event_type'], 'ack')
         self.assertEqual(ack.payload['user_message_id'], vumi_id)
         self.assertEqual(ack.payload['sent_message_id'], whatsapp_id)
@@ -116,6 +143,14 @@ class TestWhatsAppTransport(VumiTestCase):
         jid = msisdn_to_whatsapp(number)
         layer.skipEncJids.append(jid)
 
+    def share_redis(self, transport):
+        '''Makes transports started from now on use ``transport``'s fake
+        redis.'''
+        fake_redis = transport.redis._client
+        fake_manager = TxRedisManager._fake_manager.__func__
+        self.patch(TxRedisManager, '_fake_manager', classmethod(
+            lambda cls, _redis, config: fake_manager(cls, fake_redis, config)))
+
     @inlineCallbacks
     def test_outbound(self):
         self.add_auth_skip(self.config.get('phone'))
@@ -148,6 +183,189 @@ class TestWhatsAppTransport(VumiTestCase):
         receipts = self.tx_helper.get_dispatched_events()
         self.assertFalse(receipts)
 
+    @inlineCallbacks
+    def test_outbound_id_mapping_written(self):
+        self.add_auth_skip(self.config.get('phone'))
+        message_sent = yield self.tx_helper.make_dispatch_outbound(
+            content='fail!', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        node_received = yield self.testing_layer.data_received.get()
+        yield self.transport.message_ids.flush()
+        vumi_id = yield self.redis.get(node_received['id'])
+        self.assertEqual(vumi_id, message_sent['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_journaled_until_ack(self):
+        self.add_auth_skip(self.config.get('phone'))
+        message_sent = yield self.tx_helper.make_dispatch_outbound(
+            content='fail!', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        node_received = yield self.testing_layer.data_received.get()
+        yield self.transport.journal.flush()
+        entries = yield self.redis.hgetall('outbound_journal:+27010203040')
+        self.assertEqual(entries.keys(), [message_sent['message_id']])
+
+        self.testing_layer.send_ack(node_received)
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        yield self.transport.journal.flush()
+        entries = yield self.redis.hgetall('outbound_journal:+27010203040')
+        self.assertEqual(entries, {})
+
+    @inlineCallbacks
+    def test_outbound_recovered(self):
+        self.add_auth_skip(self.config.get('phone'))
+        message = self.tx_helper.make_outbound(
+            content='lost', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        self.transport.journal.append('+27010203040', message)
+        yield self.transport.journal.flush()
+
+        yield self.transport.recover_outbound(self.transport.stack_client)
+        node_received = yield self.testing_layer.data_received.get()
+        self.assertEqual(node_received.getChild('body').getData(), 'lost')
+        self.testing_layer.send_ack(node_received)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], message['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_held_while_disconnected(self):
+        self.add_auth_skip(self.config.get('phone'))
+        msisdn = self.transport.stack_client.msisdn
+        self.transport.stack_client.reconnector.clock = Clock()
+        yield self.tx_helper.make_dispatch_outbound(
+            content='one', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        node1 = yield self.testing_layer.data_received.get()
+
+        # While we're disconnected the connector is paused, so the message
+        # is handed to the transport directly.
+        yield self.transport.handle_disconnected(
+            'Test disconnect', msisdn=msisdn)
+        self.transport.handle_outbound_message(self.tx_helper.make_outbound(
+            content='two', to_addr=self.config.get('phone'),
+            from_addr='vumi'))
+        self.assertEqual(self.transport.stack_client.scheduler.queued, 1)
+
+        # The first message was never acked, so it goes out again first.
+        yield self.transport.handle_connected(msisdn=msisdn)
+        resent = yield self.testing_layer.data_received.get()
+        node2 = yield self.testing_layer.data_received.get()
+        self.assertEqual(resent['id'], node1['id'])
+        self.assertEqual(node2.getChild('body').getData(), 'two')
+
+    @inlineCallbacks
+    def test_outbound_bulk(self):
+        recipients = ['+27111', '+27222']
+        for recipient in recipients:
+            self.add_auth_skip(recipient)
+        message_sent = yield self.tx_helper.make_dispatch_outbound(
+            content='everyone', to_addr='+27111', from_addr='vumi',
+            helper_metadata={'whatsapp': {'recipients': recipients}})
+        node1 = yield self.testing_layer.data_received.get()
+        node2 = yield self.testing_layer.data_received.get()
+        self.assertEqual(
+            [node1['to'], node2['to']],
+            ['27111@s.whatsapp.net', '27222@s.whatsapp.net'])
+        self.assertEqual(
+            node1.getChild('body').getData(),
+            node2.getChild('body').getData())
+
+        # The journal entry stays until every recipient has been acked.
+        self.testing_layer.send_ack(node1)
+        [ack1] = yield self.tx_helper.wait_for_dispatched_events(1)
+        yield self.transport.journal.flush()
+        entries = yield self.redis.hgetall('outbound_journal:+27010203040')
+        self.assertEqual(entries.keys(), [message_sent['message_id']])
+
+        self.testing_layer.send_ack(node2)
+        [_, ack2] = yield self.tx_helper.wait_for_dispatched_events(2)
+        yield self.transport.journal.flush()
+        entries = yield self.redis.hgetall('outbound_journal:+27010203040')
+        self.assertEqual(entries, {})
+        self.assertEqual(
+            [(ack['user_message_id'], ack['sent_message_id'])
+             for ack in [ack1, ack2]],
+            [(message_sent['message_id'], node1['id']),
+             (message_sent['message_id'], node2['id'])])
+
+        self.tx_helper.clear_dispatched_events()
+        self.testing_layer.send_receipt(node2)
+        [receipt] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assert_receipt(receipt, node2, message_sent['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_bulk_unacked_expire(self):
+        recipients = ['+27111', '+27222']
+        for recipient in recipients:
+            self.add_auth_skip(recipient)
+        first = yield self.tx_helper.make_dispatch_outbound(
+            content='first', to_addr='+27111', from_addr='vumi',
+            helper_metadata={'whatsapp': {'recipients': recipients}})
+        unacked = self.transport.unacked_recipients
+        self.assertEqual(unacked.keys(), [first['message_id']])
+        # Never acked, and now older than ack_timeout.
+        expires, whatsapp_ids = unacked[first['message_id']]
+        unacked[first['message_id']] = (
+            expires - self.transport.config.ack_timeout, whatsapp_ids)
+
+        second = yield self.tx_helper.make_dispatch_outbound(
+            content='second', to_addr='+27111', from_addr='vumi',
+            helper_metadata={'whatsapp': {'recipients': recipients}})
+        self.assertEqual(unacked.keys(), [second['message_id']])
+
+    @inlineCallbacks
+    def test_outbound_bulk_bad_recipients(self):
+        message_sent = yield self.tx_helper.make_dispatch_outbound(
+            content='everyone', to_addr='+27111', from_addr='vumi',
+            helper_metadata={'whatsapp': {'recipients': []}})
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], message_sent['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_stage_metrics(self):
+        self.add_auth_skip(self.config.get('phone'))
+        yield self.tx_helper.make_dispatch_outbound(
+            content='timed', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        node_received = yield self.testing_layer.data_received.get()
+        self.testing_layer.send_ack(node_received)
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        self.testing_layer.send_receipt(node_received)
+        yield self.tx_helper.wait_for_dispatched_events(2)
+
+        metrics = self.transport.metrics
+        for name in ['outbound.wait_time', 'outbound.stack_hop',
+                     'outbound.send_to_ack', 'outbound.send_to_receipt',
+                     'reactor_queue.hop_delay']:
+            self.assertTrue(metrics.histogram(name).count >= 1, name)
+        self.assertEqual(metrics.gauge('outbound.in_flight'), 0)
+        self.assertEqual(len(self.transport.stage_timer), 0)
+
+    @inlineCallbacks
+    def test_metrics_published(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, metrics_prefix='whatsapp.'))
+        transport.metrics.incr('outbound.resent')
+        transport.metrics_publisher.publish_metrics()
+        [datapoints] = yield self.tx_helper.wait_for_dispatched_metrics()
+        published = dict((name, values) for name, _aggs, values in datapoints)
+        self.assertEqual(
+            [value for _time, value in published['whatsapp.outbound.resent']],
+            [1])
+        self.assertTrue('whatsapp.stack.detached_calls' in published)
+
+    @inlineCallbacks
+    def test_metrics_served(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, metrics_port=0))
+        transport.metrics.incr('outbound.resent')
+        port = transport.metrics_server.getHost().port
+        response = yield Agent(reactor).request(
+            'GET', 'http://127.0.0.1:%d/metrics' % (port,))
+        body = yield readBody(response)
+        self.assertIn('vxyowsup_outbound_resent 1\n', body)
+
     @inlineCallbacks
     def test_publish(self):
         message_sent = yield self.testing_layer.send_to_transport(
@@ -158,6 +376,614 @@ class TestWhatsAppTransport(VumiTestCase):
         self.assert_messages_equal(
             PTNode_to_TUMessage(message_sent, '+27010203040'),
             message_received)
+        self.assertEqual(self.transport.metrics.histogram(
+            'inbound.receive_to_publish').count, 1)
+
+    @inlineCallbacks
+    def test_read_receipts_batched(self):
+        message1 = self.testing_layer.send_to_transport(
+            text='one', from_address='123345@s.whatsapp.net')
+        message2 = self.testing_layer.send_to_transport(
+            text='two', from_address='123345@s.whatsapp.net')
+        receipt = yield self.testing_layer.data_received.get()
+        self.assertEqual(receipt.tag, 'receipt')
+        self.assertEqual(receipt['type'], 'read')
+        self.assertEqual(receipt['to'], '123345@s.whatsapp.net')
+        self.assertEqual(
+            [item['id'] for item in receipt.getChild('list').getAllChildren()],
+            [message1['id'], message2['id']])
+
+    @inlineCallbacks
+    def test_read_receipts_unbatched(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, inbound_receipt_batch_interval=0))
+        layer = transport.stack_client.network_layer
+        message1 = layer.send_to_transport(
+            text='one', from_address='123345@s.whatsapp.net')
+        receipt = yield layer.data_received.get()
+        self.assertEqual(receipt['id'], message1['id'])
+        self.assertEqual(receipt.getChild('list'), None)
+
+    @inlineCallbacks
+    def test_receipts_after_publish(self):
+        transport = yield self.tx_helper.get_transport(dict(
+            self.config, inbound_receipts='after_publish',
+            inbound_receipt_type='delivered',
+            inbound_receipt_batch_interval=0))
+        layer = transport.stack_client.network_layer
+        published = Deferred()
+        self.patch(transport, 'publish_message', lambda **kw: published)
+
+        message = layer.send_to_transport(
+            text='hi', from_address='123345@s.whatsapp.net')
+        yield deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(layer.data_received.pending, [])
+        self.assertEqual(transport.metrics.gauge('inbound.in_flight'), 1)
+
+        published.callback(None)
+        receipt = yield layer.data_received.get()
+        self.assertEqual(receipt['id'], message['id'])
+        self.assertEqual(receipt['type'], None)
+        self.assertEqual(transport.metrics.gauge('inbound.in_flight'), 0)
+
+    def test_bad_inbound_receipts(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, inbound_receipts='never'))
+
+    @inlineCallbacks
+    def test_axolotl_store_in_redis(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, axolotl_store='redis'))
+        layer = transport.stack_client.stack.getLayer(2)
+        self.assertTrue(isinstance(layer, StoredAxolotlLayer))
+        self.assertTrue(layer.isInitState())
+
+        layer.store.storePreKey(1, KeyHelper.generatePreKeys(1, 1)[0])
+        # The change reaches the transport through the reactor queue.
+        yield deferLater(reactor, 0.05, lambda: None)
+        yield transport.axolotl_state.flush()
+        state = yield transport.redis.hgetall('axolotl:+27010203040')
+        self.assertEqual(state.keys(), ['prekey:1'])
+        self.assertEqual(transport.metrics.get('axolotl.flushes'), 1)
+
+    def test_bad_axolotl_store(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, axolotl_store='disk'))
+
+    def test_bad_stack_mode(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, stack_mode='proces'))
+
+    def test_bad_routing(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, routing='random'))
+
+    def test_bad_log_level(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, log_level='verbose'))
+
+    @inlineCallbacks
+    def test_login_cached(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, cache_login=True))
+        transport.stack_client.whatsapp_interface.receive(
+            SuccessProtocolEntity(
+                'active', 'free', '1400000000', '1500000000', '1',
+                '1450000000', nonce='next-nonce'))
+        yield deferLater(reactor, 0.05, lambda: None)
+        state = yield transport.redis.hgetall('login:+27010203040')
+        self.assertEqual(state['nonce'], 'next-nonce')
+        self.assertEqual(state['status'], 'active')
+        self.assertEqual(transport.metrics.get('login.success'), 1)
+        self.assertEqual(
+            transport.metrics.histogram('startup.time_to_ready').count, 1)
+
+        # A transport started later (with the same redis) resumes from that
+        # login.
+        nonces = []
+        self.patch(StorageTools, 'writeNonce', staticmethod(
+            lambda phone, nonce: nonces.append((phone, nonce))))
+        self.share_redis(transport)
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, cache_login=True))
+        self.assertEqual(nonces, [('27010203040', 'next-nonce')])
+        self.assertEqual(transport.metrics.get('login.cached'), 1)
+
+    @inlineCallbacks
+    def test_outbound_bucketed_ids(self):
+        transport = yield self.tx_helper.get_transport(dict(
+            self.config, id_store_layout='buckets', id_cache_size=0))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            'hi', to_addr=self.config.get('phone'), from_addr='vumi')
+        transport.handle_outbound_message(msg)
+        node = yield layer.data_received.get()
+        yield transport.message_ids.flush()
+        bucket = yield transport.redis.hgetall('ids:%d' % (
+            whatsapp_id_time(node['id']) // 3600,))
+        self.assertEqual(bucket.values(), [pack_vumi_id(msg['message_id'])])
+
+        layer.send_ack(node)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        layer.send_receipt(node)
+        [_, receipt] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(receipt['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def get_media_transport(self, **config):
+        server = MediaServer()
+        self.add_cleanup(server.stop)
+        transport = yield self.tx_helper.get_transport(dict(
+            self.config, media=True, **config))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        returnValue((transport, server))
+
+    @inlineCallbacks
+    def test_outbound_media(self):
+        transport, server = yield self.get_media_transport()
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': server.url('image.jpg')}}})
+        transport.handle_outbound_message(msg)
+
+        request = yield layer.data_received.get()
+        self.assertEqual(request['xmlns'], 'w:m')
+        self.assertEqual(request.getChild('media')['hash'], CONTENT_HASH)
+        layer.receive(ResultRequestUploadIqProtocolEntity(
+            request['id'], server.url('upload')).toProtocolTreeNode())
+
+        node = yield layer.data_received.get()
+        media = node.getChild('media')
+        self.assertEqual(media['url'], 'http://media.example.com/served.jpg')
+        self.assertEqual(media['caption'], 'Look')
+        self.assertEqual(len(server.upload.uploads), 1)
+
+        # The same image again is sent without uploading it.
+        transport.handle_outbound_message(self.tx_helper.make_outbound(
+            'Again', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata=msg['helper_metadata']))
+        node = yield layer.data_received.get()
+        self.assertEqual(node.tag, 'message')
+        self.assertEqual(node.getChild('media')['url'], media['url'])
+        self.assertEqual(len(server.upload.uploads), 1)
+
+        layer.send_ack(node)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+
+    @inlineCallbacks
+    def test_outbound_media_recovered(self):
+        transport, server = yield self.get_media_transport()
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            None, to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': server.url('image.jpg')}}})
+        transport.journal.append('+27010203040', msg)
+        yield transport.journal.flush()
+
+        yield transport.recover_outbound(transport.stack_client)
+        request = yield layer.data_received.get()
+        self.assertEqual(request.getChild('media')['hash'], CONTENT_HASH)
+        layer.receive(ResultRequestUploadIqProtocolEntity(
+            request['id'], server.url('upload')).toProtocolTreeNode())
+        node = yield layer.data_received.get()
+        self.assertEqual(
+            node.getChild('media')['url'],
+            'http://media.example.com/served.jpg')
+        layer.send_ack(node)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_outbound_media_upload_refused(self):
+        transport, server = yield self.get_media_transport()
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': server.url('image.jpg')}}})
+        transport.handle_outbound_message(msg)
+        request = yield layer.data_received.get()
+        layer.receive(ErrorIqProtocolEntity(
+            request['id'], 's.whatsapp.net', '500',
+            'internal-server-error').toProtocolTreeNode())
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(transport.pending_iqs, {})
+        self.assertEqual(len(self.flushLoggedErrors(MediaError)), 1)
+
+    @inlineCallbacks
+    def test_outbound_media_rejected(self):
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': 'http://example.com/a.jpg'}}})
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'], 'Media messages are not enabled')
+
+        transport, _server = yield self.get_media_transport()
+        self.tx_helper.clear_dispatched_events()
+        transport.handle_outbound_message(self.tx_helper.make_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {'type': 'document'}}}))
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(
+            nack['nack_reason'],
+            'Media type must be one of: image, audio, video')
+
+        self.tx_helper.clear_dispatched_events()
+        transport.handle_outbound_message(self.tx_helper.make_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': '/etc/passwd'}}}))
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(
+            nack['nack_reason'], 'Media url must be http or https')
+
+    @inlineCallbacks
+    def test_inbound_media(self):
+        store_path = os.path.abspath(self.mktemp())
+        os.mkdir(store_path)
+        transport, server = yield self.get_media_transport(
+            media_store_path=store_path)
+        layer = transport.stack_client.network_layer
+        layer.receive(ImageDownloadableMediaMessageProtocolEntity(
+            'image/jpeg', CONTENT_HASH, server.url('image.jpg'), None,
+            len(CONTENT), 'photo.jpg', 'raw', 10, 20, 'Hello',
+            _from='123345@s.whatsapp.net').toProtocolTreeNode())
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'Hello')
+        self.assertEqual(msg['from_addr'], '+123345')
+        media = msg['helper_metadata']['whatsapp']['media']
+        self.assertEqual(media['type'], 'image')
+        self.assertEqual(media['url'], server.url('image.jpg'))
+        self.assertEqual(os.path.dirname(media['path']), store_path)
+        self.assertTrue(media['path'].endswith('.jpg'))
+        with open(media['path'], 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    @inlineCallbacks
+    def test_inbound_location(self):
+        transport, _server = yield self.get_media_transport()
+        layer = transport.stack_client.network_layer
+        layer.receive(LocationMediaMessageProtocolEntity(
+            '-33.9', '18.4', 'Cape Town', None, 'raw',
+            _from='123345@s.whatsapp.net').toProtocolTreeNode())
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], None)
+        self.assertEqual(msg['helper_metadata']['whatsapp']['media'], {
+            'type': 'location', 'latitude': '-33.9', 'longitude': '18.4',
+            'name': 'Cape Town', 'url': None,
+        })
+
+    def answer_sync(self, layer, request, users, non_users):
+        layer.receive(ResultSyncIqProtocolEntity(
+            request['id'], request.getChild('sync')['sid'], 0, True, '0',
+            dict(('+' + n, n + '@s.whatsapp.net') for n in users),
+            dict(('+' + n, n + '@s.whatsapp.net') for n in non_users),
+            []).toProtocolTreeNode())
+
+    @inlineCallbacks
+    def test_outbound_redelivered(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, dedupe_outbound=True))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            'once', to_addr=self.config.get('phone'), from_addr='vumi')
+        transport.handle_outbound_message(msg)
+        node = yield layer.data_received.get()
+        self.assertEqual(node.getChild('body').getData(), 'once')
+        # Redelivered before it is acked.
+        yield transport.handle_outbound_message(msg)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(
+            nack['nack_reason'], 'Duplicate of a message still being sent')
+        layer.send_ack(node)
+        yield self.tx_helper.wait_for_dispatched_events(2)
+        yield transport.sent_messages.flush()
+        self.tx_helper.clear_dispatched_events()
+
+        # Redelivered to a transport that has just started.
+        self.share_redis(transport)
+        restarted = yield self.tx_helper.get_transport(
+            dict(self.config, dedupe_outbound=True))
+        yield restarted.handle_outbound_message(msg)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(ack['sent_message_id'], node['id'])
+        self.assertEqual(restarted.metrics.get('dedupe.duplicates'), 1)
+        self.assertEqual(
+            restarted.stack_client.network_layer.data_received.pending, [])
+
+    @inlineCallbacks
+    def test_outbound_failed_not_deduped(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, dedupe_outbound=True, media=True))
+        msg = self.tx_helper.make_outbound(
+            'Look', to_addr=self.config.get('phone'), from_addr='vumi',
+            helper_metadata={'whatsapp': {'media': {
+                'type': 'image', 'url': 'http://127.0.0.1:0/a.jpg'}}})
+        self.patch(transport.media, 'upload', lambda *a, **kw: fail(
+            MediaError('No route')))
+        yield transport.handle_outbound_message(msg)
+        yield transport.handle_outbound_message(msg)
+        nacks = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual([nack['nack_reason'] for nack in nacks], [
+            'Failed to upload media: No route'] * 2)
+        self.assertEqual(transport.metrics.get('dedupe.duplicates'), 0)
+        self.assertEqual(len(self.flushLoggedErrors(MediaError)), 2)
+
+    @inlineCallbacks
+    def wait_connected(self, transport, client=None):
+        '''Connects ``transport``'s stack (or ``client``'s) once it has
+        started, and waits for the transport to hear about it.'''
+        if client is None:
+            client = transport.stack_client
+        yield client.connect_d
+        client.network_layer.connect()
+        while client.scheduler.held:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def next_message(self, transport, client=None):
+        '''The next message node ``transport``'s stack (or ``client``'s)
+        sends, skipping anything else it sends.'''
+        if client is None:
+            client = transport.stack_client
+        layer = client.network_layer
+        while True:
+            node = yield layer.data_received.get()
+            if node.tag == 'message':
+                returnValue(node)
+
+    @inlineCallbacks
+    def test_failover(self):
+        # Long enough that the fake redis's clock (which moves on with each
+        # command) doesn't expire the lease before we mean it to.
+        config = dict(self.config, failover=True, lease_ttl=3600)
+        self.share_redis(self.transport)
+        active = yield self.tx_helper.get_transport(
+            dict(config, node_id='a'))
+        standby = yield self.tx_helper.get_transport(
+            dict(config, node_id='b'))
+        yield self.wait_connected(active)
+        self.assertTrue(active.stack_client.lease.held)
+        self.assertFalse(standby.stack_client.lease.held)
+        # The standby's stack is built, but not started.
+        self.assertEqual(standby.started_clients, set())
+        for transport in (active, standby):
+            transport.stack_client.stack.getLayer(2).skipEncJids.append(
+                msisdn_to_whatsapp(self.config.get('phone')))
+
+        # Messages that reach the standby are passed on to the active copy.
+        msg = self.tx_helper.make_outbound(
+            'passed on', to_addr=self.config.get('phone'), from_addr='vumi')
+        yield standby.handle_outbound_message(msg)
+        self.assertEqual(standby.metrics.get('failover.forwarded'), 1)
+        yield active.collect_forwarded()
+        node = yield self.next_message(active)
+        self.assertEqual(node.getChild('body').getData(), 'passed on')
+
+        # The active copy stops renewing its lease, which expires.
+        active.stack_client.lease._loop.stop()
+        active.redis._client.clock.advance(3600)
+        yield standby.stack_client.lease.check()
+        self.assertTrue(standby.stack_client.lease.held)
+        yield self.wait_connected(standby)
+        self.assertEqual(standby.metrics.get('failover.takeovers'), 1)
+        # The message passed on was journaled once collected and never
+        # acked, so the standby sends it again.
+        node = yield self.next_message(standby)
+        self.assertEqual(node.getChild('body').getData(), 'passed on')
+        msg = self.tx_helper.make_outbound(
+            'after failover', to_addr=self.config.get('phone'),
+            from_addr='vumi')
+        standby.handle_outbound_message(msg)
+        node = yield self.next_message(standby)
+        self.assertEqual(node.getChild('body').getData(), 'after failover')
+
+        # The old active copy finds out, and stands by.
+        yield active.stack_client.lease.check()
+        self.assertFalse(active.stack_client.lease.held)
+        self.assertTrue(active.stack_client.scheduler.held)
+        self.assertEqual(active.metrics.get('failover.step_downs'), 1)
+
+    @inlineCallbacks
+    def test_capture(self):
+        capture_dir = self.mktemp()
+        os.mkdir(capture_dir)
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, capture_dir=capture_dir))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        layer = transport.stack_client.network_layer
+        layer.send_to_transport('hi', '27123@s.whatsapp.net')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        transport.handle_outbound_message(self.tx_helper.make_outbound(
+            'hello', to_addr=self.config.get('phone'), from_addr='vumi'))
+        node = yield self.next_message(transport)
+        layer.send_ack(node)
+        yield self.tx_helper.wait_for_dispatched_events(1)
+        transport.stack_client.whatsapp_interface.close_capture()
+
+        [name] = os.listdir(capture_dir)
+        self.assertTrue(name.startswith('27010203040-'))
+        records = [
+            (direction, captured.tag, captured['id'])
+            for _, direction, captured in read_capture(
+                os.path.join(capture_dir, name))
+            if captured.tag in ('message', 'ack')]
+        self.assertEqual(records[1:], [
+            (OUTBOUND, 'message', node['id']),
+            (INBOUND, 'ack', node['id'])])
+        self.assertEqual(records[0][:2], (INBOUND, 'message'))
+
+    @inlineCallbacks
+    def test_capture_failure(self):
+        capture_dir = self.mktemp()
+        os.mkdir(capture_dir)
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, capture_dir=capture_dir))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        interface = transport.stack_client.whatsapp_interface
+        capture = interface.capture
+
+        def broken(direction, node):
+            raise ValueError('Cannot encode')
+
+        self.patch(capture, 'write', broken)
+        # Sent all the same, and nothing more is captured.
+        transport.handle_outbound_message(self.tx_helper.make_outbound(
+            'hello', to_addr=self.config.get('phone'), from_addr='vumi'))
+        node = yield self.next_message(transport)
+        self.assertEqual(node.getChild('body').getData(), 'hello')
+        self.assertEqual(interface.capture, None)
+        self.assertEqual(capture._file, None)
+
+    @inlineCallbacks
+    def test_failover_recovers_taken_over_account(self):
+        config = dict(
+            self.config, failover=True, lease_ttl=3600, journal_outbound=True,
+            accounts=[
+                {'phone': '27010203040', 'password': base64.b64encode('xxx')},
+                {'phone': '27010203041', 'password': base64.b64encode('yyy')},
+            ])
+        self.share_redis(self.transport)
+        active = yield self.tx_helper.get_transport(
+            dict(config, node_id='a'))
+        for client in active.stack_clients:
+            client.stack.getLayer(2).skipEncJids.append(
+                msisdn_to_whatsapp('27999'))
+            yield self.wait_connected(active, client)
+            client.lease._loop.stop()
+        # One message on each account, neither acked.
+        for client, content in zip(active.stack_clients, ['one', 'two']):
+            yield active.handle_outbound_message(self.tx_helper.make_outbound(
+                content, to_addr='+27999', from_addr=client.msisdn))
+            yield self.next_message(active, client)
+        yield active.journal.flush()
+
+        standby = yield self.tx_helper.get_transport(
+            dict(config, node_id='b'))
+        for client in standby.stack_clients:
+            client.stack.getLayer(2).skipEncJids.append(
+                msisdn_to_whatsapp('27999'))
+        # The first account's lease expires, and only it is taken over.
+        yield active.redis.delete('lease:account:+27010203040')
+        yield standby.stack_clients[0].lease.check()
+        yield self.wait_connected(standby)
+        node = yield self.next_message(standby)
+        self.assertEqual(node.getChild('body').getData(), 'one')
+        self.assertEqual(standby.metrics.get('journal.recovered'), 1)
+        self.assertEqual(standby.started_clients, set(
+            standby.stack_clients[:1]))
+
+    @inlineCallbacks
+    def test_forwarded_collected_by_holder(self):
+        config = dict(
+            self.config, failover=True, lease_ttl=3600, accounts=[
+                {'phone': '27010203040', 'password': base64.b64encode('xxx')},
+                {'phone': '27010203041', 'password': base64.b64encode('yyy')},
+            ])
+        self.share_redis(self.transport)
+        # Another copy holds the second account.
+        yield self.redis.set('lease:account:+27010203041', 'other')
+        yield self.redis.expire('lease:account:+27010203041', 3600)
+        active = yield self.tx_helper.get_transport(
+            dict(config, node_id='a'))
+        ours, theirs = active.stack_clients
+        ours.stack.getLayer(2).skipEncJids.append(msisdn_to_whatsapp('27999'))
+        yield self.wait_connected(active)
+        self.assertFalse(theirs.lease.held)
+
+        # Left being collected by a holder that stopped.
+        left = self.tx_helper.make_outbound(
+            'left', to_addr='+27999', from_addr=ours.msisdn)
+        yield active.redis.lpush(
+            active.forwarded_key(ours) + ':collecting', left.to_json())
+        for content, client in [('new', ours), ('not ours', theirs)]:
+            yield active.forward_outbound(self.tx_helper.make_outbound(
+                content, to_addr='+27999', from_addr=client.msisdn))
+        yield active.collect_forwarded()
+        bodies = []
+        for _ in range(2):
+            node = yield self.next_message(active)
+            bodies.append(node.getChild('body').getData())
+        self.assertEqual(bodies, ['left', 'new'])
+        self.assertEqual(active.metrics.get('failover.collected'), 2)
+        # Messages for the other account are left for its holder.
+        self.assertEqual(
+            (yield active.redis.llen(active.forwarded_key(theirs))), 1)
+        self.assertEqual((yield active.redis.llen(
+            active.forwarded_key(ours) + ':collecting')), 0)
+
+    @inlineCallbacks
+    def test_check_contacts(self):
+        transport = yield self.tx_helper.get_transport(
+            dict(self.config, check_contacts=True))
+        transport.stack_client.stack.getLayer(2).skipEncJids.append(
+            msisdn_to_whatsapp(self.config.get('phone')))
+        layer = transport.stack_client.network_layer
+        msg = self.tx_helper.make_outbound(
+            'hi', to_addr='+27123', from_addr='vumi',
+            helper_metadata={'whatsapp': {'recipients': [
+                '+' + self.config.get('phone'), '+27123']}})
+        transport.handle_outbound_message(msg)
+
+        request = yield layer.data_received.get()
+        self.assertEqual(request['xmlns'], 'urn:xmpp:whatsapp:sync')
+        users = request.getChild('sync').getAllChildren()
+        self.assertEqual(
+            sorted(user.data for user in users), ['+27010203040', '+27123'])
+        self.answer_sync(layer, request, [self.config.get('phone')], ['27123'])
+
+        # Only the user is sent to.
+        node = yield layer.data_received.get()
+        self.assertEqual(node['to'], '27010203040@s.whatsapp.net')
+        self.assertEqual(transport.metrics.get('contacts.skipped'), 1)
+        self.assertEqual(
+            (yield transport.redis.get('contact:+27123')).split(' ')[1:],
+            [''])
+
+        # A known non-user is nacked without asking the server again.
+        msg = self.tx_helper.make_outbound(
+            'hi', to_addr='+27123', from_addr='vumi')
+        transport.handle_outbound_message(msg)
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(nack['nack_reason'], 'Not a WhatsApp user')
+        self.assertEqual(transport.metrics.get('contacts.syncs'), 1)
+        self.assertEqual(layer.data_received.pending, [])
+
+    def test_msisdn_to_whatsapp(self):
+        self.assertEqual(
+            msisdn_to_whatsapp('+27123'), '27123@s.whatsapp.net')
+        self.assertEqual(msisdn_to_whatsapp('27123'), '27123@s.whatsapp.net')
+
+    def test_bad_id_store_layout(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport,
+            dict(self.config, id_store_layout='lists'))
 
     @inlineCallbacks
     def test_non_ascii_outbound(self):
@@ -203,32 +1029,61 @@ class TestWhatsAppTransport(VumiTestCase):
             PTNode_to_TUMessage(message_sent, '+27010203040'),
             message_received)
 
+    @inlineCallbacks
+    def wait_for_inbound_health(self):
+        '''Waits until an inbound message has counted towards the inbound
+        component's health.'''
+        window = self.transport.health.windows['inbound']
+        while not any(window.totals()[:2]):
+            yield deferLater(reactor, 0.01, lambda: None)
+
     @inlineCallbacks
     def test_cannot_decode_message(self):
-        '''When the inbound message cannot be decoded, we should send a
-        degraded status message.'''
+        '''When inbound messages cannot be decoded, we should send a degraded
+        status message once the health of the inbound component is next
+        judged.'''
+        self.transport.health.min_events = 1
         self.testing_layer.send_to_transport(
             text=u'Hi Vumi! :)'.encode('utf-16'),
             from_address='123345@s.whatsapp.net')
+        yield self.wait_for_inbound_health()
+        self.assertEqual(
+            (yield self.tx_helper.get_dispatched_statuses()), [])
+        yield self.transport.health.check()
         [status] = yield self.tx_helper.wait_for_dispatched_statuses(1)
-        self.assertEqual(status['status'], 'degraded')
+        self.assertEqual(status['status'], 'down')
         self.assertEqual(status['component'], 'inbound')
         self.assertEqual(status['type'], 'inbound_error')
         self.assertEqual(status['message'], 'Cannot decode')
 
+    @inlineCallbacks
+    def test_single_decode_failure_not_reported(self):
+        '''One message that can't be decoded is not enough to judge the
+        inbound component by.'''
+        self.testing_layer.send_to_transport(
+            text=u'Hi Vumi! :)'.encode('utf-16'),
+            from_address='123345@s.whatsapp.net')
+        yield self.wait_for_inbound_health()
+        yield self.transport.health.check()
+        self.assertEqual(
+            (yield self.tx_helper.get_dispatched_statuses()), [])
+
     @inlineCallbacks
     def test_status_message_for_inbound_message(self):
-        '''If we are successfully able to decode the inbound message, we should
-        send a successful status message.'''
+        '''If we are successfully able to decode inbound messages, we should
+        send a successful status message once the health of the inbound
+        component is next judged.'''
         self.testing_layer.send_to_transport(
             text='Hi Vumi! :)',
             from_address='123345@s.whatsapp.net')
+        yield self.wait_for_inbound_health()
+        yield self.transport.health.check()
         [status] = yield self.tx_helper.wait_for_dispatched_statuses(1)
         self.assertEqual(status['status'], 'ok')
         self.assertEqual(status['component'], 'inbound')
         self.assertEqual(status['type'], 'inbound_success')
         self.assertEqual(
-            status['message'], 'Inbound message successfully processed')
+            status['message'], 'Inbound messages successfully processed')
 
     @inlineCallbacks
     def test_repeat_status(self):
@@ -237,9 +1092,11 @@ class TestWhatsAppTransport(VumiTestCase):
         self.testing_layer.send_to_transport(
             text='Hi Vumi! :)',
             from_address='123345@s.whatsapp.net')
+        yield self.wait_for_inbound_health()
+        yield self.transport.health.check()
         yield self.transport.add_status(
             component='inbound', status='ok', type='inbound_success',
-            message='Inbound message successfully processed')
+            message='Inbound messages successfully processed')
         statuses = yield self.tx_helper.get_dispatched_statuses()
         self.assertEqual(len(statuses), 1)
 
@@ -258,20 +1115,185 @@ class TestWhatsAppTransport(VumiTestCase):
     def test_disconnect_status(self):
         '''When we get a disconnection, the connection component status should
         be "down".'''
+        clock = self.transport.stack_client.reconnector.clock = Clock()
         self.testing_layer.disconnect()
-        [status, status_recon] = (
-            yield self.tx_helper.wait_for_dispatched_statuses(1))
+        [status] = yield self.tx_helper.wait_for_dispatched_statuses(1)
         self.assertEqual(status['status'], 'down')
         self.assertEqual(status['component'], 'connection')
         self.assertEqual(status['type'], 'disconnected')
         self.assertEqual(status['message'], 'Test disconnect')
 
+        self.tx_helper.clear_dispatched_statuses()
+        clock.advance(1)
+        [status_recon] = yield self.tx_helper.wait_for_dispatched_statuses(1)
         self.assertEqual(status_recon['status'], 'ok')
         self.assertEqual(status_recon['component'], 'connection')
         self.assertEqual(status_recon['type'], 'connected')
         self.assertEqual(
             status_recon['message'], 'Successfully connected to server')
 
+    @inlineCallbacks
+    def test_outbound_paused_while_disconnected(self):
+        msisdn = self.transport.stack_client.msisdn
+        self.transport.stack_client.reconnector.clock = Clock()
+        yield self.transport.handle_disconnected(
+            'Test disconnect', msisdn=msisdn)
+        self.assertTrue(self.transport.outbound_paused)
+        yield self.transport.handle_connected(msisdn=msisdn)
+        self.assertFalse(self.transport.outbound_paused)
+
+    @inlineCallbacks
+    def test_circuit_status(self):
+        reconnector = self.transport.stack_client.reconnector
+        reconnector.clock = Clock()
+        reconnector.failure_threshold = 2
+        msisdn = self.transport.stack_client.msisdn
+        yield self.transport.handle_disconnected('one', msisdn=msisdn)
+        yield self.transport.handle_disconnected('two', msisdn=msisdn)
+        statuses = yield self.tx_helper.wait_for_dispatched_statuses(2)
+        self.assertEqual(
+            [(status['component'], status['type']) for status in statuses],
+            [('connection', 'disconnected'), ('reconnect', 'circuit_open')])
+
+        self.tx_helper.clear_dispatched_statuses()
+        yield self.transport.handle_connected(msisdn=msisdn)
+        statuses = yield self.tx_helper.wait_for_dispatched_statuses(2)
+        self.assertEqual(
+            [(status['component'], status['type']) for status in statuses],
+            [('connection', 'connected'), ('reconnect', 'circuit_closed')])
+
+
+class TestMultiAccountWhatsAppTransport(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.patch(YowStackBuilder, 'getCoreLayers', getDummyCoreLayers)
+        self.patch(
+            YowInterfaceLayer, 'getLayerInterface', dummy_getLayerInterface)
+        self.tx_helper = self.add_helper(TransportHelper(WhatsAppTransport))
+        self.config = {
+            'accounts': [
+                {'phone': '27010203040', 'password': base64.b64encode("xxx")},
+                {'phone': '27010203041', 'password': base64.b64encode("yyy")},
+            ],
+            'routing': 'round_robin',
+        }
+        self.transport = yield self.tx_helper.get_transport(self.config)
+        self.testing_layers = [
+            client.network_layer for client in self.transport.stack_clients]
+
+    def add_auth_skip(self, client, number):
+        layer = client.stack.getLayer(2)
+        layer.skipEncJids.append(msisdn_to_whatsapp(number))
+
+    @inlineCallbacks
+    def test_outbound_round_robin(self):
+        for client in self.transport.stack_clients:
+            self.add_auth_skip(client, '27999')
+        yield self.tx_helper.make_dispatch_outbound(
+            content='one', to_addr='27999', from_addr='vumi')
+        yield self.tx_helper.make_dispatch_outbound(
+            content='two', to_addr='27999', from_addr='vumi')
+        node1 = yield self.testing_layers[0].data_received.get()
+        node2 = yield self.testing_layers[1].data_received.get()
+        self.assertEqual(node1.getChild('body').getData(), 'one')
+        self.assertEqual(node2.getChild('body').getData(), 'two')
+
+    @inlineCallbacks
+    def test_outbound_from_our_number(self):
+        self.add_auth_skip(self.transport.stack_clients[1], '27999')
+        yield self.tx_helper.make_dispatch_outbound(
+            content='hi', to_addr='27999', from_addr='+27010203041')
+        node = yield self.testing_layers[1].data_received.get()
+        self.assertEqual(node.getChild('body').getData(), 'hi')
+
+    @inlineCallbacks
+    def test_ack_from_second_account(self):
+        self.add_auth_skip(self.transport.stack_clients[1], '27999')
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            content='hi', to_addr='27999', from_addr='+27010203041')
+        node = yield self.testing_layers[1].data_received.get()
+        self.testing_layers[1].send_ack(node)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(ack['sent_message_id'], node['id'])
+
+    @inlineCallbacks
+    def test_staggered_startup(self):
+        self.patch(random, 'random', lambda: 1.0)
+        start = time.time()
+        yield self.tx_helper.get_transport(dict(
+            self.config, startup_jitter=0.05, startup_interval=0.05))
+        self.assertTrue(time.time() - start >= 0.1)
+
+    @inlineCallbacks
+    def test_publish_to_receiving_number(self):
+        self.testing_layers[1].send_to_transport(
+            text='Hi Vumi!', from_address='123345@s.whatsapp.net')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['to_addr'], '+27010203041')
+        self.assertEqual(msg['from_addr'], '+123345')
+
+
+class TestLoopWaker(VumiTestCase):
+
+    def setUp(self):
+        self.socket_map = {}
+        self.waker = LoopWaker(self.socket_map)
+
+    def test_wake(self):
+        self.add_cleanup(self.waker.close)
+        self.assertEqual(len(self.socket_map), 1)
+        self.waker.wake()
+        self.waker.wake()
+        self.assertTrue(self.waker.pending)
+        asyncore.loop(timeout=0, count=1, map=self.socket_map)
+        self.assertFalse(self.waker.pending)
+        # Only one byte was written, so there's nothing left to read.
+        asyncore.loop(timeout=0, count=1, map=self.socket_map)
+        self.assertFalse(self.waker.pending)
+
+    def test_no_lost_wakeups(self):
+        # The loop polls for longer than each call is waited for, so a call
+        # left waiting by a lost wakeup fails the test.
+        calls = deque()
+        running = [True]
+
+        def loop():
+            try:
+                while running[0]:
+                    asyncore.loop(timeout=10, count=1, map=self.socket_map)
+                    while calls:
+                        calls.popleft()()
+            finally:
+                self.waker.close()
+
+        def wake_repeatedly(results):
+            for _ in range(300):
+                called = threading.Event()
+                calls.append(called.set)
+                self.waker.wake()
+                results.append(called.wait(5))
+
+        loop_thread = threading.Thread(target=loop)
+        loop_thread.start()
+        results = []
+        wakers = [threading.Thread(target=wake_repeatedly, args=(results,))
+                  for _ in range(4)]
+        for thread in wakers:
+            thread.start()
+        for thread in wakers:
+            thread.join()
+        running[0] = False
+        self.waker.wake()
+        loop_thread.join()
+        self.assertEqual(results, [True] * 1200)
+
+    def test_wake_after_close(self):
+        self.waker.close()
+        self.waker.wake()
+        self.assertEqual(self.socket_map, {})
+
 
 def dummy_getLayerInterface(parent_interface, layer_cls):
     if layer_cls.__name__ == 'YowNetworkLayer':
@@ -339,3 +1361,29 @@ class TestingLayer(YowLayer):
         if event.getName() == YowNetworkLayer.EVENT_STATE_CONNECT:
             # Automatically say that we're connected for connect requests
             self.connect()
+
+
+class AutoAckTestingLayer(TestingLayer):
+    '''A testing layer that acks every message sent through it, for tests
+    and benchmarks where the stack can't be reached directly.'''
+
+    def send(self, data):
+        if data.tag == 'message':
+            self.send_ack(data)
+
+
+@staticmethod
+def getAutoAckCoreLayers():
+    return (AutoAckTestingLayer, YowLoggerLayer)
+
+
+def send_unencrypted(self, node):
+    self.toLower(node)
+
+
+def use_auto_ack_stack():
+    '''Makes every stack built afterwards use ``AutoAckTestingLayer`` and
+    skip encryption. Used as the setup function for stack processes.'''
+    YowStackBuilder.getCoreLayers = getAutoAckCoreLayers
+    YowInterfaceLayer.getLayerInterface = dummy_getLayerInterface
+    YowAxolotlLayer.send = send_unencrypted
@@ -0,0 +1,121 @@
+# -*- test-case-name: vxyowsup.tests.test_util -*-
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from vxyowsup.metrics import Metrics
+
+
+def when_done(d):
+    '''Returns a new deferred that fires with ``None`` once ``d`` has fired,
+    without disturbing ``d``'s own callback chain.'''
+    done = defer.Deferred()
+    d.addBoth(lambda r: done.callback(None) or r)
+    return done
+
+
+def timeout_after(d, seconds, clock=reactor):
+    '''Cancels ``d`` if it hasn't fired within ``seconds``, failing it with
+    ``defer.TimeoutError``. Returns ``d``.'''
+    call = clock.callLater(seconds, d.cancel)
+
+    def done(r):
+        if call.active():
+            call.cancel()
+        elif isinstance(r, Failure) and r.check(defer.CancelledError):
+            raise defer.TimeoutError(
+                'Timed out after %s seconds' % (seconds,))
+        return r
+
+    return d.addBoth(done)
+
+
+class BatchWriter(object):
+    '''Collects changes and writes them (to Redis, or on to whatever they
+    are for) in batches: ``batch_interval`` seconds after the first change
+    since the last batch, or as soon as ``batch_size`` changes are pending.
+
+    Subclasses keep their own pending changes, call ``_changed`` with how
+    many there are after each change, and implement ``_write_pending`` to
+    take them and start writing them, passing each write's deferred to
+    ``_track``.
+    '''
+
+    def __init__(self, batch_size, batch_interval, clock=reactor):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.clock = clock
+        self._writes = set()
+        self._flush_call = None
+
+    def _changed(self, pending):
+        if pending >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.batch_interval, self.flush)
+
+    def flush(self):
+        '''Writes all pending changes. Returns a deferred that fires once
+        every write in progress has completed.'''
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        self._write_pending()
+        return defer.gatherResults(
+            [when_done(d) for d in self._writes]).addCallback(lambda _: None)
+
+    def _write_pending(self):
+        '''Takes the pending changes and starts writing them, passing each
+        write's deferred to ``_track``. Every subclass must override this.'''
+        raise NotImplementedError()
+
+    def _track(self, d):
+        '''Keeps the write ``d`` until it has completed, for ``flush`` to
+        wait for. Returns ``d``.'''
+        self._writes.add(d)
+        d.addBoth(lambda r: self._writes.discard(d) or r)
+        return d
+
+
+class LRUCache(object):
+    '''An in-memory cache holding at most ``max_size`` entries, each for at
+    most ``ttl`` seconds. The least recently used entry is evicted first.'''
+
+    def __init__(self, max_size, ttl, metrics=None, clock=reactor,
+                 name='cache'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clock = clock
+        self.name = name
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            value, expires = entry
+            if expires > self.clock.seconds():
+                self._entries[key] = entry
+                self.metrics.incr('%s.hits' % (self.name,))
+                return value
+            self.metrics.incr('%s.evictions' % (self.name,))
+        self.metrics.incr('%s.misses' % (self.name,))
+        return None
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (value, self.clock.seconds() + self.ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.metrics.incr('%s.evictions' % (self.name,))
+
+    def delete(self, key):
+        self._entries.pop(key, None)
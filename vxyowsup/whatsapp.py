@@ -1,25 +1,76 @@
 # -*- test-case-name: vumi.transports.whatsapp.tests.test_whatsapp -*-
+import asyncore
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from functools import partial
+from urlparse import urlparse
+
 from twisted.internet import defer, reactor
-from twisted.internet.threads import deferToThread
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
 from vumi.transports.base import Transport
-from vumi.config import ConfigText, ConfigDict, ConfigInt
+from vumi.config import (
+    ConfigText, ConfigDict, ConfigInt, ConfigFloat, ConfigList, ConfigBool,
+    ConfigError)
 from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.utils import StatusEdgeDetector
 
-from yowsup.stacks import YowStackBuilder
+from yowsup.common.tools import StorageTools
+from yowsup.stacks import YowStack, YowStackBuilder
 
 from yowsup.layers.interface import YowInterfaceLayer, ProtocolEntityCallback
 from yowsup.layers.protocol_messages.protocolentities import (
     TextMessageProtocolEntity)
+from yowsup.layers.protocol_contacts.protocolentities import (
+    GetSyncIqProtocolEntity)
+from yowsup.layers.protocol_media.protocolentities import (
+    RequestUploadIqProtocolEntity)
 from yowsup.layers.protocol_receipts.protocolentities import (
     OutgoingReceiptProtocolEntity)
 from yowsup.layers.protocol_acks.protocolentities import (
     OutgoingAckProtocolEntity)
 from yowsup.layers.network import YowNetworkLayer
+from yowsup.layers.axolotl import YowAxolotlLayer
 from yowsup.layers import YowLayerEvent
 
+from vxyowsup.axolotl_store import (
+    AxolotlStateStore, MemoryAxolotlStore, StoredAxolotlLayer)
+from vxyowsup.capture import (
+    EVENT, INBOUND, OUTBOUND, CaptureWriter, event_node)
+from vxyowsup.contacts import ContactStore, ContactSync
+from vxyowsup.dedupe import SentMessages
+from vxyowsup.event_log import LEVELS, EventLog, render_entity
+from vxyowsup.events import EventBatcher
+from vxyowsup.flow_control import InFlightWindow
+from vxyowsup.health import HealthMonitor
+from vxyowsup.journal import OutboundJournal
+from vxyowsup.lease import Lease
+from vxyowsup.login_state import LoginStateStore
+from vxyowsup.media import (
+    MEDIA_TYPES, MediaError, MediaTransfers, inbound_media, media_message,
+    url_name)
+from vxyowsup.message_store import BucketedMessageIdStore, MessageIdStore
+from vxyowsup.metrics import Metrics, StageTimer
+from vxyowsup.metrics_export import MetricsPublisher, PrometheusResource
+from vxyowsup.process_stack import ProcessStackClient
+from vxyowsup.reactor_queue import ReactorQueue
+from vxyowsup.reconnect import Reconnector
+from vxyowsup.routing import StackRouter
+from vxyowsup.scheduler import OutboundScheduler
+from vxyowsup.util import timeout_after
+
 
 class WhatsAppTransportConfig(Transport.CONFIG_CLASS):
     cc = ConfigText(
@@ -31,6 +82,24 @@ class WhatsAppTransportConfig(Transport.CONFIG_CLASS):
     password = ConfigText(
         'Password received from WhatsApp on yowsup registration',
         static=True)
+    accounts = ConfigList(
+        'List of accounts (dicts with "phone" and "password" keys) to send '
+        'and receive messages on. Defaults to the single account given by '
+        'phone and password',
+        default=(), static=True)
+    routing = ConfigText(
+        'How to choose the account an outbound message is sent from when '
+        'there are several: "round_robin", "least_queued" or "sticky" (the '
+        'same account for each recipient)',
+        default='sticky', static=True)
+    stack_mode = ConfigText(
+        'Where to run each account\'s yowsup stack: "thread" (a thread in '
+        'the transport process) or "process" (a child process of its own)',
+        default='thread', static=True)
+    stack_process_setup = ConfigText(
+        'Dotted name of a function to call in each stack process before its '
+        'stack is built (only used with stack_mode "process")',
+        default=None, static=True)
     redis_manager = ConfigDict(
         'How to connect to Redis', required=True, static=True)
     ack_timeout = ConfigInt(
@@ -39,10 +108,302 @@ class WhatsAppTransportConfig(Transport.CONFIG_CLASS):
         default=60*60*24, static=True)
     echo_to = ConfigText(
         'Echo messages received by transport to given MSISDN', static=True)
+    id_batch_size = ConfigInt(
+        'Maximum number of message id mappings to collect before writing '
+        'them to redis',
+        default=100, static=True)
+    id_batch_interval = ConfigFloat(
+        'Maximum length of time (in seconds) to collect message id mappings '
+        'before writing them to redis',
+        default=0.05, static=True)
+    event_batch_interval = ConfigFloat(
+        'Maximum length of time (in seconds) to collect acks and delivery '
+        'receipts from the server before looking up the messages they are '
+        'for together. At most id_batch_size are collected at once',
+        default=0.005, static=True)
+    id_store_layout = ConfigText(
+        'How to keep message id mappings in redis: "keys" (a key for each, '
+        'with its own expiry) or "buckets" (packed into a hash for every '
+        'id_bucket_size seconds, each expiring as a whole, which takes far '
+        'less memory). Mappings written as keys are still read for '
+        'ack_timeout seconds after switching to buckets',
+        default='keys', static=True)
+    id_bucket_size = ConfigInt(
+        'Length of time (in seconds) each hash of message id mappings '
+        'covers, with id_store_layout "buckets"',
+        default=3600, static=True)
+    id_cache_size = ConfigInt(
+        'Number of message id mappings to keep in memory (0 disables the '
+        'in-memory cache)',
+        default=10000, static=True)
+    send_rate = ConfigFloat(
+        'Maximum number of messages to send per second (0 means no limit)',
+        default=0, static=True)
+    send_burst = ConfigInt(
+        'Number of messages that may be sent at once before send_rate '
+        'applies',
+        default=1, static=True)
+    recipient_send_rate = ConfigFloat(
+        'Maximum number of messages to send to a single recipient per second '
+        '(0 means no limit)',
+        default=0, static=True)
+    recipient_send_burst = ConfigInt(
+        'Number of messages that may be sent to a single recipient at once '
+        'before recipient_send_rate applies',
+        default=1, static=True)
+    max_outbound_queue = ConfigInt(
+        'Number of outbound messages waiting to be sent at which the '
+        'transport stops consuming outbound messages (0 means no limit)',
+        default=0, static=True)
+    journal_outbound = ConfigBool(
+        'Keep outbound messages in redis until the server acks them, so '
+        'that they are sent again if the transport restarts before then',
+        default=True, static=True)
+    dedupe_outbound = ConfigBool(
+        'Remember the ids of acked outbound messages for at least '
+        'ack_timeout seconds, and ack again (without sending) any message '
+        'sent again with the same id, for example when it is redelivered '
+        'after a restart. One sent again while the first is still being '
+        'sent is nacked',
+        default=False, static=True)
+    dedupe_capacity = ConfigInt(
+        'Number of outbound messages expected every ack_timeout seconds. '
+        'Beyond this, more messages have to be checked against redis to '
+        'tell whether they have been sent before',
+        default=1000000, static=True)
+    reconnect_delay = ConfigFloat(
+        'Seconds to wait before the first attempt to reconnect after losing '
+        'the connection. Each failed attempt doubles the wait',
+        default=1, static=True)
+    reconnect_max_delay = ConfigFloat(
+        'Longest time (in seconds) to wait between attempts to reconnect',
+        default=300, static=True)
+    reconnect_jitter = ConfigFloat(
+        'Largest fraction of each wait before reconnecting to take off at '
+        'random, so that accounts don\'t all reconnect at the same moment',
+        default=0.5, static=True)
+    reconnect_failure_threshold = ConfigInt(
+        'Number of failed attempts to reconnect in a row after which only '
+        'one attempt is made every reconnect_max_delay seconds',
+        default=10, static=True)
+    reconnect_stable_time = ConfigFloat(
+        'Seconds a connection must stay up before the wait before '
+        'reconnecting goes back to reconnect_delay',
+        default=60, static=True)
+    reconnect_drain_rate = ConfigFloat(
+        'Maximum number of messages per second to send from the messages '
+        'held back while an account was disconnected (0 means no limit)',
+        default=0, static=True)
+    inbound_receipts = ConfigText(
+        'When to send the server a receipt for an inbound message: '
+        '"on_receive" (as soon as it is received) or "after_publish" (once '
+        'it has been published, so the server sends it again if the '
+        'transport stops before then)',
+        default='on_receive', static=True)
+    inbound_receipt_type = ConfigText(
+        'Type of receipt to send for inbound messages: "read" or "delivered"',
+        default='read', static=True)
+    max_inbound_in_flight = ConfigInt(
+        'Maximum number of inbound messages that may be waiting to be '
+        'published. Once there are this many, the transport stops reading '
+        'from the server until some of them have been (0 means no limit)',
+        default=1000, static=True)
+    inbound_receipt_batch_interval = ConfigFloat(
+        'Maximum length of time (in seconds) to collect the receipts we '
+        'send for inbound messages from a chat before sending them to the '
+        'server as one receipt (0 sends a receipt for each message as soon '
+        'as it arrives). Acks for the receipts we receive are always sent '
+        'one at a time',
+        default=0.05, static=True)
+    inbound_receipt_batch_size = ConfigInt(
+        'Maximum number of inbound messages to send one receipt for',
+        default=50, static=True)
+    axolotl_store = ConfigText(
+        'Where to keep each account\'s encryption keys and sessions: '
+        '"sqlite" (yowsup\'s database on this host) or "redis" (loaded '
+        'into memory when the transport starts and written back to redis, '
+        'so another host can take over the account)',
+        default='sqlite', static=True)
+    axolotl_batch_interval = ConfigFloat(
+        'Maximum length of time (in seconds) to collect changes to the '
+        'encryption keys and sessions before writing them to redis',
+        default=0.05, static=True)
+    cache_login = ConfigBool(
+        'Keep what the server sends at each login in redis, so that the '
+        'next login (from this host or another) can skip the server\'s '
+        'challenge',
+        default=False, static=True)
+    startup_jitter = ConfigFloat(
+        'Longest time (in seconds) to wait at random before starting the '
+        'first account\'s stack, so that transports started together don\'t '
+        'all log in at once',
+        default=0, static=True)
+    startup_interval = ConfigFloat(
+        'Seconds to wait between starting the stacks of each account',
+        default=0, static=True)
+    failover = ConfigBool(
+        'Run as one of several copies of this transport (on different hosts, '
+        'sharing redis), each account used by only one of them at a time. A '
+        'copy only starts an account\'s stack once it holds that account\'s '
+        'lease, which it takes over when the copy holding it stops renewing '
+        'it. Outbound messages a copy can\'t send are passed on to one that '
+        'can through redis. Use with axolotl_store "redis"',
+        default=False, static=True)
+    node_id = ConfigText(
+        'Name this copy of the transport holds leases under (the host name, '
+        'process id and a random suffix if not set)',
+        default=None, static=True)
+    lease_ttl = ConfigInt(
+        'Seconds an account\'s lease lasts without being renewed, and so '
+        'the longest a failed copy keeps the account from the others',
+        default=10, static=True)
+    lease_interval = ConfigFloat(
+        'How often (in seconds) leases are renewed, standby copies try to '
+        'take them, and messages passed on by other copies are collected',
+        default=3, static=True)
+    media = ConfigBool(
+        'Send and receive images, audio and video. Outbound messages with '
+        '{"whatsapp": {"media": {"type": ..., "url": ...}}} in their helper '
+        'metadata send the file at the http(s) URL (or path in '
+        'media_upload_dir), with the message content as its caption. '
+        'Inbound media is published with the same metadata',
+        default=False, static=True)
+    media_upload_dir = ConfigText(
+        'Directory on this host that outbound media may be sent from by '
+        'path (relative to it, or absolute) or file:// URL. Only http(s) '
+        'URLs are sent if this is not set',
+        default=None, static=True)
+    media_store_path = ConfigText(
+        'Directory to download inbound media to, with its path added to the '
+        'metadata of the message. Inbound media is not downloaded if this '
+        'is not set',
+        default=None, static=True)
+    max_media_transfers = ConfigInt(
+        'Maximum number of media uploads and downloads to run at once',
+        default=4, static=True)
+    media_chunk_size = ConfigInt(
+        'Number of bytes of a media file to read at a time',
+        default=64 * 1024, static=True)
+    media_cache_ttl = ConfigInt(
+        'Length of time (in seconds) to reuse an upload for another message '
+        'with exactly the same file',
+        default=7 * 24 * 60 * 60, static=True)
+    media_timeout = ConfigFloat(
+        'Longest time (in seconds) a media upload or download may take, '
+        'including the wait to start it',
+        default=300, static=True)
+    check_contacts = ConfigBool(
+        'Check that recipients are WhatsApp users before sending to them. '
+        'Messages to numbers that aren\'t are nacked instead of sent (and '
+        'left out of messages to several recipients). Numbers not checked '
+        'in the last contact_ttl seconds are asked about in batches',
+        default=False, static=True)
+    contact_ttl = ConfigInt(
+        'Length of time (in seconds) to remember whether a number is a '
+        'WhatsApp user',
+        default=7 * 24 * 60 * 60, static=True)
+    contact_cache_size = ConfigInt(
+        'Number of checked numbers to keep in memory',
+        default=10000, static=True)
+    contact_batch_size = ConfigInt(
+        'Maximum number of numbers to ask the server about at once',
+        default=50, static=True)
+    contact_batch_interval = ConfigFloat(
+        'Maximum length of time (in seconds) to collect numbers to check '
+        'before asking the server about them together',
+        default=0.05, static=True)
+    contact_sync_timeout = ConfigFloat(
+        'Longest time (in seconds) to wait for the server to answer a check. '
+        'Messages to numbers it hasn\'t answered for are sent anyway',
+        default=30, static=True)
+    health_interval = ConfigFloat(
+        'How often (in seconds) to judge the health of the inbound, '
+        'outbound, ack_latency and connection components and publish their '
+        'statuses (only when they change)',
+        default=10, static=True)
+    health_window = ConfigFloat(
+        'Length of time (in seconds) over which to judge the health of each '
+        'component',
+        default=60, static=True)
+    health_min_events = ConfigInt(
+        'Fewest inbound or outbound messages in the window needed to judge '
+        'that component degraded or down',
+        default=10, static=True)
+    health_degraded_error_rate = ConfigFloat(
+        'Fraction of inbound or outbound messages in the window that must '
+        'fail for that component to be degraded',
+        default=0.05, static=True)
+    health_down_error_rate = ConfigFloat(
+        'Fraction of inbound or outbound messages in the window that must '
+        'fail for that component to be down',
+        default=0.5, static=True)
+    health_max_ack_latency = ConfigFloat(
+        'Longest time (in seconds) messages may take on average to be acked '
+        'before the ack_latency component is degraded',
+        default=30, static=True)
+    health_max_disconnects = ConfigInt(
+        'Number of times the connection may be lost in the window before the '
+        'connection component is degraded',
+        default=3, static=True)
+    capture_dir = ConfigText(
+        'Directory to record every protocol tree node each account receives '
+        'and sends (and its connection events) to, in a file named after the '
+        'account\'s number and the time its stack started, for replaying '
+        'with vxyowsup.bench.replay. Includes the content of messages. '
+        'Nothing is recorded if this is not set',
+        default=None, static=True)
+    log_level = ConfigText(
+        'Lowest level ("debug", "info", "warning" or "error") of message, ack '
+        'and receipt events to log',
+        default='info', static=True)
+    log_sample_rates = ConfigDict(
+        'Log only one in every n events of the given names, for example '
+        '{"ack.received": 100, "receipt.received": 100}',
+        default={}, static=True)
+    metrics_prefix = ConfigText(
+        'Prefix for the names of the transport\'s metrics, for example '
+        '"vumi.whatsapp.". Metrics are only published through Vumi\'s '
+        'metrics publisher if this is set',
+        default=None, static=True)
+    metrics_interval = ConfigInt(
+        'How often (in seconds) to publish metrics',
+        default=5, static=True)
+    metrics_port = ConfigInt(
+        'Port to serve metrics on at /metrics, in the Prometheus text '
+        'format (not served if not set)',
+        default=None, static=True)
+
+    def post_validate(self):
+        if self.inbound_receipts not in ('on_receive', 'after_publish'):
+            raise ConfigError(
+                'Unknown inbound_receipts: %r' % (self.inbound_receipts,))
+        if self.inbound_receipt_type not in ('read', 'delivered'):
+            raise ConfigError('Unknown inbound_receipt_type: %r' % (
+                self.inbound_receipt_type,))
+        if self.id_store_layout not in ('keys', 'buckets'):
+            raise ConfigError(
+                'Unknown id_store_layout: %r' % (self.id_store_layout,))
+        if self.axolotl_store not in ('sqlite', 'redis'):
+            raise ConfigError(
+                'Unknown axolotl_store: %r' % (self.axolotl_store,))
+        if self.stack_mode not in ('thread', 'process'):
+            raise ConfigError('Unknown stack_mode: %r' % (self.stack_mode,))
+        if self.routing not in StackRouter.STRATEGIES:
+            raise ConfigError('Unknown routing: %r' % (self.routing,))
+        if self.log_level not in LEVELS:
+            raise ConfigError('Unknown log_level: %r' % (self.log_level,))
+        if self.failover and self.lease_interval >= self.lease_ttl:
+            raise ConfigError('lease_interval must be less than lease_ttl')
+        if self.health_degraded_error_rate > self.health_down_error_rate:
+            raise ConfigError(
+                'health_degraded_error_rate must not be more than '
+                'health_down_error_rate')
 
 
-class WhatsAppClientDone(Exception):
-    """ Signal that the Yowsup client is done. """
+# Where copies of the transport pass on the outbound messages they can't
+# send, when failover is on: a list for each account (with the account's
+# MSISDN added), and a list of those its holder is collecting.
+FORWARDED_KEY = 'failover:outbound'
 
 
 def msisdn_to_whatsapp(msisdn):
@@ -50,6 +411,21 @@ def msisdn_to_whatsapp(msisdn):
     return msisdn.lstrip('+') + '@s.whatsapp.net'
 
 
+def media_metadata(message):
+    """ The media a message sends, from ``{"whatsapp": {"media": {...}}}``
+    in its helper metadata, or None for a text message. """
+    metadata = message['helper_metadata'].get('whatsapp', {})
+    return metadata.get('media')
+
+
+def bulk_recipients(message):
+    """ The MSISDNs a message is to be sent to instead of its to_addr, from
+    ``{"whatsapp": {"recipients": [...]}}`` in its helper metadata, or None
+    for an ordinary message. """
+    metadata = message['helper_metadata'].get('whatsapp', {})
+    return metadata.get('recipients')
+
+
 class WhatsAppTransport(Transport):
 
     CONFIG_CLASS = WhatsAppTransportConfig
@@ -59,29 +435,438 @@ class WhatsAppTransport(Transport):
     def setup_transport(self):
         config = self.config = self.get_static_config()
         self.log.info('Transport starting with: %s' % (config,))
+        self.started_at = time.time()
+        self.event_log = EventLog(
+            self.log, config.log_level, config.log_sample_rates)
 
         self.redis = yield TxRedisManager.from_config(config.redis_manager)
         self.redis = self.redis.sub_manager(self.transport_name)
+        self.metrics = Metrics()
+        # Times outbound messages from being handed to the stack until they
+        # are acked and delivered, by WhatsApp message id.
+        self.stage_timer = StageTimer(self.metrics)
+        if config.id_store_layout == 'buckets':
+            self.message_ids = BucketedMessageIdStore(
+                self.redis, config.ack_timeout,
+                bucket_size=config.id_bucket_size,
+                batch_size=config.id_batch_size,
+                batch_interval=config.id_batch_interval,
+                cache_size=config.id_cache_size,
+                metrics=self.metrics)
+        else:
+            self.message_ids = MessageIdStore(
+                self.redis, config.ack_timeout,
+                batch_size=config.id_batch_size,
+                batch_interval=config.id_batch_interval,
+                cache_size=config.id_cache_size,
+                metrics=self.metrics)
+        self.events = EventBatcher(
+            self.message_ids, self.publish_ack_for, self.publish_receipt_for,
+            batch_size=config.id_batch_size,
+            batch_interval=config.event_batch_interval, metrics=self.metrics)
+        accounts = config.accounts or [
+            {'phone': config.phone, 'password': config.password}]
+        self.journal = None
+        if config.journal_outbound:
+            self.journal = OutboundJournal(
+                self.redis, ['+' + account['phone'] for account in accounts],
+                batch_size=config.id_batch_size,
+                batch_interval=config.id_batch_interval,
+                metrics=self.metrics)
+
+        self.sent_messages = None
+        if config.dedupe_outbound:
+            self.sent_messages = SentMessages(
+                self.redis, config.ack_timeout,
+                capacity=config.dedupe_capacity,
+                batch_size=config.id_batch_size,
+                batch_interval=config.id_batch_interval,
+                metrics=self.metrics)
+            yield self.sent_messages.load()
 
-        self.our_msisdn = "+" + config.phone
-        CREDENTIALS = (config.phone, config.password)
+        self.reactor_queue = ReactorQueue(self, metrics=self.metrics)
+        self.media = None
+        if config.media:
+            self.media = MediaTransfers(
+                self.redis, store_path=config.media_store_path,
+                upload_dir=config.media_upload_dir,
+                max_transfers=config.max_media_transfers,
+                chunk_size=config.media_chunk_size,
+                cache_ttl=config.media_cache_ttl,
+                timeout=config.media_timeout, metrics=self.metrics)
+        # iq id -> deferred waiting for the server's answer to it
+        self.pending_iqs = {}
+        self.contacts = None
+        if config.check_contacts:
+            self.contacts = ContactSync(
+                ContactStore(
+                    self.redis, config.contact_ttl,
+                    cache_size=config.contact_cache_size,
+                    metrics=self.metrics),
+                self.sync_contacts, batch_size=config.contact_batch_size,
+                batch_interval=config.contact_batch_interval,
+                metrics=self.metrics)
+        self.outbound_paused = False
+        # vumi_id -> (when to give up, WhatsApp ids not yet acked) of bulk
+        # messages, oldest first
+        self.unacked_recipients = OrderedDict()
 
-        self.stack_client = StackClient(CREDENTIALS, self)
-        self.client_d = deferToThread(self.stack_client.client_start)
-        self.client_d.addErrback(self.catch_exit)
-        self.client_d.addErrback(self.log_error)
+        self.axolotl_state = None
+        axolotl_states = [None] * len(accounts)
+        if config.axolotl_store == 'redis':
+            self.axolotl_state = AxolotlStateStore(
+                self.redis, batch_size=config.id_batch_size,
+                batch_interval=config.axolotl_batch_interval,
+                metrics=self.metrics)
+            axolotl_states = yield defer.gatherResults([
+                self.axolotl_state.load('+' + account['phone'])
+                for account in accounts])
+        self.login_state = None
+        login_states = [None] * len(accounts)
+        if config.cache_login:
+            self.login_state = LoginStateStore(
+                self.redis, metrics=self.metrics)
+            login_states = yield defer.gatherResults([
+                self.login_state.load('+' + account['phone'])
+                for account in accounts])
+        # MSISDNs of the accounts that have logged in since we started
+        self.logged_in = set()
+        self.node_id = config.node_id or '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        # Clients whose stacks have been started
+        self.started_clients = set()
+        self.stack_clients = [
+            self.make_stack_client(*args)
+            for args in zip(accounts, axolotl_states, login_states)]
+        self.stack_client = self.stack_clients[0]
+        self.our_msisdn = self.stack_client.msisdn
+        self.router = StackRouter(self.stack_clients, config.routing)
+        self.poll_metrics()
 
+        # Each stack loop runs for the lifetime of the transport, so they get
+        # their own threads instead of tying up the reactor's thread pool.
+        threads = 0 if config.stack_mode == 'process' else len(accounts)
+        self.thread_pool = ThreadPool(
+            minthreads=threads, maxthreads=threads, name='whatsapp-stacks')
+        self.thread_pool.start()
         self.status_detect = StatusEdgeDetector()
+        self.health = HealthMonitor(
+            self.add_status, window=config.health_window,
+            interval=config.health_interval,
+            degraded_error_rate=config.health_degraded_error_rate,
+            down_error_rate=config.health_down_error_rate,
+            min_events=config.health_min_events,
+            max_ack_latency=config.health_max_ack_latency,
+            max_disconnects=config.health_max_disconnects,
+            metrics=self.metrics)
+        self.health.start()
+        self.client_ds = []
+        self.forward_loop = None
+        self._collecting = None
+        if config.failover:
+            # Each stack is started once its lease is held.
+            for client in self.stack_clients:
+                client.scheduler.hold()
+            yield self.publish_failover_status()
+        else:
+            if config.startup_jitter:
+                yield deferLater(
+                    reactor, random.random() * config.startup_jitter,
+                    lambda: None)
+            for i, client in enumerate(self.stack_clients):
+                if i and config.startup_interval:
+                    yield deferLater(
+                        reactor, config.startup_interval, lambda: None)
+                self.start_client(client)
+
+        self.metrics_publisher = None
+        if config.metrics_prefix is not None:
+            self.metrics_publisher = yield self.start_publisher(
+                MetricsPublisher, self.metrics, config.metrics_prefix,
+                config.metrics_interval)
+        self.metrics_server = None
+        if config.metrics_port is not None:
+            self.metrics_server = self.start_web_resources(
+                [(PrometheusResource(self.metrics), 'metrics')],
+                config.metrics_port)
+
+        if config.failover:
+            yield defer.gatherResults(
+                [client.lease.start() for client in self.stack_clients])
+            self.forward_loop = LoopingCall(self.collect_forwarded)
+            self.forward_loop.start(
+                config.lease_interval, now=False).addErrback(self.log_error)
+            return
+
+        # Wait for the WhatsApp clients to connect before continuing.
+        yield defer.gatherResults(
+            [client.connect_d for client in self.stack_clients])
+
+        if self.journal is not None:
+            for client in self.stack_clients:
+                yield self.recover_outbound(client)
+
+    def start_client(self, client):
+        self.started_clients.add(client)
+        d = client.start(self.thread_pool)
+        d.addErrback(self.log_error)
+        self.client_ds.append(d)
+
+    def holds_lease(self, client):
+        return client.lease is None or client.lease.held
+
+    @defer.inlineCallbacks
+    def take_over(self, client):
+        '''Starts using ``client``'s account, now that this copy of the
+        transport holds its lease. The account's state is loaded again
+        first, since the copy that held the lease before may have changed
+        it.'''
+        self.log.info('Taking over %s' % (client.msisdn,))
+        self.metrics.incr('failover.takeovers')
+        axolotl_state, login_state = yield self.load_account_state(
+            client.msisdn)
+        if not client.lease.held:
+            return
+        client.refresh_state(axolotl_state, login_state)
+        if client in self.started_clients:
+            client.reconnect()
+        else:
+            self.start_client(client)
+        yield self.publish_failover_status()
+        # The messages the last holder hadn't had acked on this account are
+        # sent again.
+        if self.journal is not None:
+            yield self.recover_outbound(client)
+        yield self.collect_forwarded()
+
+    @defer.inlineCallbacks
+    def load_account_state(self, msisdn):
+        '''Loads the axolotl and login state of ``msisdn``'s account from
+        redis, once this copy's own changes to them have been written.
+        Returns a deferred that fires with both, ``None`` for either that
+        isn't kept in redis.'''
+        axolotl_state = login_state = None
+        if self.axolotl_state is not None:
+            yield self.axolotl_state.flush()
+            axolotl_state = yield self.axolotl_state.load(msisdn)
+        if self.login_state is not None:
+            login_state = yield self.login_state.load(msisdn)
+        defer.returnValue((axolotl_state, login_state))
+
+    def step_down(self, client):
+        '''Stops using ``client``'s account, now that another copy of the
+        transport may hold its lease. Messages waiting to be sent on it wait
+        until the lease is held again. Those in the outbound journal are
+        sent by the new holder.'''
+        self.log.info('Lost the lease on %s, standing by' % (client.msisdn,))
+        self.metrics.incr('failover.step_downs')
+        client.scheduler.hold()
+        if client in self.started_clients:
+            client.disconnect()
+        self.unpause_outbound()
+        return self.publish_failover_status()
+
+    def publish_failover_status(self):
+        held = [c.msisdn for c in self.stack_clients if c.lease.held]
+        if held:
+            return self.add_status(
+                component='failover', status='ok', type='active',
+                message='Using %s' % (', '.join(held),))
+        return self.add_status(
+            component='failover', status='ok', type='standby',
+            message='Standing by')
+
+    def can_send(self, message):
+        '''Whether this copy of the transport holds the lease of an account
+        ``message`` can be sent from.'''
+        client = self.router.by_msisdn.get(message['from_addr'])
+        clients = [client] if client is not None else self.stack_clients
+        return any(c.lease.held for c in clients)
+
+    def forwarded_key(self, client):
+        return '%s:%s' % (FORWARDED_KEY, client.msisdn)
+
+    def forward_outbound(self, message):
+        '''Passes ``message`` on to the copy of the transport holding the
+        lease of the account it is from (if one of ours), or else of one
+        chosen by its recipient, through that account's list in redis,
+        which the holder collects from every lease_interval seconds.'''
+        self.metrics.incr('failover.forwarded')
+        self.event_log.info('message.forwarded', id=message['message_id'])
+        client = self.router.by_msisdn.get(message['from_addr'])
+        if client is None:
+            to_addr = (bulk_recipients(message) or [message['to_addr']])[0]
+            client = self.router.route_sticky(to_addr, self.stack_clients)
+        return self.redis.lpush(
+            self.forwarded_key(client), message.to_json())
+
+    def collect_forwarded(self):
+        '''Sends the messages other copies of the transport have passed on
+        to the accounts this copy holds the leases of. Returns a deferred
+        that fires once they have been journaled.'''
+        if self._collecting is not None:
+            return self._collecting
+        d = defer.gatherResults([
+            self.collect_forwarded_for(client)
+            for client in self.stack_clients if client.lease.held])
+
+        def done(r):
+            self._collecting = None
+            return r
+
+        d.addBoth(done)
+        if not d.called:
+            self._collecting = d
+        return d
+
+    @defer.inlineCallbacks
+    def collect_forwarded_for(self, client):
+        '''Goes through ``client``'s list of passed on messages once. Each
+        message is moved to a list of those being collected until it has
+        been journaled, so that any this copy stops before journaling are
+        collected by the account's next holder.'''
+        key = self.forwarded_key(client)
+        collecting = key + ':collecting'
+        # Left by a holder that stopped before journaling them (newest
+        # first, as they are pushed on the front).
+        left = yield self.redis.lrange(collecting, 0, -1)
+        records = list(reversed(left))
+        count = yield self.redis.llen(key)
+        batch_size = self.config.id_batch_size
+        for start in xrange(0, count, batch_size):
+            batch = yield defer.gatherResults([
+                self.redis.rpoplpush(key, collecting)
+                for _ in xrange(min(batch_size, count - start))])
+            records.extend(record for record in batch if record is not None)
+        if not records:
+            return
+        self.metrics.incr('failover.collected', len(records))
+        yield defer.gatherResults([
+            defer.maybeDeferred(
+                self.handle_outbound_message,
+                TransportUserMessage.from_json(record))
+            for record in records])
+        if self.journal is not None:
+            yield self.journal.flush()
+        yield self.redis.delete(collecting)
+
+    @defer.inlineCallbacks
+    def recover_outbound(self, client):
+        '''Sends the messages left in ``client``'s journal by a previous run,
+        or by the copy of the transport that held its lease before.'''
+        recovered = yield self.journal.recover(
+            client.msisdn, max_age=self.config.ack_timeout)
+        if recovered:
+            self.log.info(
+                'Resending %d unacknowledged outbound messages' % (
+                    len(recovered),))
+        for fields in recovered:
+            self.metrics.incr('journal.recovered')
+            recipients = fields.pop('recipients', None)
+            media = fields.pop('media', None)
+            if media is not None:
+                fields['helper_metadata'] = {'whatsapp': {'media': media}}
+            self.send_message(TransportUserMessage(
+                transport_name=self.transport_name,
+                transport_type=self.transport_type, **fields), recipients)
+
+    def poll_metrics(self):
+        '''Registers the gauges that are read each time metrics are
+        exported.'''
+        clients = self.stack_clients
+        self.metrics.poll('outbound.queue_depth', lambda: sum(
+            client.scheduler.queued for client in clients))
+        self.metrics.poll('outbound.in_flight', lambda: sum(
+            len(client.scheduler.in_flight) for client in clients))
+        self.metrics.poll('stack.detached_calls', lambda: sum(
+            len(getattr(client, 'detached_calls', ())) for client in clients))
+        self.metrics.poll('reactor_queue.depth', lambda: len(
+            self.reactor_queue))
+        # Only known here for stacks running in this process.
+        self.metrics.poll('inbound.in_flight', lambda: sum(
+            len(client.whatsapp_interface.inbound_window)
+            for client in clients if hasattr(client, 'whatsapp_interface')))
+        if self.config.failover:
+            self.metrics.poll('failover.leases_held', lambda: sum(
+                1 for client in clients if client.lease.held))
+        if self.media is not None:
+            self.metrics.poll('media.transfers_active', lambda: (
+                self.media.active))
+            self.metrics.poll('media.transfers_waiting', lambda: (
+                self.media.waiting))
 
-        # Wait for the WhatsApp client to connect before continuing.
-        yield self.stack_client.connect_d
+    def make_stack_client(self, account, axolotl_state=None,
+                          login_state=None):
+        config = self.config
+        credentials = (account['phone'], account['password'])
+        if config.stack_mode == 'process':
+            client = ProcessStackClient(
+                credentials, self, setup=config.stack_process_setup,
+                axolotl_state=axolotl_state, login_state=login_state)
+        else:
+            client = StackClient(
+                credentials, self, axolotl_state, login_state)
+        client.scheduler = OutboundScheduler(
+            partial(self.send_to_stack, client),
+            rate=config.send_rate, burst=config.send_burst,
+            recipient_rate=config.recipient_send_rate,
+            recipient_burst=config.recipient_send_burst,
+            max_queued=config.max_outbound_queue,
+            pause=self.pause_outbound, unpause=self.unpause_outbound,
+            drain_rate=config.reconnect_drain_rate, metrics=self.metrics)
+        client.reconnector = Reconnector(
+            client.reconnect, delay=config.reconnect_delay,
+            max_delay=config.reconnect_max_delay,
+            jitter=config.reconnect_jitter,
+            failure_threshold=config.reconnect_failure_threshold,
+            stable_after=config.reconnect_stable_time, metrics=self.metrics)
+        client.lease = None
+        if config.failover:
+            client.lease = Lease(
+                self.redis, 'account:%s' % (client.msisdn,), self.node_id,
+                ttl=config.lease_ttl, interval=config.lease_interval,
+                acquired=lambda: self.take_over(client).addErrback(
+                    self.log_error),
+                lost=lambda: self.step_down(client).addErrback(
+                    self.log_error),
+                metrics=self.metrics)
+        return client
 
     @defer.inlineCallbacks
     def teardown_transport(self):
         self.log.info("Stopping client ...")
-        if hasattr(self, 'stack_client'):
-            self.stack_client.client_stop()
-            yield self.client_d
+        if getattr(self, 'metrics_publisher', None) is not None:
+            self.metrics_publisher.stop()
+        if hasattr(self, 'health'):
+            self.health.stop()
+        forward_loop = getattr(self, 'forward_loop', None)
+        if forward_loop is not None and forward_loop.running:
+            forward_loop.stop()
+        if getattr(self, 'metrics_server', None) is not None:
+            yield self.metrics_server.stopListening()
+        if hasattr(self, 'client_ds'):
+            for client in self.stack_clients:
+                client.reconnector.stop()
+                client.scheduler.stop()
+                client.client_stop()
+            yield defer.DeferredList(self.client_ds)
+            self.thread_pool.stop()
+
+        if hasattr(self, 'events'):
+            yield self.events.flush()
+        if hasattr(self, 'message_ids'):
+            yield self.message_ids.flush()
+        if getattr(self, 'journal', None) is not None:
+            yield self.journal.flush()
+        if getattr(self, 'sent_messages', None) is not None:
+            yield self.sent_messages.flush()
+        if getattr(self, 'axolotl_state', None) is not None:
+            yield self.axolotl_state.flush()
+        # Given up only once everything is written, so that the next holder
+        # starts from it.
+        for client in getattr(self, 'stack_clients', ()):
+            if client.lease is not None:
+                yield client.lease.stop()
 
         if hasattr(self, 'redis'):
             yield self.redis._close()
@@ -97,164 +882,869 @@ class WhatsAppTransport(Transport):
 
     def handle_outbound_message(self, message):
         # message is a vumi.message.TransportUserMessage
-        self.log.info('Sending message: %s' % (message.to_json(),))
-        msg = TextMessageProtocolEntity(
-            message['content'].encode("UTF-8"),
-            to=msisdn_to_whatsapp(message['to_addr']).encode("UTF-8"))
-        self.redis.setex(
-            msg.getId(), self.config.ack_timeout, message['message_id'])
-        self.stack_client.send_to_stack(msg)
+        recipients = bulk_recipients(message)
+        if recipients is not None and not (
+                isinstance(recipients, list) and recipients and
+                all(isinstance(r, basestring) for r in recipients)):
+            return self.publish_nack(
+                message['message_id'],
+                'Recipients must be a non-empty list of MSISDNs')
+        media = media_metadata(message)
+        if media is not None:
+            error = self.check_media(media)
+            if error is not None:
+                return self.publish_nack(message['message_id'], error)
+        if self.config.failover and not self.can_send(message):
+            return self.forward_outbound(message)
+        if self.sent_messages is None:
+            return self.send_outbound(message, recipients)
+        d = self.sent_messages.claim(message['message_id'])
+        return d.addCallback(self.send_if_new, message, recipients)
+
+    def send_if_new(self, claimed, message, recipients):
+        '''Sends ``message`` unless it has been sent before, in which case it
+        is acked again with the WhatsApp id of the first ack, or nacked if
+        it hasn't been acked yet.'''
+        new, whatsapp_id = claimed
+        if new:
+            return self.send_outbound(message, recipients)
+        self.event_log.warning('message.duplicate', id=message['message_id'])
+        if whatsapp_id is None:
+            return self.publish_nack(
+                message['message_id'],
+                'Duplicate of a message still being sent')
+        return self.publish_ack(
+            user_message_id=message['message_id'],
+            sent_message_id=whatsapp_id)
+
+    def send_outbound(self, message, recipients):
+        self.event_log.info(
+            'message.sending', id=message['message_id'],
+            to=message['to_addr'] if recipients is None else (
+                '%d recipients' % (len(recipients),)))
+        self.event_log.debug('message.sending', message=message.to_json)
+        if self.journal is not None:
+            self.journal.append(
+                self.journal_account(message, recipients), message,
+                recipients)
+        self.send_message(message, recipients)
+
+    def journal_account(self, message, recipients):
+        '''The account ``message`` is journaled under, and so sent again by
+        the copy of the transport that takes it over: the account it is
+        sent from, if it is one of ours, or else one of those this copy is
+        using, chosen by its (first) recipient. Doesn't move the router on,
+        so the account may not be the one the message goes out on.'''
+        client = self.router.by_msisdn.get(message['from_addr'])
+        if client is None:
+            clients = [c for c in self.stack_clients if self.holds_lease(c)]
+            to_addr = recipients[0] if recipients else message['to_addr']
+            client = self.router.route_sticky(
+                to_addr, clients or self.stack_clients)
+        return client.msisdn
+
+    def check_media(self, media):
+        '''Returns why the ``media`` of an outbound message can't be sent, or
+        None if it can.'''
+        if self.media is None:
+            return 'Media messages are not enabled'
+        if not isinstance(media, dict) or media.get('type') not in MEDIA_TYPES:
+            return 'Media type must be one of: %s' % (', '.join(MEDIA_TYPES),)
+        if not isinstance(media.get('url'), basestring):
+            return 'Media must have a url'
+        if (self.media.upload_dir is None and
+                urlparse(media['url']).scheme not in ('http', 'https')):
+            return 'Media url must be http or https'
+
+    def send_message(self, message, recipients=None):
+        '''Sends ``message`` to its ``to_addr``, or to each of
+        ``recipients`` instead if given. Each recipient gets a WhatsApp
+        message of its own, and so its own ack and delivery report, all
+        published for the original message. If contacts are checked,
+        recipients that aren't WhatsApp users are skipped.'''
+        if self.contacts is None:
+            return self.send_to_recipients(message, recipients)
+        d = self.contacts.check(recipients or [message['to_addr']])
+        return d.addCallback(self.skip_non_users, message, recipients)
+
+    def skip_non_users(self, contacts, message, recipients):
+        '''Sends ``message`` to those of its recipients that aren't known
+        not to be WhatsApp users, or nacks it if that leaves none.'''
+        non_users = set(
+            msisdn for msisdn, jid in contacts.iteritems() if jid is None)
+        if non_users:
+            self.metrics.incr('contacts.skipped', len(non_users))
+        if recipients is None:
+            sendable = message['to_addr'] not in non_users
+        else:
+            recipients = [r for r in recipients if r not in non_users]
+            sendable = bool(recipients)
+        if not sendable:
+            return self.fail_outbound(message, 'Not a WhatsApp user')
+        return self.send_to_recipients(message, recipients)
+
+    def fail_outbound(self, message, reason):
+        '''Nacks ``message``, which couldn't be sent, and forgets it was
+        being sent, so that it is sent if it is delivered again.'''
+        if self.journal is not None:
+            self.journal.remove(message['message_id'])
+        if self.sent_messages is not None:
+            self.sent_messages.forget(message['message_id'])
+        return self.publish_nack(message['message_id'], reason)
+
+    def send_to_recipients(self, message, recipients=None):
+        media = media_metadata(message)
+        if media is not None:
+            return self.send_media(message, media, recipients)
+        body = message['content'].encode("UTF-8")
+        self.enqueue_message(message, recipients, lambda to: (
+            TextMessageProtocolEntity(body, to=to)))
+
+    def send_media(self, message, media, recipients=None):
+        '''Uploads the file ``media`` describes and then sends it like
+        ``send_message``. Text messages don't wait for the upload, so may be
+        sent first. ``message`` is nacked if the upload fails.'''
+        to_addr = recipients[0] if recipients else message['to_addr']
+        client = self.router.route(message, to_addr)
+        fields = [
+            ('to', msisdn_to_whatsapp(to_addr).encode('UTF-8')),
+            ('from', client.msisdn.lstrip('+')),
+        ]
+        caption = message['content']
+        if caption is not None:
+            caption = caption.encode('UTF-8')
+        d = self.media.upload(
+            media['url'], partial(self.request_upload, client, media['type']),
+            fields, name=media.get('name'))
+        d.addCallback(lambda upload: self.enqueue_message(
+            message, recipients, partial(
+                media_message, media, upload, caption=caption)))
+        return d.addErrback(self.media_failed, message)
+
+    def media_failed(self, f, message):
+        self.log.error(f)
+        self.metrics.incr('media.upload_failures')
+        self.health.failure(
+            'outbound', 'Failed to upload media',
+            {'error': f.getErrorMessage()})
+        return self.fail_outbound(
+            message, 'Failed to upload media: %s' % (f.getErrorMessage(),))
+
+    def request_upload(self, client, media_type, media):
+        '''Asks the server (through ``client``'s stack) where to upload
+        ``media`` to. Returns a deferred that fires with the URL and whether
+        the server already has it.'''
+        entity = RequestUploadIqProtocolEntity(
+            media_type, b64Hash=media.hash, size=media.size)
+        return self.send_iq(client.request_upload, entity)
+
+    def send_iq(self, send, entity):
+        '''Sends an iq with ``send`` and returns a deferred that is fired
+        with the server's answer by the ``handle_`` method it goes to.'''
+        iq_id = entity.getId()
+        d = self.pending_iqs[iq_id] = defer.Deferred(
+            lambda _: self.pending_iqs.pop(iq_id, None))
+        send(entity)
+        return d
+
+    def handle_upload_slot(self, iq_id, url, duplicate=False, error=None):
+        d = self.pending_iqs.pop(iq_id, None)
+        if d is None:
+            return
+        if url is None:
+            d.errback(MediaError('Upload refused by server: %s' % (error,)))
+        else:
+            d.callback((url, duplicate))
+
+    def sync_contacts(self, msisdns):
+        '''Asks the server (through a connected account) which of
+        ``msisdns`` are WhatsApp users. Returns a deferred that fires with
+        ``{msisdn: jid}``, with a JID of None for those that aren't.'''
+        clients = [c for c in self.stack_clients if not c.scheduler.held]
+        client = (clients or self.stack_clients)[0]
+        entity = GetSyncIqProtocolEntity(
+            ['+' + msisdn.lstrip('+') for msisdn in msisdns],
+            mode=GetSyncIqProtocolEntity.MODE_DELTA)
+        d = self.send_iq(client.sync_contacts, entity)
+        if self.config.contact_sync_timeout:
+            timeout_after(d, self.config.contact_sync_timeout)
+
+        def synced(numbers):
+            by_number = dict(
+                (msisdn.lstrip('+'), msisdn) for msisdn in msisdns)
+            return dict(
+                (by_number[number.lstrip('+')], jid)
+                for number, jid in numbers.iteritems()
+                if number.lstrip('+') in by_number)
+
+        return d.addCallback(synced)
+
+    def handle_sync_result(self, iq_id, users, non_users):
+        '''Called with the numbers the server says are WhatsApp users (with
+        their JIDs) and those it says aren't.'''
+        d = self.pending_iqs.pop(iq_id, None)
+        if d is not None:
+            numbers = dict.fromkeys(non_users)
+            numbers.update(users)
+            d.callback(numbers)
+
+    def enqueue_message(self, message, recipients, make_entity):
+        '''Queues the WhatsApp message ``make_entity`` makes for the JID of
+        each recipient of ``message``.'''
+        lane = 'reply' if message['in_reply_to'] else 'bulk'
+        if recipients is None:
+            recipients = [message['to_addr']]
+        else:
+            self.metrics.record('outbound.recipients', len(recipients))
+        whatsapp_ids = []
+        for to_addr in recipients:
+            msg = make_entity(msisdn_to_whatsapp(to_addr).encode("UTF-8"))
+            whatsapp_ids.append(msg.getId())
+            self.message_ids.add(msg.getId(), message['message_id'])
+            client = self.router.route(message, to_addr)
+            client.scheduler.enqueue(msg, to_addr, lane, key=msg.getId())
+        if len(whatsapp_ids) > 1 and self.journal is not None:
+            self.expire_unacked()
+            self.unacked_recipients[message['message_id']] = (
+                time.time() + self.config.ack_timeout, set(whatsapp_ids))
+
+    def expire_unacked(self):
+        '''Forgets which recipients of bulk messages sent more than
+        ack_timeout seconds ago haven't acked them. Journal recovery drops
+        those messages by then anyway.'''
+        now = time.time()
+        while self.unacked_recipients:
+            vumi_id = next(iter(self.unacked_recipients))
+            if self.unacked_recipients[vumi_id][0] > now:
+                return
+            del self.unacked_recipients[vumi_id]
+
+    def send_to_stack(self, client, msg):
+        self.stage_timer.start(msg.getId())
+        client.send_to_stack(msg)
+
+    def pause_outbound(self, reason='Outbound queue full'):
+        if self.outbound_paused:
+            return
+        self.log.info('%s, pausing outbound messages' % (reason,))
+        self.outbound_paused = True
+        self.connectors[self.transport_name].pause()
+
+    def all_disconnected(self):
+        '''Whether every account this copy of the transport uses is
+        disconnected. A copy that uses none passes messages on instead.'''
+        clients = [c for c in self.stack_clients if self.holds_lease(c)]
+        return bool(clients) and all(c.scheduler.held for c in clients)
+
+    def unpause_outbound(self):
+        '''Resumes outbound messages, unless some account's queue is still
+        full or every account is disconnected.'''
+        if not self.outbound_paused:
+            return
+        if any(client.scheduler.paused for client in self.stack_clients):
+            return
+        if self.all_disconnected():
+            return
+        self.log.info('Resuming outbound messages')
+        self.outbound_paused = False
+        self.connectors[self.transport_name].unpause()
+
+    def write_axolotl(self, msisdn, field, value):
+        self.axolotl_state.update(msisdn, field, value)
 
-    @defer.inlineCallbacks
     def _send_ack(self, whatsapp_id):
-        vumi_id = yield self.redis.get(whatsapp_id)
-        if vumi_id is None:
-            defer.returnValue(None)
-        yield self.publish_ack(
+        latency = self.stage_timer.stop(
+            'outbound.send_to_ack', whatsapp_id, keep=True)
+        if latency is not None:
+            self.health.latency('ack_latency', latency)
+        for client in self.stack_clients:
+            client.scheduler.done(whatsapp_id)
+        self.events.ack(whatsapp_id)
+
+    def publish_ack_for(self, whatsapp_id, vumi_id):
+        if self.journal is not None and self._all_acked(vumi_id, whatsapp_id):
+            self.journal.remove(vumi_id)
+        if self.sent_messages is not None:
+            self.sent_messages.sent(vumi_id, whatsapp_id)
+        self.health.success('outbound')
+        return self.publish_ack(
             user_message_id=vumi_id, sent_message_id=whatsapp_id)
 
-    @defer.inlineCallbacks
+    def _all_acked(self, vumi_id, whatsapp_id):
+        '''Notes that ``whatsapp_id`` was acked. Returns True once every
+        recipient of ``vumi_id`` has been.'''
+        entry = self.unacked_recipients.get(vumi_id)
+        if entry is None:
+            return True
+        unacked = entry[1]
+        unacked.discard(whatsapp_id)
+        if unacked:
+            return False
+        del self.unacked_recipients[vumi_id]
+        return True
+
     def _send_delivery_report(self, whatsapp_id):
-        vumi_id = yield self.redis.get(whatsapp_id)
-        if vumi_id:
-            yield self.publish_delivery_report(
-                user_message_id=vumi_id, delivery_status='delivered')
-            yield self.redis.delete(whatsapp_id)
+        self.stage_timer.stop('outbound.send_to_receipt', whatsapp_id)
+        self.events.receipt(whatsapp_id)
+
+    def publish_receipt_for(self, whatsapp_id, vumi_id):
+        return self.publish_delivery_report(
+            user_message_id=vumi_id, delivery_status='delivered')
+
+    def publish_inbound(self, received_at, receipt=None, media=None, **kw):
+        '''Publishes an inbound message the stack received at
+        ``received_at``, then tells the stack it is done with it, passing on
+        ``receipt`` to send if it was published. Any ``media`` it came with
+        is downloaded first, if there is somewhere to keep it.'''
+        client = self.router.by_msisdn[kw['to_addr']]
+        d = defer.succeed(media)
+        if (media is not None and media['type'] in MEDIA_TYPES and
+                self.media is not None and self.config.media_store_path):
+            d = self.download_media(media)
+
+        def publish(media):
+            if media is not None:
+                kw['helper_metadata'] = {'whatsapp': {'media': media}}
+            self.metrics.record(
+                'inbound.receive_to_publish', time.time() - received_at)
+            return self.publish_message(**kw)
+
+        d.addCallback(publish)
 
-    def catch_exit(self, f):
-        f.trap(WhatsAppClientDone)
-        self.log.info("Yowsup client killed.")
+        def published(r):
+            self.health.success('inbound')
+            client.inbound_done(receipt)
+            return r
+
+        def failed(f):
+            self.health.failure(
+                'inbound', 'Failed to publish',
+                {'error': f.getErrorMessage()})
+            client.inbound_done()
+            return f
+
+        return d.addCallbacks(published, failed)
+
+    def download_media(self, media):
+        '''Downloads inbound ``media`` to the store, and returns it with the
+        path it was saved to. If that fails, it is returned as it was.'''
+        name = uuid.uuid4().hex + os.path.splitext(
+            media.get('name') or url_name(media['url']))[1]
+        d = self.media.download(media['url'], name)
+
+        def downloaded(upload):
+            return dict(media, path=upload.path)
+
+        def failed(f):
+            self.log.error(f)
+            self.metrics.incr('media.download_failures')
+            return media
+
+        return d.addCallbacks(downloaded, failed)
 
     def log_error(self, f):
         self.log.error(f)
         return f
 
     def handle_inbound_error(self, error, message):
-        return self.add_status(
-            component='inbound', status='degraded', type='inbound_error',
-            message=error, details={'message': message})
-
-    def handle_inbound_success(self):
-        return self.add_status(
-            component='inbound', status='ok', type='inbound_success',
-            message='Inbound message successfully processed')
+        self.health.failure('inbound', error, {'message': message})
 
-    def handle_connected(self):
-        return self.add_status(
-            component='connection', status='ok', type='connected',
-            message='Successfully connected to server')
+    @defer.inlineCallbacks
+    def handle_connected(self, msisdn=None):
+        client = self.router.by_msisdn.get(msisdn)
+        circuit_closed = False
+        if client is not None and self.holds_lease(client):
+            circuit_closed = client.reconnector.circuit_open
+            client.reconnector.connected()
+            # Sends whatever was held back while we were disconnected,
+            # starting with anything sent that the server never acked.
+            client.scheduler.release()
+            self.unpause_outbound()
+        self.health.connection_changed(True)
+        # Reported as soon as it happens, degraded if it keeps dropping.
+        yield self.add_status(
+            component='connection', **self.health.status('connection'))
+        if circuit_closed:
+            yield self.add_status(
+                component='reconnect', status='ok', type='circuit_closed',
+                message='Reconnected to server')
 
-    def handle_disconnected(self, reason):
-        return self.add_status(
+    @defer.inlineCallbacks
+    def handle_disconnected(self, reason, msisdn=None):
+        client = self.router.by_msisdn.get(msisdn)
+        if client is not None:
+            client.scheduler.hold()
+            delay = None
+            if self.holds_lease(client):
+                delay = client.reconnector.disconnected()
+            if delay is not None:
+                self.log.info('Reconnecting %s in %.1f seconds' % (
+                    msisdn, delay))
+            if self.all_disconnected():
+                self.pause_outbound('All accounts disconnected')
+        self.health.connection_changed(False, reason)
+        yield self.add_status(
             component='connection', status='down', type='disconnected',
             message=reason)
+        if client is not None and client.reconnector.circuit_open:
+            yield self.add_status(
+                component='reconnect', status='down', type='circuit_open',
+                message='Failed to reconnect %d times, retrying every %s '
+                        'seconds' % (client.reconnector.failures,
+                                     client.reconnector.max_delay))
+
+    def handle_login(self, state, handshake_time=None, msisdn=None):
+        '''Called each time an account logs in, with what the server sent and
+        how long it took since the connection was made.'''
+        self.metrics.incr('login.success')
+        if handshake_time is not None:
+            self.metrics.record('login.handshake_time', handshake_time)
+        if msisdn not in self.logged_in:
+            self.logged_in.add(msisdn)
+            self.metrics.record(
+                'startup.time_to_ready', time.time() - self.started_at)
+        if self.login_state is not None:
+            return self.login_state.save(msisdn, state)
 
     def handle_unknown_event(self, name):
         self.log.info('Unhandled event received: %s' % name)
 
 
+class LoopWaker(asyncore.file_dispatcher):
+    '''A pipe in the stack loop's socket map. Writing to it wakes the loop
+    up from its poll.'''
+
+    def __init__(self, socket_map):
+        self.read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map=socket_map)
+        os.close(self.read_fd)  # file_dispatcher keeps its own copy.
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.pending = False
+
+    def wake(self):
+        if self.pending or self.write_fd is None:
+            return
+        self.pending = True
+        try:
+            os.write(self.write_fd, '\0')
+        except OSError as e:
+            # A full pipe will wake the loop anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        # Empty the pipe before clearing the flag: a wake() in between finds
+        # the flag still set and writes nothing, and its call still runs
+        # after this, with the others that woke the loop. Clearing it first
+        # would let recv() swallow that wake()'s byte and leave the flag set
+        # with nothing left to clear it.
+        self.recv(4096)
+        self.pending = False
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+        self.write_fd = None
+
+
 class StackClient(object):
 
     STACK_BUILDER = YowStackBuilder
+    POLL_TIMEOUT = 60
 
-    def __init__(self, credentials, transport):
+    def __init__(self, credentials, transport, axolotl_state=None,
+                 login_state=None):
         self.CREDENTIALS = credentials
         self.transport = transport
+        self.msisdn = "+" + credentials[0]
+        self.login_state = login_state
 
-        self.stack = self.STACK_BUILDER.getDefaultStack(
-            layer=WhatsAppInterface(transport), media=False, axolotl=True)
+        interface = WhatsAppInterface(transport, self.msisdn)
+        media = transport.config.media
+        if axolotl_state is None:
+            self.stack = self.STACK_BUILDER.getDefaultStack(
+                layer=interface, media=media, axolotl=True)
+        else:
+            # Keys and sessions come from the state loaded from redis, and
+            # changes to them go back to the transport to be written there.
+            self.axolotl_store = MemoryAxolotlStore(
+                axolotl_state, on_change=partial(
+                    transport.reactor_queue.call, 'write_axolotl',
+                    self.msisdn))
+            layers = tuple(
+                StoredAxolotlLayer(self.axolotl_store)
+                if layer is YowAxolotlLayer else layer
+                for layer in self.STACK_BUILDER.getDefaultLayers(
+                    axolotl=True, media=media))
+            self.stack = YowStack(layers + (interface,), reversed=False)
         self.stack.setCredentials(self.CREDENTIALS)
 
         self.network_layer = self.stack.getLayer(0)
         self.whatsapp_interface = self.stack.getLayer(-1)
         self.connect_d = defer.Deferred()
 
+        # Yowsup shares one queue of detached calls and one asyncore socket
+        # map between all stacks in the process, so each client keeps its own
+        # and runs its own loop over them. Queuing a call wakes the loop, so
+        # it runs straight away instead of after the next poll times out.
+        self.detached_calls = deque()
+        self.stack.execDetached = self.exec_detached
+        self.socket_map = {}
+        if isinstance(self.network_layer, asyncore.dispatcher):
+            self.network_layer._map = self.socket_map
+        self.waker = LoopWaker(self.socket_map)
+        self.running = False
+
+        # (deadline, seq, call) of the calls waiting for call_later's delay
+        self.timers = []
+        self._timer_seq = itertools.count()
+        self._timer_lock = threading.Lock()
+        self.whatsapp_interface.call_later = self.call_later
+
+    def start(self, thread_pool):
+        return deferToThreadPool(reactor, thread_pool, self.client_start)
+
     def client_start(self):
 
+        self.resume_login()
         self.whatsapp_interface.connect()
-        self.connect_d.callback(None)
+        self.started()
 
-        self.stack.loop(discrete=0, count=1, timeout=1)
+        self.loop()
+
+    def started(self):
+        reactor.callFromThread(self.connect_d.callback, None)
+
+    def resume_login(self):
+        '''Leaves the nonce from the account's last login, if we have it,
+        where yowsup's login looks for it.'''
+        nonce = (self.login_state or {}).get('nonce')
+        if nonce is not None:
+            StorageTools.writeNonce(self.CREDENTIALS[0], nonce)
+
+    def exec_detached(self, call):
+        '''Queues ``call`` to run in the stack loop thread. Safe to call from
+        any thread.'''
+        self.detached_calls.append(call)
+        self.waker.wake()
+
+    def call_later(self, delay, call):
+        '''Runs ``call`` in the stack loop thread once ``delay`` seconds have
+        passed.'''
+        with self._timer_lock:
+            heapq.heappush(self.timers, (
+                time.time() + delay, next(self._timer_seq), call))
+        self.waker.wake()
+
+    def poll_timeout(self):
+        with self._timer_lock:
+            if not self.timers:
+                return self.POLL_TIMEOUT
+            return max(0, min(
+                self.POLL_TIMEOUT, self.timers[0][0] - time.time()))
+
+    def loop(self):
+        self.running = True
+        try:
+            while self.running:
+                asyncore.loop(
+                    timeout=self.poll_timeout(), count=1,
+                    map=self.socket_map)
+                self.run_detached_calls()
+                self.run_timers()
+        finally:
+            self.waker.close()
+
+    def run_timers(self):
+        now = time.time()
+        while self.running:
+            with self._timer_lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                _deadline, _seq, call = heapq.heappop(self.timers)
+            call()
+
+    def run_detached_calls(self):
+        while self.running:
+            try:
+                call = self.detached_calls.popleft()
+            except IndexError:
+                return
+            call()
 
     def client_stop(self):
         self.transport.log.info("Stopping client ...")
 
         def _stop():
             self.transport.log.info("Sending disconnect ...")
+            self.whatsapp_interface.flush_receipts()
             self.whatsapp_interface.disconnect()
+            self.whatsapp_interface.close_capture()
+            self.running = False
 
-        def _kill():
-            raise WhatsAppClientDone("We are exiting NOW!")
+        # The stack may be waiting for room to publish a message.
+        self.whatsapp_interface.inbound_window.close()
+        self.exec_detached(_stop)
 
-        self.stack.execDetached(_stop)
-        self.stack.execDetached(_kill)
+    def inbound_done(self, receipt=None):
+        '''Called once an inbound message has been published (or failed to
+        be), with the receipt to send for it if it was waiting for that.'''
+        self.whatsapp_interface.inbound_window.release()
+        if receipt is not None:
+            self.exec_detached(
+                lambda: self.whatsapp_interface.send_receipt(*receipt))
+
+    def reconnect(self):
+        self.exec_detached(self.whatsapp_interface.reconnect)
+
+    def disconnect(self):
+        self.exec_detached(self.whatsapp_interface.disconnect)
+
+    def refresh_state(self, axolotl_state=None, login_state=None):
+        '''Replaces the account's axolotl and login state with what was
+        loaded from redis, while the stack is not connected.'''
+        if axolotl_state is not None and hasattr(self, 'axolotl_store'):
+            self.axolotl_store.state = dict(axolotl_state)
+        if login_state is not None:
+            self.login_state = login_state
+            self.resume_login()
+
+    def request_upload(self, entity):
+        self.exec_detached(
+            lambda: self.whatsapp_interface.request_upload(entity))
+
+    def sync_contacts(self, entity):
+        self.exec_detached(
+            lambda: self.whatsapp_interface.sync_contacts(entity))
 
     def send_to_stack(self, msg):
+        queued_at = time.time()
+
         def send():
+            self.transport.metrics.record(
+                'outbound.stack_hop', time.time() - queued_at)
             self.whatsapp_interface.send_to_human(msg)
-        self.stack.execDetached(send)
+        self.exec_detached(send)
 
 
 class WhatsAppInterface(YowInterfaceLayer):
 
-    def __init__(self, transport):
+    def __init__(self, transport, msisdn):
         super(WhatsAppInterface, self).__init__()
         self.transport = transport
+        self.msisdn = msisdn
+        self.reactor_queue = transport.reactor_queue
+        self.event_log = transport.event_log
         self.echo_to = self.transport.config.echo_to
+        config = transport.config
+        self.receipts_after_publish = (
+            config.inbound_receipts == 'after_publish')
+        self.read_receipts = config.inbound_receipt_type == 'read'
+        self.receipt_batch_interval = config.inbound_receipt_batch_interval
+        self.receipt_batch_size = config.inbound_receipt_batch_size
+        self.inbound_window = InFlightWindow(
+            config.max_inbound_in_flight, metrics=transport.metrics)
+        # Set by the stack client to run calls in the stack loop later.
+        self.call_later = None
+        self.connected_at = None
+
+        self.capture = None
+        if config.capture_dir is not None:
+            self.capture = CaptureWriter(os.path.join(
+                config.capture_dir, '%s-%d.vxcap' % (
+                    msisdn.lstrip('+'), time.time())))
+        # Called with a name and the seconds taken for each node handled,
+        # when profiling.
+        self.timer = None
+
+        # (to, participant) -> ids of the messages waiting for a receipt
+        self.receipts = {}
+        self._receipts_lock = threading.Lock()
+        self._receipts_flush_pending = False
 
     def send_to_human(self, msg):
         self.toLower(msg)
 
+    def receive(self, entity):
+        if self.capture is not None:
+            self.write_capture(INBOUND, entity.toProtocolTreeNode)
+        if self.timer is None:
+            super(WhatsAppInterface, self).receive(entity)
+            return
+        started = time.time()
+        super(WhatsAppInterface, self).receive(entity)
+        self.timer('stack:%s' % (entity.getTag(),), time.time() - started)
+
+    def toLower(self, entity):
+        if self.capture is not None:
+            self.write_capture(OUTBOUND, entity.toProtocolTreeNode)
+        super(WhatsAppInterface, self).toLower(entity)
+
+    def write_capture(self, direction, make_node):
+        '''Captures the node ``make_node`` returns. If that fails, capturing
+        stops, rather than losing the entity being received or sent.'''
+        try:
+            self.capture.write(direction, make_node())
+        except Exception as e:
+            self.event_log.error(
+                'capture.failed', path=self.capture.path, error=repr(e))
+            self.close_capture()
+
+    def close_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def send_receipt(self, message_id, to, participant):
+        '''Sends a receipt for a message, or collects it to be sent in one
+        receipt with the others for the same chat.'''
+        if not self.receipt_batch_interval or self.call_later is None:
+            self.toLower(OutgoingReceiptProtocolEntity(
+                message_id, to, self.read_receipts, participant))
+            return
+        key = (to, participant)
+        with self._receipts_lock:
+            ids = self.receipts.setdefault(key, [])
+            ids.append(message_id)
+            full = len(ids) >= self.receipt_batch_size
+            if full:
+                del self.receipts[key]
+            schedule = not full and not self._receipts_flush_pending
+            if schedule:
+                self._receipts_flush_pending = True
+        if full:
+            self._send_receipts(key, ids)
+        elif schedule:
+            self.call_later(self.receipt_batch_interval, self.flush_receipts)
+
+    def flush_receipts(self):
+        '''Sends all the collected receipts.'''
+        with self._receipts_lock:
+            receipts, self.receipts = self.receipts, {}
+            self._receipts_flush_pending = False
+        for key, ids in receipts.iteritems():
+            self._send_receipts(key, ids)
+
+    def _send_receipts(self, key, ids):
+        to, participant = key
+        self.transport.metrics.record('receipts.batch_size', len(ids))
+        self.toLower(OutgoingReceiptProtocolEntity(
+            ids, to, self.read_receipts, participant))
+
+    def reconnect(self):
+        self.broadcastEvent(
+            YowLayerEvent(YowNetworkLayer.EVENT_STATE_CONNECT))
+
+    def request_upload(self, entity):
+        '''Sends a request to upload media. The answer is passed to the
+        transport's ``handle_upload_slot``.'''
+        def success(result, request):
+            self.reactor_queue.call(
+                'handle_upload_slot', request.getId(), result.getUrl(),
+                result.isDuplicate())
+
+        def error(result, request):
+            self.reactor_queue.call(
+                'handle_upload_slot', request.getId(), None,
+                error='%s %s' % (result.code, result.text))
+
+        self._sendIq(entity, success, error)
+
+    def sync_contacts(self, entity):
+        '''Asks the server which numbers are WhatsApp users. The answer is
+        passed to the transport's ``handle_sync_result``.'''
+        def success(result, request):
+            self.reactor_queue.call(
+                'handle_sync_result', request.getId(), result.inNumbers,
+                list(result.outNumbers) + result.invalidNumbers)
+
+        self._sendIq(entity, success)
+
     @ProtocolEntityCallback("message")
     def onMessage(self, messageProtocolEntity):
-        self.transport.log.info('Received %s' % (
-            ' '.join(str(messageProtocolEntity).split('\n')),
-        ))
+        received_at = time.time()
+        self.event_log.info(
+            'message.received', id=messageProtocolEntity.getId(),
+            sender=messageProtocolEntity.getFrom(False))
+        self.event_log.debug(
+            'message.received',
+            entity=lambda: render_entity(messageProtocolEntity))
 
+        media = None
         try:
             from_address = "+" + messageProtocolEntity.getFrom(False)
             from_address = from_address.decode("UTF-8")
-            body = messageProtocolEntity.getBody().decode("UTF-8")
+            if messageProtocolEntity.getType() == 'media':
+                media = inbound_media(messageProtocolEntity)
+                body = media.pop('caption', None)
+                if body is not None:
+                    body = body.decode("UTF-8")
+            else:
+                body = messageProtocolEntity.getBody().decode("UTF-8")
         except UnicodeDecodeError:
-            message = ' '.join(str(messageProtocolEntity).split('\n'))
-            self.transport.log.err('Cannot decode %r' % message)
-            reactor.callFromThread(
-                self.transport.handle_inbound_error,
-                'Cannot decode', '%r' % message)
+            message = render_entity(messageProtocolEntity)
+            self.event_log.error('message.undecodable', entity=repr(message))
+            self.reactor_queue.call(
+                'handle_inbound_error', 'Cannot decode', '%r' % message)
             return
 
-        receipt = OutgoingReceiptProtocolEntity(
+        receipt = (
             messageProtocolEntity.getId(),
             msisdn_to_whatsapp(from_address).encode("UTF-8"),
-            'read',
             messageProtocolEntity.getParticipant())
-        self.toLower(receipt)
+        if self.receipts_after_publish:
+            receipt_after_publish = receipt
+        else:
+            receipt_after_publish = None
+            self.send_receipt(*receipt)
 
-        if self.echo_to:
-            self.transport.log.debug(
-                'Echoing message received by transport to %s' % self.echo_to)
-            reactor.callFromThread(
-                self.transport.handle_outbound_message,
+        if self.echo_to and media is None:
+            self.event_log.debug('message.echo', to=self.echo_to)
+            self.reactor_queue.call(
+                'handle_outbound_message',
                 TransportUserMessage(
-                    to_addr=self.echo_to, from_addr=self.transport.our_msisdn,
+                    to_addr=self.echo_to, from_addr=self.msisdn,
                     content=body, transport_name='whatsapp',
                     transport_type='whatsapp'))
 
-        reactor.callFromThread(
-            self.transport.publish_message,
-            from_addr=from_address, content=body,
-            to_addr=self.transport.our_msisdn,
+        # Blocks while too many messages are waiting to be published.
+        self.inbound_window.acquire()
+        self.reactor_queue.call(
+            'publish_inbound', received_at, receipt_after_publish,
+            media=media, from_addr=from_address, content=body,
+            to_addr=self.msisdn,
             transport_type=self.transport.transport_type,
             to_addr_type=TransportUserMessage.AT_MSISDN,
             from_addr_type=TransportUserMessage.AT_MSISDN)
-        reactor.callFromThread(
-            self.transport.handle_inbound_success)
+
+    @ProtocolEntityCallback("success")
+    def onSuccess(self, entity):
+        '''logged in'''
+        self.event_log.info(
+            'login.success', status=entity.status, kind=entity.kind)
+        handshake_time = None
+        if self.connected_at is not None:
+            handshake_time = time.time() - self.connected_at
+        self.reactor_queue.call(
+            'handle_login', {
+                'nonce': entity.nonce, 'status': entity.status,
+                'kind': entity.kind, 'creation': entity.creation,
+                'expiration': entity.expiration, 't': entity.t,
+            }, handshake_time, msisdn=self.msisdn)
 
     @ProtocolEntityCallback("receipt")
     def onReceipt(self, entity):
         '''receives confirmation of delivery to human'''
-        self.transport.log.info(
-            'Received %s' % ' '.join(str(entity).split('\n')))
+        self.event_log.info(
+            'receipt.received', id=entity.getId(), type=entity.getType())
+        self.event_log.debug(
+            'receipt.received', entity=lambda: render_entity(entity))
+        # An ack carries a single id, so unlike the receipts we send for
+        # inbound messages, these can't be batched.
         ack = OutgoingAckProtocolEntity(
             entity.getId(), "receipt", entity.getType(), entity.getFrom())
         self.toLower(ack)
@@ -264,27 +1754,29 @@ class WhatsAppInterface(YowInterfaceLayer):
         # entity.getType() is 'read'
         # when it is delivered and read simultaneously,
         # only one receipt is sent and entity.getType() is 'read'
-        reactor.callFromThread(
-            self.transport._send_delivery_report, entity.getId())
+        self.reactor_queue.call('_send_delivery_report', entity.getId())
 
     @ProtocolEntityCallback("ack")
     def onAck(self, ack):
         '''receives confirmation of delivery to server'''
         # sent_message_id: whatsapp id
         # user_message_id: vumi_id
-        self.transport.log.info('Received %s' % ' '.join(str(ack).split('\n')))
+        self.event_log.info(
+            'ack.received', id=ack.getId(), **{'class': ack.getClass()})
         if ack.getClass() == "message":
-            reactor.callFromThread(self.transport._send_ack, ack.getId())
+            self.reactor_queue.call('_send_ack', ack.getId())
 
     def onEvent(self, event):
         name = event.getName()
+        if self.capture is not None:
+            self.write_capture(
+                EVENT, lambda: event_node(name, event.args.get('reason')))
         if name == YowNetworkLayer.EVENT_STATE_CONNECTED:
-            reactor.callFromThread(self.transport.handle_connected)
+            self.connected_at = time.time()
+            self.reactor_queue.call('handle_connected', msisdn=self.msisdn)
         elif name == YowNetworkLayer.EVENT_STATE_DISCONNECTED:
-            reactor.callFromThread(
-                self.transport.handle_disconnected, event.args.get('reason'))
-            self.broadcastEvent(
-                YowLayerEvent(YowNetworkLayer.EVENT_STATE_CONNECT))
+            self.reactor_queue.call(
+                'handle_disconnected', event.args.get('reason'),
+                msisdn=self.msisdn)
         else:
-            reactor.callFromThread(
-                self.transport.handle_unknown_event, name)
+            self.reactor_queue.call('handle_unknown_event', name)